@@ -0,0 +1,23 @@
+from __future__ import absolute_import, division, print_function
+import tensorflow as tf
+from config import get_config
+from data_input import DataInput
+
+logging = tf.logging
+flags = tf.flags
+flags.DEFINE_string("save_path", None, "Model output directory")
+flags.DEFINE_string("config_file", None, "Model config file")
+flags.DEFINE_integer("num_workers", 4, "Number of processes reading the data set (0 == sequential)")
+flags.DEFINE_bool("overwrite", False, "Recompute the stats even if they already exist")
+FLAGS = flags.FLAGS
+
+if __name__ == "__main__":
+    # Precomputes the normalization stats of the data set, without loading it in memory
+    config = get_config(FLAGS)
+    data_input = DataInput(config, load_data=False)
+
+    if data_input.pose_stats_exist() and not FLAGS.overwrite:
+        print('Stats already computed, use --overwrite to recompute them')
+    else:
+        stats = data_input.compute_pose_stats(not config.only_val, FLAGS.num_workers)
+        data_input.save_pose_stats(stats)
@@ -9,7 +9,7 @@ from collections import OrderedDict
 
 class Config(object):
     def __init__(self, flags):
-        self.base_config = os.path.join('configs', 'base_config.py')
+        self.base_config = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'configs', 'base_config.py')
         with open(self.base_config, 'r') as f:
             dict_file = eval(f.read())
             self.__dict__ = dict_file
@@ -8,6 +8,16 @@
     'normalize_data': True,
     # Perform per joint normalization
     'normalize_per_joint': False,
+    # Compile the processed sequences once into a memory mapped cache, stored in data_path
+    'data_cache': False,
+    # Number of processes reading the data set on startup (0 == sequential)
+    'load_workers': 0,
+    # Draw the training batches balancing the action classes
+    'balance_classes': False,
+    # Stream the sequences from the data set instead of loading them, for data sets larger than ram
+    'data_streaming': False,
+    # Approximate size of the shuffle buffer used when streaming, in MB
+    'stream_buffer_mb': 1024,
 
     ## Model Options
     # Model type to train
@@ -65,7 +75,7 @@
     'motiongan_save_path': None,
 
     ## Training Options
-    # It's the batch size
+    # It's the batch size, models built with None accept any batch size (e.g. for serving)
     'batch_size': 256,
     # Final epoch
     'num_epochs': 128,
@@ -81,6 +91,25 @@
     'crop_len': 0,
     # Train on future prediction task only
     'train_fp': False,
+    # Training input pipeline: feed_dict (numpy batches, prefetch options below), tf_data (in graph)
+    'input_pipeline': 'feed_dict',
+    # Number of background workers preparing the training batches (0 == synchronous)
+    'prefetch_workers': 0,
+    # Type of the prefetch workers: thread, process (forked before the model and session are built)
+    'prefetch_type': 'thread',
+    # Max number of prepared batches waiting for the training loop (also used by tf_data)
+    'prefetch_queue_size': 8,
+    # Train discriminator and generator in a single step on the same batch, instead of alternating
+    'fused_train_step': False,
+    # Number of training steps per session run, in a graph loop (needs the tf_data input pipeline,
+    # not supported with mixed_precision, the float16 weight casts would only be read once per run)
+    'steps_per_run': 1,
+    # Number of data parallel replicas, the batch is split among them (1 == deactivated)
+    'num_replicas': 1,
+    # Type of the local devices running the replicas: gpu, cpu (virtual cpu devices are created)
+    'replica_device': 'gpu',
+    # Networks compute in float16, with float32 weights and losses and dynamic loss scaling
+    'mixed_precision': False,
 
 
     ## Environment Options
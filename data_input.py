@@ -4,16 +4,47 @@ import tensorflow as tf
 import numpy as np
 import h5py as h5
 import os
+import hashlib
+import ctypes
+import multiprocessing
 from glob import glob
 from tqdm import trange
 from utils.threadsafe_iter import threadsafe_generator
 from utils.seq_utils import get_swap_list
+from utils.running_stats import RunningStats
 import re
 
+# Bump when the layout or the processing of the compiled cache changes
+CACHE_VERSION = 1
+
+# Number of sequences read and processed at once when loading
+READ_CHUNK_LEN = 256
+
+# DataInput used by the pool workers, inherited when they are forked
+_pool_data_input = None
+
+
+def _pool_init():
+    # HDF5 handles must not be shared across processes, each worker opens its own
+    _pool_data_input.h5file = h5.File(_pool_data_input.h5file_path, 'r')
+
+
+def pose_stats_file_paths(config):
+    """Paths of the mean and std files of the data set of config (or a DataInput)"""
+    stat_type = '_perjoint' if config.normalize_per_joint else '_global'
+    mean_file_path = os.path.join(config.data_path, config.data_set + config.data_set_version + stat_type + '_poses_mean.npy')
+    std_file_path = os.path.join(config.data_path, config.data_set + config.data_set_version + stat_type + '_poses_std.npy')
+    return mean_file_path, std_file_path
+
+
+def _pool_call(args):
+    method_name, method_args = args
+    return getattr(_pool_data_input, method_name)(*method_args)
+
 
 class DataInput(object):
     """The input data."""
-    def __init__(self, config):
+    def __init__(self, config, load_data=True):
         self.data_path = config.data_path
         self.data_set = config.data_set
         self.batch_size = config.batch_size
@@ -26,6 +57,11 @@ class DataInput(object):
         self.epoch_factor = config.epoch_factor
         self.augment_data = config.augment_data
         self.body_members = config.body_members
+        self.data_cache = config.data_cache
+        self.load_workers = config.load_workers
+        self.data_streaming = config.data_streaming
+        self.stream_buffer_mb = config.stream_buffer_mb
+        self.balance_classes = config.balance_classes
 
         self.swap_list = get_swap_list(self.body_members)
 
@@ -33,8 +69,8 @@ class DataInput(object):
             self.used_joints = config.used_joints
             self.full_njoints = config.full_njoints
 
-        file_path = os.path.join(self.data_path, self.data_set + self.data_set_version + '.h5')
-        self.h5file = h5.File(file_path, 'r')
+        self.h5file_path = os.path.join(self.data_path, self.data_set + self.data_set_version + '.h5')
+        self.h5file = h5.File(self.h5file_path, 'r')
         self.train_keys = [self.data_set + '/Train/' + k
                            for k in self.h5file.get(self.data_set + '/Train').keys()]
         self.val_keys = [self.data_set + '/Validate/' + k
@@ -63,80 +99,312 @@ class DataInput(object):
         self.pshape[1] = self.pick_num if self.pick_num > 0 else (
                          self.crop_len if self.crop_len > 0 else None)
 
+        # Ragged storage: all the frames of a split in a flat [nframes, njoints, 4] buffer, with the
+        # labels and the start offset of each sequence. Batches are gathered from them on the fly
+        self.frames = {}
+        self.labs = {}
+        self.starts = {}
+        self._epoch_samples = {}
+        self._frames_ph = {}
+
+        # Without loading, e.g. to only precompute the stats
+        if not load_data:
+            return
+
+        if self.data_streaming:
+            # Nothing is loaded, batch_generator streams the sequences from the data set (or its
+            # memory mapped cache), so only the stats are needed upfront
+            if self.data_cache:
+                for is_training in ([False] if self.only_val else [True, False]):
+                    self.load_split(is_training)
+            else:
+                self.load_pose_stats()
+        else:
+            if not self.only_val:
+                self.load_split(True)
+            self.load_split(False)
+
         if not self.only_val:
-            self.train_batches = self.pre_comp_batches(True)
-            self.train_batches *= self.epoch_factor
             self.train_epoch_size *= self.epoch_factor
-        self.val_batches = self.pre_comp_batches(False)
 
-    def pre_comp_batches(self, is_training):
+    def load_split(self, is_training):
+        if self.data_cache:
+            labs, frames, starts = self.load_cache(is_training)
+        else:
+            labs, frames, starts = self.load_to_ram(is_training)
+        self.labs[is_training] = labs
+        self.frames[is_training] = frames
+        self.starts[is_training] = starts
+
+    def epoch_samples(self, is_training, epoch, seed=42):
+        """Sequence indices of the batches of an epoch, [epoch_size * batch_size]. They only
+        depend on the seed and the epoch number, and the batch membership is reshuffled every
+        epoch: successive permutations of the split, or class balanced draws (by action) with
+        balance_classes. With only_val, the sequences come in order, wrapping around at the end."""
         epoch_size = self.train_epoch_size if is_training else self.val_epoch_size
-        labs, poses = self.load_to_ram(is_training)
-
-        batches = []
-        for slice_idx in range(epoch_size):
-            slice_start = slice_idx * self.batch_size
-            slice_len = min(slice_start + self.batch_size, labs.shape[0])
-            labs_batch = labs[slice_start:slice_len, ...]
-            poses_batch = poses[slice_start:slice_len, ...]
-            if labs_batch.shape[0] < self.batch_size:
-                rand_indices = np.random.random_integers(0, poses.shape[0] - 1, self.batch_size - labs_batch.shape[0])
-                labs_batch_extra = labs[rand_indices, ...]
-                labs_batch = np.concatenate([labs_batch, labs_batch_extra], axis=0)
-                poses_batch_extra = poses[rand_indices, ...]
-                poses_batch = np.concatenate([poses_batch, poses_batch_extra], axis=0)
-            batches.append((labs_batch, poses_batch))
-
-        del labs
-        del poses
-
-        return batches
+        nseqs = self.labs[is_training].shape[0]
+        nsamples = epoch_size * self.batch_size
+
+        # Only the last epoch of each split is kept, replaced at once to be safe across threads
+        cached = self._epoch_samples.get(is_training)
+        if cached is not None and cached[0] == (seed, epoch):
+            return cached[1]
+
+        if self.only_val:
+            samples = np.arange(nsamples) % nseqs
+        else:
+            rng = np.random.RandomState([seed, epoch])
+            if self.balance_classes and is_training:
+                _, seq_classes, class_counts = np.unique(self.labs[is_training][:, 2],
+                                                         return_inverse=True, return_counts=True)
+                probs = 1.0 / class_counts[seq_classes]
+                samples = rng.choice(nseqs, nsamples, p=probs / np.sum(probs))
+            else:
+                nperms = -(-nsamples // nseqs)
+                samples = np.concatenate([rng.permutation(nseqs) for _ in range(nperms)])[:nsamples]
+
+        self._epoch_samples[is_training] = ((seed, epoch), samples)
+        return samples
+
+    def get_batch_samples(self, is_training, index, seed=42):
+        """Labels and starts of the index-th batch of the stream, see epoch_samples."""
+        epoch_size = self.train_epoch_size if is_training else self.val_epoch_size
+        epoch, slice_idx = divmod(index, epoch_size)
+        seq_idcs = self.epoch_samples(is_training, epoch, seed)[
+            slice_idx * self.batch_size:(slice_idx + 1) * self.batch_size]
+        return self.labs[is_training][seq_idcs, :], self.starts[is_training][seq_idcs]
 
     def load_to_ram(self, is_training):
-        len_keys = self.len_train_keys if is_training else self.len_val_keys
+        """Loads the split in the ragged layout: returns the labels, the flat frames
+        [nframes, njoints, 4] and the start offset of each sequence in them."""
+        keys = self.train_keys if is_training else self.val_keys
+        len_keys = len(keys)
         labs = np.empty([len_keys, 4], dtype=np.int32)
-        poses = np.zeros([len_keys, self.pshape[0], self.max_plen, self.pshape[2]], dtype=np.float32)
+        starts = np.empty([len_keys], dtype=np.int64)
+
+        # Raw lengths are an upper bound of the trimmed ones, the excess is released after reading
+        bound_lens = np.array([min(self.h5file[key + '/Pose'].shape[-1], self.max_plen) for key in keys], dtype=np.int64)
+        max_nframes = np.sum(bound_lens)
+        key_chunks = self._key_chunks(len_keys)
+        if self.load_workers > 0:
+            frames, chunk_reader = self._read_chunks_parallel(is_training, key_chunks, bound_lens)
+        else:
+            frames = np.empty([max_nframes, self.pshape[0], self.pshape[2]], dtype=np.float32)
+            chunk_reader = ((key_idcs,) + self.read_seqs_frames(key_idcs, is_training) for key_idcs in key_chunks)
+
+        # Stats are accumulated while reading, if they have to be computed
+        stats = None if self.pose_stats_exist() else self.new_pose_stats()
+
         splitname = 'train' if is_training else 'val'
         print('Loading "%s" data to ram...' % splitname)
+        nframes = 0
         t = trange(len_keys, dynamic_ncols=True)
-        for k in t:
-            seq_idx, subject, action, pose, plen = self.read_h5_data(k, is_training)
-            pose = pose[:, :, :self.max_plen] if plen > self.max_plen else pose
-            plen = self.max_plen if plen > self.max_plen else plen
-            labs[k, :] = [seq_idx, subject, action, plen]
-            poses[k, :, :plen, :] = pose
-
-        stat_type = '_perjoint' if self.normalize_per_joint else '_global'
-        mean_file_path = os.path.join(self.data_path, self.data_set + self.data_set_version + stat_type + '_poses_mean.npy')
-        std_file_path = os.path.join(self.data_path, self.data_set + self.data_set_version + stat_type + '_poses_std.npy')
-
-        if tf.gfile.Exists(mean_file_path) and tf.gfile.Exists(std_file_path):
-            self.poses_mean = np.load(mean_file_path)
-            self.poses_std = np.load(std_file_path)
+        for key_idcs, chunk_labs, chunk_frames in chunk_reader:
+            labs[key_idcs, :] = chunk_labs
+            starts[key_idcs] = nframes + np.cumsum(labs[key_idcs, 3]) - labs[key_idcs, 3]
+            chunk_nframes = chunk_frames.shape[0]
+            # In the parallel case, this compacts the chunk within the shared buffer
+            frames[nframes:nframes + chunk_nframes, ...] = chunk_frames
+            if stats is not None:
+                self.update_pose_stats(stats, frames[nframes:nframes + chunk_nframes, ...])
+            nframes += chunk_nframes
+            t.update(len(key_idcs))
+        t.close()
+        if self.load_workers > 0:
+            # Copied, a view would keep the whole upper bound shared buffer alive
+            frames = np.array(frames[:nframes, ...])
         else:
-            print('Computing mean and std of skels')
-            norm_dims = (0, 2) if self.normalize_per_joint else (0, 1, 2)
-            self.poses_mean = np.mean(poses[..., :3], axis=norm_dims, keepdims=True)
-            self.poses_std = np.std(poses[..., :3], axis=norm_dims, keepdims=True)
-            print(self.poses_mean, self.poses_std)
-            np.save(mean_file_path, self.poses_mean)
-            np.save(std_file_path, self.poses_std)
-
-            zero_std = [i for i in range(self.poses_std.shape[1]) if np.sum(self.poses_std[:, i, ...], axis=-1) < 1e-4]
-            if len(zero_std) > 0:
-                print('Warning: the following joints have zero std:', zero_std)
-
-        # print(np.min(poses, (0, 1, 2)), np.max(poses, (0, 1, 2)))
-        # print(np.std(poses[..., :3], axis=(0, 1, 2), keepdims=True))
+            frames.resize([nframes, self.pshape[0], self.pshape[2]], refcheck=False)
+
+        self.load_pose_stats(stats)
+
         if self.normalize_data:
-            poses[..., :3] = self.normalize_poses(poses[..., :3])
+            frames[..., :3] = self.normalize_frames(frames[..., :3])
 
-        # print(np.min(poses, (0, 1, 2)), np.max(poses, (0, 1, 2)))
-        # print(np.std(poses[..., :3], axis=(0, 1, 2), keepdims=True))
+        return labs, frames, starts
 
-        return labs, poses
+    def _stats_file_paths(self):
+        return pose_stats_file_paths(self)
 
-    def read_h5_data(self, key_idx, is_training):
+    def pose_stats_exist(self):
+        mean_file_path, std_file_path = self._stats_file_paths()
+        return tf.gfile.Exists(mean_file_path) and tf.gfile.Exists(std_file_path)
+
+    def new_pose_stats(self):
+        return RunningStats([self.pshape[0], 3] if self.normalize_per_joint else [3])
+
+    def update_pose_stats(self, stats, frames):
+        # frames: [nframes, njoints, 4], the global stats also reduce over the joints
+        frames = frames[..., :3]
+        if not self.normalize_per_joint:
+            frames = np.reshape(frames, [-1, 3])
+        stats.update(frames)
+
+    def load_pose_stats(self, stats=None):
+        """Loads the normalization stats. If missing, they are taken from stats, a RunningStats
+        accumulated over the valid frames, or computed with compute_pose_stats, then saved.
+        The stats are always kept with shape [1, njoints or 1, 1, 3]"""
+        if self.pose_stats_exist():
+            mean_file_path, std_file_path = self._stats_file_paths()
+            self.poses_mean = np.load(mean_file_path)
+            self.poses_std = np.load(std_file_path)
+        else:
+            if stats is None:
+                stats = self.compute_pose_stats(not self.only_val)
+            self.save_pose_stats(stats)
+
+    def save_pose_stats(self, stats):
+        mean_file_path, std_file_path = self._stats_file_paths()
+        stats_shape = [1, self.pshape[0] if self.normalize_per_joint else 1, 1, 3]
+        self.poses_mean = np.reshape(stats.mean, stats_shape).astype(np.float32)
+        self.poses_std = np.reshape(stats.std, stats_shape).astype(np.float32)
+        print(self.poses_mean, self.poses_std)
+        np.save(mean_file_path, self.poses_mean)
+        np.save(std_file_path, self.poses_std)
+
+        zero_std = [i for i in range(self.poses_std.shape[1]) if np.sum(self.poses_std[:, i, ...], axis=-1) < 1e-4]
+        if len(zero_std) > 0:
+            print('Warning: the following joints have zero std:', zero_std)
+
+    def compute_pose_stats(self, is_training=True, num_workers=0):
+        """Computes the normalization stats streaming over the sequences of the split, so the
+        data never has to be fully in memory. With num_workers > 0, the sequences are sharded
+        across a pool of processes, and their partial stats merged in order."""
+        len_keys = self.len_train_keys if is_training else self.len_val_keys
+        stats = self.new_pose_stats()
+
+        print('Computing mean and std of skels')
+        t = trange(len_keys, dynamic_ncols=True)
+        if num_workers > 0:
+            shards = np.array_split(np.arange(len_keys), num_workers * 8)
+            shards_args = [(is_training, shard) for shard in shards if len(shard) > 0]
+            for shard_len, shard_stats in self.pool_map('_shard_pose_stats', shards_args, num_workers):
+                stats.merge(shard_stats)
+                t.update(shard_len)
+        else:
+            for key_idcs in self._key_chunks(len_keys):
+                self.update_pose_stats(stats, self.read_seqs_frames(key_idcs, is_training)[1])
+                t.update(len(key_idcs))
+        t.close()
+
+        return stats
+
+    def _shard_pose_stats(self, is_training, key_idcs):
+        stats = self.new_pose_stats()
+        for chunk_start in range(0, len(key_idcs), READ_CHUNK_LEN):
+            chunk_idcs = key_idcs[chunk_start:chunk_start + READ_CHUNK_LEN]
+            self.update_pose_stats(stats, self.read_seqs_frames(chunk_idcs, is_training)[1])
+        return len(key_idcs), stats
+
+    def pool_map(self, method_name, args_list, num_workers):
+        """Maps a method of this DataInput over args_list with a pool of forked processes,
+        yielding the results in order. Each worker opens its own HDF5 handle."""
+        global _pool_data_input
+        self.h5file.close()
+        _pool_data_input = self
+        pool = multiprocessing.Pool(num_workers, _pool_init)
+        try:
+            for result in pool.imap(_pool_call, [(method_name, args) for args in args_list]):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+            _pool_data_input = None
+            self.h5file = h5.File(self.h5file_path, 'r')
+
+    def _cache_file_paths(self, is_training):
+        splitname = 'train' if is_training else 'val'
+        used_joints = self.used_joints if "Human36" in self.data_set else None
+        cache_key = repr((CACHE_VERSION, self.data_set, self.data_set_version, used_joints,
+                          self.max_plen, self.normalize_data, self.normalize_per_joint))
+        cache_hash = hashlib.md5(cache_key.encode('utf-8')).hexdigest()[:12]
+        base_path = os.path.join(self.data_path, '%s%s_%s_cache_%s' %
+                                 (self.data_set, self.data_set_version, splitname, cache_hash))
+        return base_path + '_poses.bin', base_path + '_index.npz'
+
+    def _cache_source_info(self, is_training):
+        keys = self.train_keys if is_training else self.val_keys
+        return np.array([os.path.getmtime(self.h5file.filename), len(keys)], dtype=np.float64)
+
+    def compile_cache(self, is_training):
+        """Processes every sequence of the split once and writes the trimmed poses in a flat
+        float32 file, frame major ([nframes, njoints, 4]), along with an index file holding
+        the labels and the start offset of each sequence."""
+        poses_path, index_path = self._cache_file_paths(is_training)
+        len_keys = self.len_train_keys if is_training else self.len_val_keys
+        labs = np.empty([len_keys, 4], dtype=np.int32)
+        starts = np.empty([len_keys], dtype=np.int64)
+        splitname = 'train' if is_training else 'val'
+        print('Compiling "%s" data cache...' % splitname)
+
+        # Written under temporary names, so an interrupted compilation is never picked up
+        tmp_poses_path = poses_path + '.tmp'
+        tmp_index_path = index_path[:-len('.npz')] + '_tmp.npz'
+        stats = None if self.pose_stats_exist() else self.new_pose_stats()
+        nframes = 0
+        with open(tmp_poses_path, 'wb') as f:
+            t = trange(len_keys, dynamic_ncols=True)
+            for key_idcs in self._key_chunks(len_keys):
+                labs[key_idcs, :], chunk_frames = self.read_seqs_frames(key_idcs, is_training)
+                starts[key_idcs] = nframes + np.cumsum(labs[key_idcs, 3]) - labs[key_idcs, 3]
+                chunk_frames.tofile(f)
+                nframes += chunk_frames.shape[0]
+                if stats is not None:
+                    self.update_pose_stats(stats, chunk_frames)
+                t.update(len(key_idcs))
+            t.close()
+
+        frames = np.memmap(tmp_poses_path, dtype=np.float32, mode='r+',
+                           shape=(nframes, self.pshape[0], self.pshape[2]))
+        self.load_pose_stats(stats)
+        if self.normalize_data:
+            chunk_len = 2 ** 16
+            for chunk_start in range(0, nframes, chunk_len):
+                chunk = frames[chunk_start:chunk_start + chunk_len, :, :3]
+                frames[chunk_start:chunk_start + chunk_len, :, :3] = self.normalize_frames(chunk)
+        frames.flush()
+        del frames
+
+        np.savez(tmp_index_path, labs=labs, starts=starts, nframes=nframes,
+                 poses_mean=self.poses_mean, poses_std=self.poses_std,
+                 source_info=self._cache_source_info(is_training))
+        os.rename(tmp_poses_path, poses_path)
+        os.rename(tmp_index_path, index_path)
+
+    def load_cache(self, is_training):
+        """Opens the compiled cache of the split, compiling it first if it is missing or stale.
+        Returns the labels, the memory mapped frames and the start offset of each sequence."""
+        poses_path, index_path = self._cache_file_paths(is_training)
+
+        is_valid = tf.gfile.Exists(poses_path) and tf.gfile.Exists(index_path)
+        if is_valid:
+            with np.load(index_path) as index:
+                is_valid = np.array_equal(index['source_info'], self._cache_source_info(is_training))
+        if not is_valid:
+            self.compile_cache(is_training)
+
+        with np.load(index_path) as index:
+            labs = index['labs']
+            starts = index['starts']
+            nframes = int(index['nframes'])
+            self.poses_mean = index['poses_mean']
+            self.poses_std = index['poses_std']
+
+        frames = np.memmap(poses_path, dtype=np.float32, mode='r',
+                           shape=(nframes, self.pshape[0], self.pshape[2]))
+
+        return labs, frames, starts
+
+    @property
+    def pad_frame(self):
+        # Padding frame used past the end of short sequences: zeros, as seen after normalization
+        if getattr(self, '_pad_frame', None) is None:
+            self._pad_frame = np.zeros([self.pshape[0], 1, self.pshape[2]], dtype=np.float32)
+            if self.normalize_data:
+                self._pad_frame[..., :3] = self.normalize_poses(np.zeros([1, self.pshape[0], 1, 3]))[0, ...]
+        return self._pad_frame
+
+    def read_h5_raw(self, key_idx, is_training):
         if is_training:
             key = self.train_keys[key_idx]
         else:
@@ -146,32 +414,107 @@ class DataInput(object):
         action = np.int32(self.h5file[key+'/Action']) - 1  # Small hack to reindex the classes from 0
         pose = np.array(self.h5file[key+'/Pose'], dtype=np.float32)
 
-        pose, plen = self.process_pose(pose)
-
         seq_idx = np.int32(re.match(self.key_pattern, key).group(1))
 
+        return seq_idx, subject, action, pose
+
+    def read_h5_data(self, key_idx, is_training):
+        seq_idx, subject, action, pose = self.read_h5_raw(key_idx, is_training)
+
+        pose, plen = self.process_pose(pose)
+
         return seq_idx, subject, action, pose, plen
 
+    def read_seqs_frames(self, key_idcs, is_training):
+        """Reads and processes a chunk of sequences at once, capped at max_plen. Returns their
+        labels [len(key_idcs), 4] and their frames, concatenated [nframes, njoints, 4]."""
+        labs = np.empty([len(key_idcs), 4], dtype=np.int32)
+        poses = []
+        for i, k in enumerate(key_idcs):
+            seq_idx, subject, action, pose = self.read_h5_raw(k, is_training)
+            labs[i, :3] = [seq_idx, subject, action]
+            poses.append(pose)
+        frames, labs[:, 3] = self.process_poses(poses, self.max_plen)
+        return labs, np.asarray(frames, dtype=np.float32)
+
+    def _read_chunks_parallel(self, is_training, key_chunks, bound_lens):
+        """Reads the chunks with a pool of load_workers processes. The workers write the frames
+        (and labels) in shared memory, each chunk at the offset given by the raw lengths, so
+        nothing is pickled back. Returns the shared frames buffer and a generator of the
+        (key_idcs, labels, frames) of each chunk, in order, as views of the shared memory."""
+        len_keys = bound_lens.shape[0]
+        max_nframes = int(np.sum(bound_lens))
+        frames_shape = [max_nframes, self.pshape[0], self.pshape[2]]
+        self._shared_frames = multiprocessing.RawArray(ctypes.c_float, int(np.prod(frames_shape)))
+        self._shared_labs = multiprocessing.RawArray(ctypes.c_int32, len_keys * 4)
+        frames = np.ctypeslib.as_array(self._shared_frames).reshape(frames_shape)
+        labs = np.ctypeslib.as_array(self._shared_labs).reshape([len_keys, 4])
+
+        bound_starts = np.cumsum(bound_lens) - bound_lens
+        chunks_args = [(is_training, key_idcs, bound_starts[key_idcs[0]]) for key_idcs in key_chunks]
+
+        def _chunk_reader():
+            try:
+                chunks_nframes = self.pool_map('_read_chunk_to_shared', chunks_args, self.load_workers)
+                for c, chunk_nframes in enumerate(chunks_nframes):
+                    _, key_idcs, bound_start = chunks_args[c]
+                    yield key_idcs, labs[key_idcs, :], frames[bound_start:bound_start + chunk_nframes, ...]
+            finally:
+                # The buffers stay referenced by the returned arrays
+                self._shared_frames = None
+                self._shared_labs = None
+
+        return frames, _chunk_reader()
+
+    def _read_chunk_to_shared(self, is_training, key_idcs, bound_start):
+        chunk_labs, chunk_frames = self.read_seqs_frames(key_idcs, is_training)
+        frames = np.ctypeslib.as_array(self._shared_frames).reshape([-1, self.pshape[0], self.pshape[2]])
+        labs = np.ctypeslib.as_array(self._shared_labs).reshape([-1, 4])
+        frames[bound_start:bound_start + chunk_frames.shape[0], ...] = chunk_frames
+        labs[key_idcs, :] = chunk_labs
+        return chunk_frames.shape[0]
+
+    @staticmethod
+    def _key_chunks(len_keys):
+        return [np.arange(chunk_start, min(chunk_start + READ_CHUNK_LEN, len_keys))
+                for chunk_start in range(0, len_keys, READ_CHUNK_LEN)]
+
     def process_pose(self, pose):
+        frames, plens = self.process_poses([pose])
+        return np.transpose(frames, (1, 0, 2)), np.int32(plens[0])
+
+    def process_poses(self, poses, max_len=None):
+        """Vectorized process_pose over a list of raw poses [njoints, channels, frames], all the
+        frames are processed at once, concatenated. Returns them frame major,
+        [nframes, njoints, channels], along with the length of each sequence (capped at max_len)."""
+        raw_lens = np.array([pose.shape[2] for pose in poses], dtype=np.int64)
+        raw_starts = np.cumsum(raw_lens) - raw_lens
+        frame_seqs = np.repeat(np.arange(len(poses)), raw_lens)
+        pose = np.concatenate(poses, axis=2)
+
         # Remove nans
         pose[np.isnan(pose)] = 0
 
-        # Trim zero frames
-        pose_nz = pose[:, :3, :] != 0
-        plen = np.int32(pose.shape[2])
-        for f in range(plen):
-            if np.any(pose_nz[:, :, f]):
-                pose = pose[:, :, f:]
-                pose_nz = pose_nz[:, :, f:]
-                break
-
-        plen = np.int32(pose.shape[2])
-        for f in range(plen-1, 0, -1):
-            if np.any(pose_nz[:, :, f]):
-                pose = pose[:, :, :f+1]
-                break
-
-        plen = np.int32(pose.shape[2])
+        # Trim zero frames, to the first and last non zero frames of each sequence
+        nz_frames = np.flatnonzero(np.any(pose[:, :3, :] != 0, axis=(0, 1)))
+        seq_starts = raw_starts.copy()
+        seq_ends = raw_starts + raw_lens
+        if nz_frames.size > 0:  # All zero sequences are kept untrimmed
+            nz_seqs, first_nz = np.unique(frame_seqs[nz_frames], return_index=True)
+            last_nz = nz_frames[np.append(first_nz[1:], len(nz_frames)) - 1]
+            first_nz = nz_frames[first_nz]
+            seq_starts[nz_seqs] = first_nz
+            # The end is only trimmed if there is a non zero frame past the first one
+            seq_ends[nz_seqs] = np.where(last_nz > first_nz, last_nz + 1, seq_ends[nz_seqs])
+        plens = seq_ends - seq_starts
+        if max_len is not None:
+            plens = np.minimum(plens, max_len)
+
+        frame_pos = np.arange(frame_seqs.shape[0]) - seq_starts[frame_seqs]
+        is_kept = (frame_pos >= 0) & (frame_pos < plens[frame_seqs])
+        pose = pose[:, :, is_kept]
+        frame_seqs = frame_seqs[is_kept]
+        first_frames = np.cumsum(plens) - plens
 
         # Format tracking state
         if pose.shape[1] > 3:
@@ -180,85 +523,93 @@ class DataInput(object):
             pose = np.concatenate([pose, np.ones((pose.shape[0], 1, pose.shape[2]))], axis=1)
 
         # Dataset specific processing
-        if self.data_set == 'NTURGBD':
-            pose = pose[:25, :, :]  # Warning: only taking first skeleton
-            pose[:, :3, :] -= pose[0, np.newaxis, :3, 0, np.newaxis]  # Recentering sequence by hip start position
-            pose[:, :3, :] = pose[:, :3, :] * 1.0e3  # Rescale to mm
-            pose_1 = pose[:, 1, :].copy()
-            pose[:, 1, :] = pose[:, 2, :]  # Swapping Y-Z coords
-            pose[:, 2, :] = pose_1
-        elif self.data_set == 'MSRC12':
-            pose[:, :3, :] -= pose[0, np.newaxis, :3, 0, np.newaxis]  # Recentering sequence by hip start position
-            pose[:, :3, :] = pose[:, :3, :] * 1.0e3  # Rescale to mm
-            pose_1 = pose[:, 1, :].copy()
-            pose[:, 1, :] = pose[:, 2, :]  # Swapping Y-Z coords
-            pose[:, 2, :] = pose_1
+        if self.data_set in ('NTURGBD', 'MSRC12'):
+            if self.data_set == 'NTURGBD':
+                pose = pose[:25, :, :]  # Warning: only taking first skeleton
+            # Recentering sequence by hip start position, rescale to mm and swapping Y-Z coords, at once
+            xzy = [0, 2, 1]
+            hips_start = pose[0, xzy, :][:, first_frames]
+            pose[:, :3, :] = (pose[:, xzy, :] - hips_start[:, frame_seqs]) * 1.0e3
         elif self.data_set == 'Human36':
             pose = pose[self.used_joints, ...]
             # pose[:, :3, :] = pose[:, :3, :] / 1.0e3 # Rescale to meters
             # pose = pose[:, :, range(0, plen, 2)]  # Subsampling to 25hz
             # pose = pose[:, :, range(0, plen, 10)]  # Subsampling to 5hz
-            plen = np.int32(pose.shape[2])
         elif self.data_set == 'Human36_expmaps':
             pose = pose[self.used_joints, ...]
             # pose = pose[:, :, range(0, plen, 2)]  # Subsampling to 25hz
             # pose = pose[:, :, range(0, plen, 10)]  # Subsampling to 5hz
-            plen = np.int32(pose.shape[2])
             # pose[:, :3, :] = (pose[:, :3, :] + 90) / 180
 
-        pose = np.transpose(pose, (0, 2, 1))
+        frames = np.ascontiguousarray(np.transpose(pose, (2, 0, 1)))
 
-        return pose, plen
+        return frames, plens
 
-    def sub_sample_pose(self, pose, plen):
+    def sub_sample_frames(self, plens, rng=np.random):
+        """Draws the crop starts and picks of a whole batch at once.
+        Returns the frame indices [batch, len] relative to each sequence start,
+        and a mask of the ones falling inside the sequence (the rest is padding)."""
+        batch_size = plens.shape[0]
+        plens = plens.astype(np.int64)
 
+        offsets = np.zeros([batch_size, 1], dtype=np.int64)
         if self.crop_len > 0:
-            if self.crop_len >= plen:
-                pose = pose[:, :self.crop_len, :]  # Warning, silent implicit 0-pad
-            elif self.crop_len < plen:
-                indx = np.random.randint(0, plen - self.crop_len)
-                pose = pose[:, indx:indx + self.crop_len, :]
-            plen = np.int32(self.crop_len)
+            is_cropped = self.crop_len < plens  # Warning, silent implicit pad if crop_len >= plen
+            crop_range = np.where(is_cropped, plens - self.crop_len, 0)
+            offsets[:, 0] = (rng.rand(batch_size) * crop_range).astype(np.int64)
+            seq_lens = np.full([batch_size], self.crop_len, dtype=np.int64)
+        else:
+            seq_lens = plens
 
         if self.pick_num > 0:
-            if self.pick_num >= plen:
-                pose = pose[:, :self.pick_num, :]  # Warning, silent implicit 0-pad
-            elif self.pick_num < plen:
-                subplen = plen / self.pick_num
-                picks = np.random.randint(0, subplen, size=(self.pick_num)) + \
-                        np.arange(0, plen, subplen, dtype=np.int32)
-                pose = pose[:, picks, :]
-            plen = np.int32(self.pick_num)
+            picks = np.tile(np.arange(self.pick_num, dtype=np.int64), (batch_size, 1))
+            is_picked = self.pick_num < seq_lens  # Warning, silent implicit pad if pick_num >= seq_len
+            # Integer spacing, as in the original per sequence picks: np.arange(0, plen, plen / pick_num,
+            # dtype=np.int32) steps by int(plen / pick_num), and randint truncates its float high bound
+            subplens = np.where(is_picked, seq_lens // self.pick_num, 1)[:, np.newaxis]
+            rand_picks = (rng.rand(batch_size, self.pick_num) * subplens).astype(np.int64)
+            picks = np.where(is_picked[:, np.newaxis], rand_picks + (picks * subplens), picks)
+        else:
+            # Without crop nor pick, sequences are padded up to max_plen
+            picks = np.tile(np.arange(self.crop_len if self.crop_len > 0 else self.max_plen,
+                                      dtype=np.int64), (batch_size, 1))
 
-        return pose, plen
+        frame_idcs = offsets + picks
+        is_valid = frame_idcs < plens[:, np.newaxis]
 
-    def sub_sample_batch(self, batch, is_training):
-        labs_batch, poses_batch = batch
+        return frame_idcs, is_valid
 
-        if self.pshape[1] is not None:
-            new_labs_batch = np.empty([self.batch_size, 4], dtype=np.int32)
-            new_poses_batch = np.empty([self.batch_size] + self.pshape, dtype=np.float32)
-            new_labs_batch[:, :3] = labs_batch[:, :3]
-            new_labs_batch[:, 3] = self.pshape[1]
-            for i in range(self.batch_size):
-                new_poses_batch[i, ...], _new_plen = self.sub_sample_pose(poses_batch[i, ...], labs_batch[i, 3])
+    def sub_sample_batch(self, batch, is_training, rng=np.random, frames=None):
+        labs_batch, starts_batch = batch
+        frames = self.frames[is_training] if frames is None else frames
+
+        frame_idcs, is_valid = self.sub_sample_frames(labs_batch[:, 3], rng)
+        seq_len = frame_idcs.shape[1]
 
-            labs_batch = new_labs_batch
-            poses_batch = new_poses_batch
+        # Single gather from the flat frames, padding frames are read from the start and overwritten
+        gather_idcs = starts_batch[:, np.newaxis] + np.where(is_valid, frame_idcs, 0)
+        poses_batch = np.empty([self.batch_size, self.pshape[0], seq_len, self.pshape[2]], dtype=np.float32)
+        poses_batch[...] = np.transpose(frames[gather_idcs.ravel(), ...].reshape(
+            [self.batch_size, seq_len, self.pshape[0], self.pshape[2]]), (0, 2, 1, 3))
+        np.transpose(poses_batch, (0, 2, 1, 3))[~is_valid] = self.pad_frame[:, 0, :]
+
+        if self.pshape[1] is not None:
+            labs_batch = labs_batch.copy()
+            labs_batch[:, 3] = self.pshape[1]
 
             if self.augment_data and is_training:
-                poses_batch = self.data_augmentation(poses_batch)
+                poses_batch = self.data_augmentation(poses_batch, rng)
 
         return labs_batch, poses_batch
 
-    def data_augmentation(self, poses):
+    def data_augmentation(self, poses, rng=np.random):
         def _jitter_height(poses):
-            jitter_tensor = np.random.uniform(0.7, 1.3, (self.batch_size, 1, 1, 1))
+            jitter_tensor = rng.uniform(0.7, 1.3, (self.batch_size, 1, 1, 1))
             poses[..., 2:] = poses[..., 2:] * jitter_tensor
             return poses
 
         def _swap_sides(poses):
-            if np.random.rand() > 0.5:
+            if rng.rand() > 0.5:
                 poses[..., :1] = poses[..., :1] * -1.0
                 for swap_tup in self.swap_list:
                     poses_tmp = poses[:, swap_tup[0], :, :].copy()
@@ -272,19 +623,197 @@ class DataInput(object):
 
     @threadsafe_generator
     def batch_generator(self, is_training):
-        epoch_size = self.train_epoch_size if is_training else self.val_epoch_size
-        batches = self.train_batches if is_training else self.val_batches
+        if self.data_streaming:
+            for batch in self._stream_batches(is_training):
+                yield batch
+
+        # Seeded from the global rng, so each generator has its own sequence of epochs
+        seed = np.random.randint(2 ** 31)
+        index = 0
+        while True:
+            yield self.sub_sample_batch(self.get_batch_samples(is_training, index, seed), is_training)
+            index += 1
+
+    def _stream_batches(self, is_training):
+        """Endless stream of batches, reading the sequences without loading the split. Each epoch
+        visits the chunks of contiguous keys in random order, and their sequences go to a shuffle
+        buffer of about stream_buffer_mb (and at least a batch of sequences), from which the batches
+        are drawn. The peak memory is that buffer plus a chunk, whatever the size of the data set."""
+        len_keys = self.len_train_keys if is_training else self.len_val_keys
+        key_chunks = self._key_chunks(len_keys)
+        is_shuffled = not self.only_val
+
+        frame_bytes = self.pshape[0] * self.pshape[2] * np.dtype(np.float32).itemsize
+        max_buffer_frames = int(self.stream_buffer_mb * (2 ** 20)) // frame_bytes
 
+        buffer_labs = []
+        buffer_seqs = []
+        buffer_frames = 0
         while True:
-            rand_indices = np.random.permutation(epoch_size)
-            for slice_idx in range(epoch_size):
-                if not self.only_val:
-                    yield self.sub_sample_batch(batches[rand_indices[slice_idx]], is_training)
-                else:
-                    yield self.sub_sample_batch(batches[slice_idx], is_training)
+            chunk_order = np.random.permutation(len(key_chunks)) if is_shuffled else range(len(key_chunks))
+            for c in chunk_order:
+                chunk_labs, chunk_frames = self._read_stream_chunk(key_chunks[c], is_training)
+                chunk_starts = np.cumsum(chunk_labs[:, 3]) - chunk_labs[:, 3]
+                for s in range(chunk_labs.shape[0]):
+                    buffer_labs.append(chunk_labs[s, :])
+                    buffer_seqs.append(chunk_frames[chunk_starts[s]:chunk_starts[s] + chunk_labs[s, 3], ...].copy())
+                buffer_frames += chunk_frames.shape[0]
+                del chunk_frames
+
+                # Without shuffling, sequences are batched as soon as possible, in reading order.
+                # A tiny buffer still holds a whole batch, whatever the stream_buffer_mb
+                while len(buffer_seqs) >= self.batch_size and (buffer_frames >= max_buffer_frames
+                                                               or not is_shuffled):
+                    if is_shuffled:
+                        labs_batch, seqs_batch = [], []
+                        # Each pick is swapped with the last sequence and popped. In descending order,
+                        # so that the pending picks are never the moved ones
+                        for s in sorted(np.random.choice(len(buffer_seqs), self.batch_size, replace=False),
+                                        reverse=True):
+                            buffer_labs[s], buffer_labs[-1] = buffer_labs[-1], buffer_labs[s]
+                            buffer_seqs[s], buffer_seqs[-1] = buffer_seqs[-1], buffer_seqs[s]
+                            labs_batch.append(buffer_labs.pop())
+                            seqs_batch.append(buffer_seqs.pop())
+                    else:
+                        labs_batch, seqs_batch = buffer_labs[:self.batch_size], buffer_seqs[:self.batch_size]
+                        del buffer_labs[:self.batch_size], buffer_seqs[:self.batch_size]
+                    labs_batch = np.stack(labs_batch)
+                    buffer_frames -= labs_batch[:, 3].sum()
+
+                    starts_batch = np.cumsum(labs_batch[:, 3]) - labs_batch[:, 3]
+                    yield self.sub_sample_batch((labs_batch, starts_batch), is_training,
+                                                frames=np.concatenate(seqs_batch, axis=0))
+
+    def _read_stream_chunk(self, key_idcs, is_training):
+        # Labels and normalized frames of a chunk of contiguous sequences
+        if self.data_cache:
+            labs = self.labs[is_training][key_idcs, :]
+            starts = self.starts[is_training]
+            frames = np.array(self.frames[is_training][starts[key_idcs[0]]:starts[key_idcs[-1]] + labs[-1, 3], ...])
+        else:
+            labs, frames = self.read_seqs_frames(key_idcs, is_training)
+            if self.normalize_data:
+                frames[..., :3] = self.normalize_frames(frames[..., :3])
+        return labs, frames
+
+    def get_batch(self, is_training, index, rng=np.random, seed=42):
+        """Random access version of batch_generator: returns the index-th batch of the stream.
+        The batches of each epoch only depend on the seed and the epoch number, so different
+        workers can prepare consecutive batches independently."""
+        assert not self.data_streaming, 'random access batches are not available when streaming'
+        return self.sub_sample_batch(self.get_batch_samples(is_training, index, seed), is_training, rng)
+
+    def tf_dataset(self, is_training, map_fn=None, start_index=0, prefetch_size=8):
+        """In graph version of the batch stream: the shuffling, the crop / pick sub sampling and the
+        augmentation are tf ops reading the flat frames of the split, which are fed only once, when
+        the iterator is initialized (see tf_feed_dict). Elements are (index, labels, poses) tuples,
+        index counting batches from start_index, passed through map_fn if given."""
+        assert not self.data_streaming, 'the tf.data pipeline needs the frames loaded (or memory mapped)'
+        labs = self.labs[is_training]
+        starts = self.starts[is_training]
+        frames = self.frames[is_training]
+        nseqs = labs.shape[0]
+
+        with tf.name_scope('data_input'):
+            frames_ph = tf.placeholder(tf.float32, frames.shape, name='frames')
+            self._frames_ph[is_training] = frames_ph
+            labs_t = tf.constant(labs)
+            starts_t = tf.constant(starts)
+            pad_frame = tf.constant(self.pad_frame[:, 0, :])
+
+            # Sequences are reshuffled each epoch, batches may span two epochs
+            seq_idcs = tf.data.Dataset.range(nseqs)
+            if is_training and not self.only_val:
+                seq_idcs = seq_idcs.shuffle(nseqs)
+            seq_idcs = seq_idcs.repeat().apply(tf.contrib.data.batch_and_drop_remainder(self.batch_size))
+            indices = tf.data.Dataset.range(start_index, np.iinfo(np.int64).max)
+
+            def _sample_batch(index, seq_idcs_batch):
+                labs_batch = tf.gather(labs_t, seq_idcs_batch)
+                frame_idcs, is_valid = self.tf_sub_sample_frames(labs_batch[:, 3])
+                seq_len = int(frame_idcs.shape[1])
+
+                # Same single gather as sub_sample_batch, padding frames are replaced afterwards
+                gather_idcs = (tf.gather(starts_t, seq_idcs_batch)[:, tf.newaxis] +
+                               tf.where(is_valid, frame_idcs, tf.zeros_like(frame_idcs)))
+                poses_batch = tf.gather(frames_ph, gather_idcs)
+                is_valid = tf.tile(is_valid[:, :, tf.newaxis, tf.newaxis], [1, 1, self.pshape[0], self.pshape[2]])
+                pad_batch = tf.tile(pad_frame[tf.newaxis, tf.newaxis, ...], [self.batch_size, seq_len, 1, 1])
+                poses_batch = tf.transpose(tf.where(is_valid, poses_batch, pad_batch), (0, 2, 1, 3))
+
+                if self.pshape[1] is not None:
+                    labs_batch = tf.concat([labs_batch[:, :3], tf.fill([self.batch_size, 1], np.int32(self.pshape[1]))], axis=1)
+
+                    if self.augment_data and is_training:
+                        poses_batch = self.tf_data_augmentation(poses_batch)
+
+                labs_batch.set_shape([self.batch_size, 4])
+                poses_batch.set_shape([self.batch_size, self.pshape[0], seq_len, self.pshape[2]])
+                return index, labs_batch, poses_batch
+
+            dataset = tf.data.Dataset.zip((indices, seq_idcs)).map(_sample_batch)
+            if map_fn is not None:
+                dataset = dataset.map(map_fn)
+            return dataset.prefetch(prefetch_size)
+
+    def tf_feed_dict(self, is_training):
+        """Feed dict to run along with the initializer of the tf_dataset iterators."""
+        return {self._frames_ph[is_training]: self.frames[is_training]}
+
+    def tf_sub_sample_frames(self, plens):
+        """In graph version of sub_sample_frames."""
+        plens = tf.cast(plens, tf.int64)
+
+        if self.crop_len > 0:
+            crop_range = tf.where(self.crop_len < plens, plens - self.crop_len, tf.zeros_like(plens))
+            offsets = tf.cast(tf.random_uniform([self.batch_size]) * tf.cast(crop_range, tf.float32), tf.int64)
+            offsets = offsets[:, tf.newaxis]
+            seq_lens = tf.fill([self.batch_size], np.int64(self.crop_len))
+        else:
+            offsets = tf.zeros([self.batch_size, 1], dtype=tf.int64)
+            seq_lens = plens
+
+        if self.pick_num > 0:
+            picks = tf.tile(tf.range(self.pick_num, dtype=tf.int64)[tf.newaxis, :], [self.batch_size, 1])
+            is_picked = self.pick_num < seq_lens
+            # Integer spacing, see sub_sample_frames
+            subplens = tf.where(is_picked, seq_lens // self.pick_num, tf.ones_like(seq_lens))[:, tf.newaxis]
+            rand_picks = tf.cast(tf.random_uniform([self.batch_size, self.pick_num]) *
+                                 tf.cast(subplens, tf.float32), tf.int64)
+            is_picked = tf.tile(is_picked[:, tf.newaxis], [1, self.pick_num])
+            picks = tf.where(is_picked, rand_picks + (picks * subplens), picks)
+        else:
+            seq_len = self.crop_len if self.crop_len > 0 else self.max_plen
+            picks = tf.tile(tf.range(seq_len, dtype=tf.int64)[tf.newaxis, :], [self.batch_size, 1])
+
+        frame_idcs = offsets + picks
+        is_valid = frame_idcs < plens[:, tf.newaxis]
+
+        return frame_idcs, is_valid
+
+    def tf_data_augmentation(self, poses):
+        """In graph version of data_augmentation."""
+        jitter_tensor = tf.random_uniform([self.batch_size, 1, 1, 1], 0.7, 1.3)
+        poses = tf.concat([poses[..., :2], poses[..., 2:] * jitter_tensor], axis=-1)
+
+        # The sequential swaps of data_augmentation, composed in a single permutation of the joints
+        swap_perm = np.arange(self.pshape[0])
+        for swap_tup in self.swap_list:
+            swap_perm_tmp = swap_perm[swap_tup[0]].copy()
+            swap_perm[swap_tup[0]] = swap_perm[swap_tup[1]]
+            swap_perm[swap_tup[1]] = swap_perm_tmp
+        flip_x = np.ones([self.pshape[2]], dtype=np.float32)
+        flip_x[0] = -1.0
+        swapped_poses = tf.gather(poses, swap_perm, axis=1) * flip_x
+
+        return tf.cond(tf.random_uniform([]) > 0.5, lambda: swapped_poses, lambda: poses)
 
     def normalize_poses(self, poses):
         return (poses - self.poses_mean) / (self.poses_std + 1e-8)
 
     def unnormalize_poses(self, poses):
         return (poses * (self.poses_std + 1e-8)) + self.poses_mean
+
+    def normalize_frames(self, frames):
+        # Same as normalize_poses, for frame major arrays [nframes, njoints, 3]
+        return (frames - self.poses_mean[:, :, 0, :]) / (self.poses_std[:, :, 0, :] + 1e-8)
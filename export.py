@@ -0,0 +1,125 @@
+from __future__ import absolute_import, division, print_function
+
+import time
+import numpy as np
+import tensorflow as tf
+import tensorflow.contrib.keras.api.keras.backend as K
+from tensorflow.tools.graph_transforms import TransformGraph
+from models.motiongan import get_model
+from predictor import MotionPredictor, load_config, load_pose_stats
+from frozen_predictor import FrozenPredictor, OUTPUT_NAME
+from utils.restore_keras_model import restore_keras_model
+from utils.seq_utils import gen_mask
+
+flags = tf.flags
+flags.DEFINE_string("model_path", None, "Trained model save path")
+flags.DEFINE_string("export_format", "graph_def", "Export formats: graph_def, saved_model")
+flags.DEFINE_integer("batch_size", 0, "Batch size of the exported graph (0 == any batch size)")
+flags.DEFINE_bool("benchmark", False, "Compares the latency of the export against gen_model.predict")
+flags.DEFINE_string("benchmark_batch_sizes", "1,16,128", "Comma separated batch sizes to benchmark")
+flags.DEFINE_integer("benchmark_runs", 50, "Timed runs per batch size")
+FLAGS = flags.FLAGS
+
+# Graph transforms of the frozen graph, the Identity nodes include the Keras input and weight reads
+OPTIMIZE_TRANSFORMS = ['strip_unused_nodes',
+                       'remove_nodes(op=Identity, op=CheckNumerics)',
+                       'fold_constants(ignore_errors=true)',
+                       'fold_batch_norms',
+                       'fold_old_batch_norms',
+                       'sort_by_execution_order']
+
+
+def build_export_graph(config, poses_mean=None, poses_std=None):
+    """Builds the generator, with the normalization of its inputs and outputs, in the default
+    graph and Keras session. Returns the input placeholders dict and the output tensor."""
+    K.set_learning_phase(0)  # The training only branches are not built
+    seq_len = config.pick_num if config.pick_num > 0 else (
+              config.crop_len if config.crop_len > 0 else None)
+    base_shape = (config.batch_size, config.njoints, seq_len)
+
+    inputs = {'poses': tf.placeholder(tf.float32, base_shape + (3,), name='poses'),
+              'mask': tf.placeholder(tf.float32, base_shape + (1,), name='mask')}
+    real_seq = inputs['poses']
+    if config.normalize_data:
+        real_seq = (real_seq - poses_mean) / (poses_std + 1e-8)
+    input_tensors = {'real_seq': real_seq, 'seq_mask': inputs['mask']}
+    if config.action_cond:
+        inputs['labels'] = tf.placeholder(tf.int32, (config.batch_size, 1), name='labels')
+        input_tensors['true_label'] = inputs['labels']
+    if config.latent_cond_dim > 0:
+        inputs['latent'] = tf.placeholder(tf.float32, (config.batch_size, config.latent_cond_dim), name='latent')
+        input_tensors['latent_cond'] = inputs['latent']
+
+    model_wrap = get_model(config, input_tensors, gen_only=True)
+    restore_keras_model(model_wrap.gen_model, config.save_path + '_gen_weights.hdf5', False, False)
+
+    gen_poses = model_wrap.gen_model.outputs[0]
+    if config.normalize_data:
+        gen_poses = (gen_poses * (poses_std + 1e-8)) + poses_mean
+    return inputs, tf.identity(gen_poses, name=OUTPUT_NAME)
+
+
+def freeze_graph(sess, inputs, output):
+    """Frozen and optimized GraphDef computing output from inputs, the weights are constants"""
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        sess, sess.graph.as_graph_def(), [output.op.name])
+    return TransformGraph(graph_def, [x.op.name for x in inputs.values()], [output.op.name], OPTIMIZE_TRANSFORMS)
+
+
+def write_saved_model(graph_def, export_dir, input_names):
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+        with tf.Session(graph=graph) as sess:
+            signature = tf.saved_model.signature_def_utils.predict_signature_def(
+                dict([(name, graph.get_tensor_by_name(name + ':0')) for name in input_names]),
+                {OUTPUT_NAME: graph.get_tensor_by_name(OUTPUT_NAME + ':0')})
+            builder = tf.saved_model.builder.SavedModelBuilder(export_dir)
+            builder.add_meta_graph_and_variables(
+                sess, [tf.saved_model.tag_constants.SERVING],
+                signature_def_map={tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY: signature})
+            builder.save()
+
+
+def benchmark(predictors, config, batch_sizes, runs, warmup=3):
+    """Prints the predict latency of each (name, predictor) pair, on random inputs"""
+    for batch_size in batch_sizes:
+        poses = np.random.normal(size=(batch_size, predictors[0][1].njoints, predictors[0][1].seq_len, 3))
+        mask = gen_mask(1, 0.5, batch_size, config.njoints, poses.shape[2], config.body_members)
+        labels = np.random.randint(config.num_actions, size=(batch_size, 1))
+        for name, predictor in predictors:
+            if predictor.batch_size is not None and predictor.batch_size != batch_size:
+                continue
+            times = []
+            for r in range(warmup + runs):
+                start = time.time()
+                predictor.predict(poses, mask, labels)
+                if r >= warmup:
+                    times.append((time.time() - start) * 1000)
+            print('%s, batch size %d: mean %.2f ms, p50 %.2f ms, p99 %.2f ms, %.3f ms/sample' %
+                  (name, batch_size, np.mean(times), np.percentile(times, 50),
+                   np.percentile(times, 99), np.mean(times) / batch_size))
+
+
+if __name__ == "__main__":
+    assert FLAGS.export_format in ('graph_def', 'saved_model'), 'unknown export format'
+    config = load_config(FLAGS.model_path, FLAGS.batch_size if FLAGS.batch_size > 0 else None)
+    poses_mean, poses_std = load_pose_stats(config) if config.normalize_data else (None, None)
+
+    inputs, output = build_export_graph(config, poses_mean, poses_std)
+    graph_def = freeze_graph(K.get_session(), inputs, output)
+
+    if FLAGS.export_format == 'graph_def':
+        export_path = config.save_path + '_gen_frozen.pb'
+        with tf.gfile.GFile(export_path, 'wb') as f:
+            f.write(graph_def.SerializeToString())
+    else:
+        export_path = config.save_path + '_gen_saved_model'
+        write_saved_model(graph_def, export_path, inputs.keys())
+    print('Exported %d nodes to %s' % (len(graph_def.node), export_path))
+
+    if FLAGS.benchmark:
+        K.clear_session()
+        frozen_predictor = FrozenPredictor(export_path)
+        keras_predictor = MotionPredictor(FLAGS.model_path, config.batch_size, poses_mean, poses_std)
+        benchmark([('gen_model.predict', keras_predictor), ('frozen', frozen_predictor)], config,
+                  [int(b) for b in FLAGS.benchmark_batch_sizes.split(',')], FLAGS.benchmark_runs)
@@ -0,0 +1,67 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import tensorflow as tf
+from utils.seq_utils import gen_latent_noise
+
+# Tensor names of the exported generator graph, see export.py
+INPUT_NAMES = ('poses', 'mask', 'labels', 'latent')
+OUTPUT_NAME = 'gen_poses'
+
+
+class FrozenPredictor(object):
+    """Runs a generator exported by export.py, a frozen GraphDef (.pb) or a SavedModel directory,
+    in its own graph and session, without building any Keras model.
+
+    The normalization is part of the graph, predict takes and returns unnormalized poses,
+    same as MotionPredictor.predict."""
+
+    def __init__(self, export_path, session_config=None):
+        self.graph = tf.Graph()
+        self.sess = tf.Session(graph=self.graph, config=session_config)
+        with self.graph.as_default():
+            if tf.gfile.IsDirectory(export_path):
+                tf.saved_model.loader.load(self.sess, [tf.saved_model.tag_constants.SERVING], export_path)
+            else:
+                graph_def = tf.GraphDef()
+                with tf.gfile.GFile(export_path, 'rb') as f:
+                    graph_def.ParseFromString(f.read())
+                tf.import_graph_def(graph_def, name='')
+
+        self.inputs = {}
+        for name in INPUT_NAMES:
+            try:
+                self.inputs[name] = self.graph.get_tensor_by_name(name + ':0')
+            except KeyError:
+                pass  # Not an input of this model
+        self.output = self.graph.get_tensor_by_name(OUTPUT_NAME + ':0')
+        self.graph.finalize()
+
+        poses_shape = self.inputs['poses'].shape.as_list()
+        self.batch_size = poses_shape[0]
+        self.njoints = poses_shape[1]
+        self.seq_len = poses_shape[2]
+        self.action_cond = 'labels' in self.inputs
+        # Number of rows of the label embedding, None if it can not be found
+        emb_ops = [op for op in self.graph.get_operations() if op.name.endswith('emb_label/embeddings')]
+        self.num_actions = emb_ops[0].outputs[0].shape.as_list()[0] if emb_ops else None
+        self.latent_cond_dim = self.inputs['latent'].shape.as_list()[-1] if 'latent' in self.inputs else 0
+
+    def predict(self, poses, mask, labels=None, latent=None):
+        """Returns the generated poses [batch, njoints, seq_len, 3], from the poses
+        [batch, njoints, seq_len, 3], mask [batch, njoints, seq_len(, 1)], labels [batch(, 1)]
+        and latent [batch, latent_cond_dim]"""
+        poses = np.asarray(poses, dtype=np.float32)
+        batch_size = poses.shape[0]
+        feed_dict = {self.inputs['poses']: poses,
+                     self.inputs['mask']: np.reshape(np.asarray(mask, dtype=np.float32), poses.shape[:3] + (1,))}
+        if self.action_cond:
+            assert labels is not None, 'the model is conditioned on the action labels'
+            feed_dict[self.inputs['labels']] = np.reshape(labels, (batch_size, 1)).astype(np.int32)
+        if self.latent_cond_dim > 0:
+            latent = gen_latent_noise(batch_size, self.latent_cond_dim) if latent is None else latent
+            feed_dict[self.inputs['latent']] = np.reshape(latent, (batch_size, self.latent_cond_dim)).astype(np.float32)
+        return self.sess.run(self.output, feed_dict)
+
+    def close(self):
+        self.sess.close()
@@ -47,7 +47,7 @@ class _CausalConv(Layer):
         pad_shape = [size for size in self.kernel_size]
         pad_shape[self.causal_dim] = self.kernel_size[self.causal_dim] - kernel_shape[self.causal_dim]
         pad_shape += [self.input_dim, self.filters]
-        kernel_pad = constant(np.zeros(pad_shape), dtype='float32')
+        kernel_pad = constant(np.zeros(pad_shape), dtype=kernel.dtype)
         self.kernel = concatenate([kernel, kernel_pad], axis=self.causal_dim)
         self.bias = self.add_weight(name='bias',
                                     shape=(self.filters,),
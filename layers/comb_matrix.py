@@ -24,9 +24,10 @@ class CombMatrix(Layer):
     def call(self, x, **kwargs):
         perm_dims = range(len(self.shape))
         perm_dims[self.joints_dim], perm_dims[-1] = perm_dims[-1], perm_dims[self.joints_dim]
-        perm_shape = [int(self.shape[i]) for i in perm_dims]
+        # The batch dimension may be unknown
+        perm_shape = [-1] + [int(self.shape[i]) for i in perm_dims[1:]]
         x = permute_dimensions(x, perm_dims)
-        x = reshape(x, [np.prod(perm_shape[:-1]), perm_shape[-1]])
+        x = reshape(x, [-1, perm_shape[-1]])
         x = dot(x, self.comb_matrix)
         x = reshape(x, perm_shape)
         x = permute_dimensions(x, perm_dims)
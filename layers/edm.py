@@ -5,10 +5,12 @@ import tensorflow.contrib.keras.api.keras.backend as K
 
 def edm(x, y=None):
     with K.name_scope('edm'):
+        # Computed in float32, the sqrt of small float16 distances is not accurate
+        dtype = x.dtype
         y = x if y is None else y
-        x = K.expand_dims(x, axis=1)
-        y = K.expand_dims(y, axis=2)
-        return K.sqrt(K.sum(K.square(x - y), axis=-1) + K.epsilon())
+        x = K.expand_dims(K.cast(x, 'float32'), axis=1)
+        y = K.expand_dims(K.cast(y, 'float32'), axis=2)
+        return K.cast(K.sqrt(K.sum(K.square(x - y), axis=-1) + K.epsilon()), dtype)
 
 
 def edm_loss(y_true, y_pred):
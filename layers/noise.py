@@ -24,7 +24,8 @@ class GaussianMultNoise(Layer):
 
     def call(self, inputs, training=None):
         def noised():
-            return inputs + (inputs * K.random_normal(shape=K.shape(inputs), mean=0., stddev=self.stddev))
+            return inputs + (inputs * K.random_normal(shape=K.shape(inputs), mean=0., stddev=self.stddev,
+                                                      dtype=inputs.dtype))
 
         return K.in_train_phase(noised, inputs, training=training)
 
@@ -58,7 +59,8 @@ class NoiseInjection(Layer):
         self.noise_w = self.add_weight(shape=(1, 1, 1, channels), name='noise_w', initializer='glorot_uniform')
 
     def call(self, inputs, seed=None):
-        return inputs + (self.noise_w * K.random_normal(shape=K.shape(inputs), mean=0., stddev=self.stddev, seed=seed))
+        return inputs + (self.noise_w * K.random_normal(shape=K.shape(inputs), mean=0., stddev=self.stddev,
+                                                        dtype=inputs.dtype, seed=seed))
 
     def get_config(self):
         config = {'stddev': self.stddev}
@@ -112,9 +112,11 @@ class InstanceNormalization(Layer):
 
         del reduction_axes[0]
 
-        mean = K.mean(inputs, reduction_axes, keepdims=True)
-        stddev = K.std(inputs, reduction_axes, keepdims=True) + self.epsilon
-        normed = (inputs - mean) / stddev
+        # The moments are computed in float32, also for float16 inputs
+        inputs_f32 = K.cast(inputs, 'float32')
+        mean = K.mean(inputs_f32, reduction_axes, keepdims=True)
+        stddev = K.std(inputs_f32, reduction_axes, keepdims=True) + self.epsilon
+        normed = K.cast((inputs_f32 - mean) / stddev, inputs.dtype)
 
         broadcast_shape = [1] * len(input_shape)
         if self.axis is not None:
@@ -160,9 +160,7 @@ class RelationalMemoryCell(Layer):
             return 0
 
     def call(self, inputs, memory, training=None):
-        batch_size = int(inputs.shape[0])
-
-        memory = K.reshape(memory, (batch_size, self.mem_slots, self.mem_size))
+        memory = K.reshape(memory, (-1, self.mem_slots, self.mem_size))
         inputs = self._linear(inputs, self.kernel_in, self.bias_in)
         inputs_reshape = K.expand_dims(inputs, axis=1)
 
@@ -207,15 +205,13 @@ class RelationalMemoryCell(Layer):
               new_memory: New memory tensor.
             """
 
-        batch_size = int(memory.shape[0])
-
         qkv = self._linear(memory, self.kernel_qkv, self.bias_qkv)
         # qkv = self._layer_norm(qkv, self.offset_qkv, self.scale_qkv)
 
         mem_slots = memory.get_shape().as_list()[1]  # Denoted as N.
 
         # [B, N, F] -> [B, N, H, F/H]
-        qkv_reshape = K.reshape(qkv, (batch_size, mem_slots, self.num_heads, self.qkv_size))
+        qkv_reshape = K.reshape(qkv, (-1, mem_slots, self.num_heads, self.qkv_size))
 
         # [B, N, H, F/H] -> [B, H, N, F/H]
         qkv_transpose = K.permute_dimensions(qkv_reshape, [0, 2, 1, 3])
@@ -231,7 +227,7 @@ class RelationalMemoryCell(Layer):
         output_transpose = K.permute_dimensions(output, [0, 2, 1, 3])
 
         # [B, N, H, V] -> [B, N, H * V]
-        new_memory = K.reshape(output_transpose, (batch_size, mem_slots, self.mem_size))
+        new_memory = K.reshape(output_transpose, (-1, mem_slots, self.mem_size))
 
         return new_memory
 
@@ -269,23 +265,23 @@ class RelationalMemoryCell(Layer):
     def _layer_norm(self, x, offset, scale):
         in_shape = x.shape
         if len(in_shape) > 2:
-            x_shape = [int(dim) for dim in x.shape]
-            x = K.reshape(x, (x_shape[0] * x_shape[1], x_shape[2]))
+            x_shape = K.int_shape(x)
+            x = K.reshape(x, (-1, x_shape[2]))
         mean, var = tf.nn.moments(x, [1], keep_dims=True)
         x = tf.nn.batch_normalization(x, mean, var, offset, scale, K.epsilon())
         if len(in_shape) > 2:
-            x = K.reshape(x, x_shape)
+            x = K.reshape(x, (-1,) + x_shape[1:])
         return x
 
     def _linear(self, x, kernel, bias):
         in_shape = x.shape
         if len(in_shape) > 2:
-            x_shape = [int(dim) for dim in x.shape]
-            x = K.reshape(x, (x_shape[0] * x_shape[1], x_shape[2]))
+            x_shape = K.int_shape(x)
+            x = K.reshape(x, (-1, x_shape[2]))
         x = K.dot(x, kernel)
         x = K.bias_add(x, bias)
         if len(in_shape) > 2:
-            x = K.reshape(x, (x_shape[0], x_shape[1], int(kernel.shape[1])))
+            x = K.reshape(x, (-1, x_shape[1], int(kernel.shape[1])))
         return x
 
 
@@ -333,20 +329,21 @@ class RelationalMemoryRNN(RNN):
             inputs, mask=mask, training=training, initial_state=initial_state)
 
     def get_initial_state(self, inputs):
-        batch_size = int(inputs.shape[0])
+        # The batch size may only be known at run time
+        batch_size = tf.shape(inputs)[0]
         mem_size = self.num_heads * self.head_size
-        initial_state = tf.eye(self.mem_slots, batch_shape=[batch_size])
+        initial_state = tf.tile(tf.eye(self.mem_slots, dtype=inputs.dtype)[tf.newaxis, ...], [batch_size, 1, 1])
 
         # Pad the matrix with zeros.
         if mem_size > self.mem_slots:
             difference = mem_size - self.mem_slots
-            pad = tf.zeros((batch_size, self.mem_slots, difference))
+            pad = tf.zeros((batch_size, self.mem_slots, difference), dtype=inputs.dtype)
             initial_state = tf.concat([initial_state, pad], -1)
         # Truncation. Take the first `self._mem_size` components.
         elif mem_size < self.mem_slots:
             initial_state = initial_state[:, :, :mem_size]
 
-        initial_state = tf.reshape(initial_state, (batch_size, self.units))
+        initial_state = tf.reshape(initial_state, (-1, self.units))
         return [initial_state]
 
     @property
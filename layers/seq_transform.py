@@ -21,7 +21,7 @@ def remove_hip_in(x, x_mask, data_set):
             x_mask = Lambda(lambda arg: arg[:, 2:, ...], name=scope+'remove_hip_mask_in')(x_mask)
         else:
             def _get_hips(arg):
-                return K.reshape(arg[:, 0, :, :], (arg.shape[0], 1, arg.shape[2], 3))
+                return arg[:, :1, :, :]
 
             hip_info = Lambda(_get_hips, name=scope+'hip_coords')(x)
 
@@ -47,7 +47,7 @@ def translate_start_in(x):
     scope = Scoping.get_global_scope()
     with scope.name_scope('translate_start'):
         def _get_start(arg):
-            return K.reshape(arg[:, 0, 0, :], (arg.shape[0], 1, 1, 3))
+            return arg[:, :1, :1, :]
 
         start_coords = Lambda(_get_start, name=scope+'start_coords')(x)
 
@@ -70,15 +70,12 @@ def rotate_start_in(x, body_members):
         hip = body_members['torso']['joints'][0]
         head_top = body_members['head']['joints'][-1]
 
-        base_shape = [int(d) for d in x.shape]
-        base_shape[1] = 1
-        base_shape[2] = 1
-
         def _get_rotation(arg):
             coords_list = tf.unstack(arg[:, :, 0, :], axis=1)
             torso_rot = tf.cross(coords_list[left_shoulder] - coords_list[hip],
                                  coords_list[right_shoulder] - coords_list[hip])
-            side_rot = K.reshape(tf.cross(coords_list[head_top] - coords_list[hip], torso_rot), base_shape)
+            side_rot = tf.cross(coords_list[head_top] - coords_list[hip], torso_rot)
+            side_rot = K.expand_dims(K.expand_dims(side_rot, axis=1), axis=1)
             theta_diff = ((np.pi / 2) - tf.atan2(side_rot[..., 1], side_rot[..., 0])) / 2
             cos_theta_diff = tf.cos(theta_diff)
             sin_theta_diff = tf.sin(theta_diff)
@@ -159,7 +156,7 @@ def seq_to_angles_in(x, x_mask, body_members):
         members_from, members_to, body_graph = get_body_graph(body_members)
 
         def _get_hips(arg):
-            return K.reshape(arg[:, 0, :, :], (arg.shape[0], 1, arg.shape[2], 3))
+            return arg[:, :1, :, :]
 
         hip_coords = Lambda(_get_hips, name=scope+'hip_coords')(x)
 
@@ -172,17 +169,13 @@ def seq_to_angles_in(x, x_mask, body_members):
         bone_len = Lambda(_get_bone_len, name=scope+'bone_len')(x)
 
         def _get_angles(coords):
-            base_shape = [int(dim) for dim in coords.shape]
-            base_shape.pop(1)
-            base_shape[-1] = 1
-
             coords_list = tf.unstack(coords, axis=1)
+            base_ones = K.ones_like(coords_list[0][..., :1])
+            base_zeros = K.zeros_like(base_ones)
 
             def _get_angle_for_joint(joint_idx, parent_idx, angles):
                 if parent_idx is None:  # joint_idx should be 0
-                    parent_bone = K.constant(np.concatenate([np.ones(base_shape),
-                                                             np.zeros(base_shape),
-                                                             np.zeros(base_shape)], axis=-1))
+                    parent_bone = K.concatenate([base_ones, base_zeros, base_zeros], axis=-1)
                 else:
                     parent_bone = coords_list[parent_idx] - coords_list[joint_idx]
 
@@ -203,10 +196,6 @@ def seq_to_angles_in(x, x_mask, body_members):
         x = Lambda(_get_angles, name=scope+'angles')(x)
 
         def _get_angles_mask(coord_masks):
-            base_shape = [int(dim) for dim in coord_masks.shape]
-            base_shape.pop(1)
-            base_shape[-1] = 1
-
             coord_masks_list = tf.unstack(coord_masks, axis=1)
 
             def _get_angle_mask_for_joint(joint_idx, angles_mask):
@@ -248,18 +237,14 @@ def seq_to_angles_out(x, body_members, hip_coords, bone_len, fixed_angles):
             rotmat_list = tf.unstack(rotmat, axis=1)
             bone_len_list = tf.unstack(bone_len, axis=1)
 
-            base_shape = [int(d) for d in rotmat.shape]
-            base_shape.pop(1)
-            base_shape[-2] = 1
-            base_shape[-1] = 1
+            base_zeros = K.zeros_like(rotmat_list[0][..., :1, :1])
+            base_ones = K.ones_like(base_zeros)
             bone_idcs = {idx_tup: i for i, idx_tup in enumerate([idx_tup for idx_tup in zip(members_from, members_to)])}
 
             def _get_coords_for_joint(joint_idx, parent_idx, child_angle_idx, coords):
                 if parent_idx is None:  # joint_idx should be 0
-                    coords[joint_idx] = K.zeros(base_shape[:-2] + [3, 1])
-                    parent_bone = K.constant(np.concatenate([np.ones(base_shape),
-                                                             np.zeros(base_shape),
-                                                             np.zeros(base_shape)], axis=-2))
+                    coords[joint_idx] = K.concatenate([base_zeros, base_zeros, base_zeros], axis=-2)
+                    parent_bone = K.concatenate([base_ones, base_zeros, base_zeros], axis=-2)
                 else:
                     parent_bone = coords[parent_idx] - coords[joint_idx]
                     parent_bone_norm = K.sqrt(K.sum(K.square(parent_bone), axis=-2, keepdims=True) + K.epsilon())
@@ -268,7 +253,7 @@ def seq_to_angles_out(x, body_members, hip_coords, bone_len, fixed_angles):
                 for child_idx in body_graph[joint_idx]:
                     child_bone = tf.matmul(rotmat_list[child_angle_idx], parent_bone)
                     child_bone_idx = bone_idcs[(joint_idx, child_idx)]
-                    child_bone = child_bone * K.reshape(bone_len_list[child_bone_idx], (child_bone.shape[0], 1, 1, 1))
+                    child_bone = child_bone * K.reshape(bone_len_list[child_bone_idx], (-1, 1, 1, 1))
                     coords[child_idx] = child_bone + coords[joint_idx]
                     child_angle_idx += 1
 
@@ -1,5 +1,4 @@
 from __future__ import absolute_import, division, print_function
-import numpy as np
 import tensorflow.contrib.keras.api.keras.backend as K
 from tensorflow.contrib.keras.api.keras.models import Model
 from tensorflow.contrib.keras.api.keras.layers import Input
@@ -80,18 +79,16 @@ def _conv_block(x, out_filters, bneck_filters, groups, kernel_size, strides):
 
 def _jitter_height(poses):
     with K.name_scope('jitter_height'):
-        select_mask = np.zeros(poses.shape)
-        select_mask[..., 2] = 1.0
-        select_mask = K.constant(select_mask, dtype='float32')
-        jitter_z = poses * K.random_uniform([int(poses.shape[0]), 1, 1, 1], minval=0.7, maxval=1.3)
+        select_mask = K.constant([0.0, 0.0, 1.0], dtype='float32')
+        jitter_z = poses * K.random_uniform(K.stack([K.shape(poses)[0], 1, 1, 1]), minval=0.7, maxval=1.3)
         new_poses = (poses * (1 - select_mask)) + (jitter_z * select_mask)
         return new_poses
 
 
 def _sim_occlusions(poses):
     with K.name_scope('sim_occlusions'):
-        jitter_coords = poses * K.random_uniform(poses.shape, minval=0.8, maxval=1.2)
-        select_mask = K.random_binomial([int(poses.shape[0]), 1, 1, 1], 0.5)
+        jitter_coords = poses * K.random_uniform(K.shape(poses), minval=0.8, maxval=1.2)
+        select_mask = K.random_binomial(K.stack([K.shape(poses)[0], 1, 1, 1]), 0.5)
         new_poses = (poses * (1 - select_mask)) + (jitter_coords * select_mask)
         return new_poses
 
@@ -23,17 +23,19 @@ from layers.normalization import InstanceNormalization
 from layers.noise import NoiseInjection
 from layers.cudnn_recurrent import CuDNNLSTM
 from collections import OrderedDict
+from contextlib import contextmanager
 from utils.scoping import Scoping
+from utils.mixed_precision import mixed_precision_scope, DynamicLossScale
 
 CONV1D_ARGS = {'padding': 'same', 'kernel_regularizer': l2(5e-4)}
 CONV2D_ARGS = {'padding': 'same', 'data_format': 'channels_last', 'kernel_regularizer': l2(5e-4)}
 
 
-def get_model(config):
+def get_model(config, input_tensors=None, input_fn=None, gen_only=False):
     class_name = 'MotionGANV' + config.model_version[1:]
     module = __import__('models.motiongan', fromlist=[class_name])
     my_class = getattr(module, class_name)
-    return my_class(config)
+    return my_class(config, input_tensors, input_fn, gen_only)
 
 
 def _get_tensor(tensors, name):
@@ -43,8 +45,102 @@ def _get_tensor(tensors, name):
         return tensors
 
 
+def _nadam_updates(optimizer, grads, params, is_finite=None):
+    """Nadam.get_updates, on precomputed gradients. Variables can not be created in graph loops, so
+    the moments are created on the first call, which must be outside them, and the optimizer state
+    is read explicitly. If is_finite (a scalar bool tensor) is given, the update is skipped when false."""
+    if len(optimizer.weights) == 0:
+        ms = [K.zeros(K.int_shape(p)) for p in params]
+        vs = [K.zeros(K.int_shape(p)) for p in params]
+        optimizer.weights = [optimizer.iterations] + ms + vs
+    ms = optimizer.weights[1:len(params) + 1]
+    vs = optimizer.weights[len(params) + 1:]
+    iterations = optimizer.iterations.read_value()
+    m_schedule = optimizer.m_schedule.read_value()
+    lr = optimizer.lr.read_value()
+    beta_1 = optimizer.beta_1.read_value()
+    beta_2 = optimizer.beta_2.read_value()
+
+    t = K.cast(iterations, K.floatx()) + 1
+    momentum_cache_t = beta_1 * (1. - 0.5 * (K.pow(K.cast_to_floatx(0.96), t * optimizer.schedule_decay)))
+    momentum_cache_t_1 = beta_1 * (1. - 0.5 * (K.pow(K.cast_to_floatx(0.96), (t + 1) * optimizer.schedule_decay)))
+    m_schedule_new = m_schedule * momentum_cache_t
+    m_schedule_next = m_schedule * momentum_cache_t * momentum_cache_t_1
+
+    new_values = [(optimizer.iterations, iterations, iterations + 1),
+                  (optimizer.m_schedule, m_schedule, m_schedule_new)]
+    for p, g, m, v in zip(params, grads, ms, vs):
+        p_old, m_old, v_old = p.read_value(), m.read_value(), v.read_value()
+        g_prime = g / (1. - m_schedule_new)
+        m_t = beta_1 * m_old + (1. - beta_1) * g
+        m_t_prime = m_t / (1. - m_schedule_next)
+        v_t = beta_2 * v_old + (1. - beta_2) * K.square(g)
+        v_t_prime = v_t / (1. - K.pow(beta_2, t))
+        m_t_bar = (1. - momentum_cache_t) * g_prime + momentum_cache_t_1 * m_t_prime
+        p_t = p_old - lr * m_t_bar / (K.sqrt(v_t_prime) + optimizer.epsilon)
+        if getattr(p, 'constraint', None) is not None:
+            p_t = p.constraint(p_t)
+        new_values += [(m, m_old, m_t), (v, v_old, v_t), (p, p_old, p_t)]
+
+    if is_finite is not None:
+        new_values = [(var, old, K.switch(is_finite, new, old)) for var, old, new in new_values]
+
+    # All the new values are computed before assigning any of them
+    with tf.control_dependencies([new for _, _, new in new_values]):
+        return [tf.assign(var, new) for var, _, new in new_values]
+
+
+def _get_updates(optimizer, grads, params, loss_scale=None):
+    # With loss scaling, the scale is adjusted and the updates skipped when the gradients overflow
+    if loss_scale is None:
+        return _nadam_updates(optimizer, grads, params)
+    is_finite = loss_scale.is_finite(grads)
+    return loss_scale.get_updates(is_finite) + _nadam_updates(optimizer, grads, params, is_finite)
+
+
+@contextmanager
+def _weight_reads_scope(weights):
+    """Layers convert their weights with Variable.value(), a snapshot taken once per session run, so
+    the steps of a graph loop would all compute with the weights of the start of the run. In this
+    scope, the weights convert to reads created on entry, in the current loop and control dependencies."""
+    reads = dict([(id(weight), weight.read_value()) for weight in weights])
+    variable_value = tf.Variable.value
+
+    def value(self):
+        return reads[id(self)] if id(self) in reads else variable_value(self)
+
+    tf.Variable.value = value
+    try:
+        yield
+    finally:
+        tf.Variable.value = variable_value
+
+
+def _weight_reg_losses(model):
+    """Builds the regularization losses of the weights of model again, e.g. on the reads of a
+    _weight_reads_scope. Keras layers keep the regularizer of their weight <name> in <name>_regularizer."""
+    reg_losses = []
+    for layer in model.layers:
+        if isinstance(layer, Model):
+            reg_losses += _weight_reg_losses(layer)
+            continue
+        for attr, regularizer in sorted(vars(layer).items()):
+            if attr.endswith('_regularizer') and regularizer is not None:
+                weight = getattr(layer, attr[:-len('_regularizer')], None)
+                if weight is not None:
+                    reg_losses.append(regularizer(weight))
+    return reg_losses
+
+
 class _MotionGAN(object):
-    def __init__(self, config):
+    def __init__(self, config, input_tensors=None, input_fn=None, gen_only=False):
+        """input_tensors: optional dict of tensors, e.g. from a tf.data iterator, to build the model
+        on instead of placeholders, keyed by input name (real_seq, seq_mask, true_label, latent_cond).
+        The train functions then take no inputs, the eval functions are still fed.
+        input_fn: callable returning a new dict of input tensors, e.g. the iterator get_next, required
+        by the in graph training loop (config.steps_per_run > 1).
+        gen_only: only builds gen_model, for inference. There is no discriminator, losses nor
+        train functions."""
         self.name = config.model_type + '_' + config.model_version
         self.data_set = config.data_set
         self.batch_size = config.batch_size
@@ -91,30 +187,55 @@ class _MotionGAN(object):
         self.stats = {}
         self.z_params = []
 
-        # Discriminator
-        real_seq = Input(batch_shape=(self.batch_size, self.njoints, self.seq_len, 3), name='real_seq', dtype='float32')
+        input_tensors = {} if input_tensors is None else input_tensors
+        self.feed_inputs = len(input_tensors) == 0
+
+        # Set while building the in graph training loop, see _reg_losses
+        self._rebuild_reg_losses = False
+
+        # Mixed precision: the networks compute in float16, with float32 weights and losses
+        self.mixed_precision = config.mixed_precision
+        self.disc_loss_scale = DynamicLossScale(name='disc_loss_scale') if self.mixed_precision else None
+        self.gen_loss_scale = DynamicLossScale(name='gen_loss_scale') if self.mixed_precision else None
+
+        def _input(batch_shape, name, dtype):
+            tensor = input_tensors.get(name, None)
+            if tensor is not None:
+                tensor = tf.identity(tensor, name=name)  # Inputs are looked up by name
+            return Input(batch_shape=batch_shape, name=name, dtype=dtype, tensor=tensor)
+
+        # Inputs
+        real_seq = _input((self.batch_size, self.njoints, self.seq_len, 3), 'real_seq', 'float32')
         self.disc_inputs = [real_seq]
         self.place_holders = []
         if self.action_cond:
-            true_label = Input(batch_shape=(self.batch_size, 1), name='true_label', dtype='int32')
+            true_label = _input((self.batch_size, 1), 'true_label', 'int32')
             self.place_holders.append(true_label)  # it is not an input because it is only used in the loss
         if self.latent_cond_dim > 0:
-            latent_cond = Input(batch_shape=(self.batch_size, self.latent_cond_dim), name='latent_cond', dtype='float32')
+            latent_cond = _input((self.batch_size, self.latent_cond_dim), 'latent_cond', 'float32')
             self.place_holders.append(latent_cond)
-        x = self._proc_disc_inputs(self.disc_inputs)
-        self.real_outputs = self._proc_disc_outputs(self.discriminator(x))
-        self.disc_model = Model(self.disc_inputs, self.real_outputs, name=self.name + '_discriminator')
+
+        # Discriminator
+        if not gen_only:
+            x = self._proc_disc_inputs(self.disc_inputs)
+            self.real_outputs = self._proc_disc_outputs(self._run_net(self.discriminator, x, 'discriminator'))
+            self.disc_model = Model(self.disc_inputs, self.real_outputs, name=self.name + '_discriminator')
 
         # Generator
-        seq_mask = Input(batch_shape=(self.batch_size, self.njoints, self.seq_len, 1), name='seq_mask', dtype='float32')
+        seq_mask = _input((self.batch_size, self.njoints, self.seq_len, 1), 'seq_mask', 'float32')
         self.gen_inputs = [real_seq, seq_mask]
+        self.input_names = ['real_seq', 'seq_mask']
         if self.action_cond:
             self.gen_inputs.append(true_label)
+            self.input_names.append('true_label')
         if self.latent_cond_dim > 0:
             self.gen_inputs.append(latent_cond)
+            self.input_names.append('latent_cond')
         x = self._proc_gen_inputs(self.gen_inputs)
-        self.gen_outputs = self._proc_gen_outputs(self.generator(x))
+        self.gen_outputs = self._proc_gen_outputs(self._run_net(self.generator, x, 'generator'))
         self.gen_model = Model(self.gen_inputs, self.gen_outputs, name=self.name + '_generator')
+        if gen_only:
+            return
         self.fake_outputs = self.disc_model(self.gen_outputs)
 
         # Losses
@@ -130,12 +251,49 @@ class _MotionGAN(object):
                 gen_loss += loss
 
         # Custom train functions
-        with K.name_scope('discriminator/functions/train'):
-            disc_optimizer = Nadam(lr=config.learning_rate)
-            disc_training_updates = disc_optimizer.get_updates(disc_loss, self.disc_model.trainable_weights)
-            self.disc_train_f = K.function(self.disc_inputs + self.gen_inputs,
-                                           self.gan_losses.values() + self.disc_losses.values(),
-                                           disc_training_updates)
+        disc_optimizer = Nadam(lr=config.learning_rate)
+        gen_optimizer = Nadam(lr=config.learning_rate)
+        self.fused_train_step = config.fused_train_step
+        self.num_replicas = config.num_replicas
+        self.replica_devices = ['/%s:%d' % (config.replica_device, r) for r in range(self.num_replicas)]
+        self._step_model = None
+        if self.num_replicas > 1:
+            # Data parallel training, the batch is split across the replicas
+            assert self.batch_size is not None and self.batch_size % self.num_replicas == 0, \
+                'the batch must be static and split evenly across the replicas'
+            with K.name_scope('functions/replicas'):
+                train_losses, disc_grads, gen_grads = self._train_losses_and_grads(self.gen_inputs)
+        else:
+            train_losses = self.gan_losses, self.disc_losses, self.gen_losses, self.gen_metrics
+            with K.name_scope('functions/gradients'):
+                disc_grads = self._get_gradients(disc_loss, self.disc_model.trainable_weights, self.disc_loss_scale)
+                gen_grads = self._get_gradients(gen_loss, self.gen_model.trainable_weights, self.gen_loss_scale)
+        disc_train_outs = train_losses[0].values() + train_losses[1].values()
+        gen_train_outs = train_losses[2].values() + train_losses[3].values()
+
+        if self.fused_train_step:
+            # Both updates in a single run, on the same batch and the same generated sequence.
+            # Gradients are computed before any weight is updated (simultaneous updates)
+            with K.name_scope('functions/train'):
+                with tf.control_dependencies(disc_grads + gen_grads + disc_train_outs + gen_train_outs):
+                    training_updates = _get_updates(disc_optimizer, disc_grads,
+                                                    self.disc_model.trainable_weights, self.disc_loss_scale)
+                    training_updates += _get_updates(gen_optimizer, gen_grads,
+                                                     self.gen_model.trainable_weights, self.gen_loss_scale)
+                self.fused_train_f = K.function(self.gen_inputs if self.feed_inputs else [],
+                                                disc_train_outs + gen_train_outs, training_updates)
+        else:
+            with K.name_scope('discriminator/functions/train'):
+                disc_training_updates = _get_updates(disc_optimizer, disc_grads,
+                                                     self.disc_model.trainable_weights, self.disc_loss_scale)
+                self.disc_train_f = K.function(self.disc_inputs + self.gen_inputs if self.feed_inputs else [],
+                                               disc_train_outs, disc_training_updates)
+
+            with K.name_scope('generator/functions/train'):
+                gen_training_updates = _get_updates(gen_optimizer, gen_grads,
+                                                    self.gen_model.trainable_weights, self.gen_loss_scale)
+                self.gen_train_f = K.function(self.gen_inputs if self.feed_inputs else [],
+                                              gen_train_outs, gen_training_updates)
 
         with K.name_scope('discriminator/functions/eval'):
             self.disc_eval_f = K.function(self.disc_inputs + self.gen_inputs,
@@ -143,13 +301,6 @@ class _MotionGAN(object):
 
         self.disc_model = self._pseudo_build_model(self.disc_model, disc_optimizer)
 
-        with K.name_scope('generator/functions/train'):
-            gen_optimizer = Nadam(lr=config.learning_rate)
-            gen_training_updates = gen_optimizer.get_updates(gen_loss, self.gen_model.trainable_weights)
-            self.gen_train_f = K.function(self.gen_inputs,
-                                          self.gen_losses.values() + self.gen_metrics.values(),
-                                          gen_training_updates)
-
         with K.name_scope('generator/functions/eval'):
             gen_f_outs = self.gen_losses.values() + self.gen_metrics.values()
             gen_f_outs.append(self.fae_z)
@@ -159,6 +310,14 @@ class _MotionGAN(object):
 
         self.gen_model = self._pseudo_build_model(self.gen_model, gen_optimizer)
 
+        self.steps_per_run = config.steps_per_run
+        if self.steps_per_run > 1:
+            assert input_fn is not None, 'the training loop needs an input_fn, reading the inputs in graph'
+            # The float16 casts of the weights are built outside the loop, they would be read once per run
+            assert not self.mixed_precision, 'the training loop does not support mixed_precision'
+            with K.name_scope('functions/train_loop'):
+                self.train_loop_f = self._build_train_loop(input_fn, disc_optimizer, gen_optimizer)
+
         # GAN, complete model
         self.gan_model = Model(self.gen_inputs,
                                self.disc_model(self.gen_model(self.gen_inputs)),
@@ -171,6 +330,22 @@ class _MotionGAN(object):
         losses_dict = OrderedDict(zip(keys, train_outs))
         return losses_dict
 
+    def fused_train(self, inputs):
+        train_outs = self.fused_train_f(inputs)
+        disc_keys = self.gan_losses.keys() + self.disc_losses.keys()
+        gen_keys = self.gen_losses.keys() + self.gen_metrics.keys()
+        disc_losses = OrderedDict(zip(['train/%s' % key for key in disc_keys], train_outs[:len(disc_keys)]))
+        gen_losses = OrderedDict(zip(['train/%s' % key for key in gen_keys], train_outs[len(disc_keys):]))
+        return disc_losses, gen_losses
+
+    def train_loop(self, num_steps):
+        train_outs = self.train_loop_f([num_steps])
+        disc_keys = self.gan_losses.keys() + self.disc_losses.keys()
+        gen_keys = self.gen_losses.keys() + self.gen_metrics.keys()
+        disc_losses = OrderedDict(zip(['train/%s' % key for key in disc_keys], train_outs[:len(disc_keys)]))
+        gen_losses = OrderedDict(zip(['train/%s' % key for key in gen_keys], train_outs[len(disc_keys):]))
+        return disc_losses, gen_losses
+
     def disc_eval(self, inputs):
         eval_outs = self.disc_eval_f(inputs)
         keys = self.gan_losses.keys() + self.disc_losses.keys()
@@ -214,7 +389,7 @@ class _MotionGAN(object):
             gen_seq = self.gen_outputs[0]
 
             no_zero_frames = K.cast(K.greater_equal(K.abs(K.sum(real_seq, axis=(1, 3))), K.epsilon()), 'float32')
-            no_zero_frames_edm = K.reshape(no_zero_frames, (no_zero_frames.shape[0], 1, 1, no_zero_frames.shape[1]))
+            no_zero_frames_edm = K.expand_dims(K.expand_dims(no_zero_frames, axis=1), axis=1)
 
             with K.name_scope('gan_loss'):
                 if self.gan_type == 'wgan':
@@ -225,11 +400,11 @@ class _MotionGAN(object):
                     gan_losses['loss_fake'] = K.mean(loss_fake)
 
                     # Gradient Penalty
-                    alpha = K.random_uniform((self.batch_size, 1, 1, 1))
+                    alpha = K.random_uniform(K.stack([K.shape(real_seq)[0], 1, 1, 1]))
                     interpolates = (alpha * real_seq) + ((1 - alpha) * gen_seq)
                     inter_outputs = self.disc_model(interpolates)
                     inter_score = _get_tensor(inter_outputs, 'score_out')
-                    grad_mixed = K.gradients(inter_score, [interpolates])[0]
+                    grad_mixed = self._get_gradients(inter_score, [interpolates], self.disc_loss_scale)[0]
                     norm_grad_mixed = K.sqrt(K.sum(K.square(grad_mixed), axis=(1, 2, 3)) + K.epsilon())
                     grad_penalty = K.expand_dims(K.square(norm_grad_mixed - self.gamma_grads) / (self.gamma_grads ** 2), axis=-1)
 
@@ -243,9 +418,9 @@ class _MotionGAN(object):
 
                 elif self.gan_type == 'ralsgan':
                     # RaLSGAN, https://arxiv.org/abs/1807.00734
-                    Kone = K.ones((self.batch_size, 1), dtype='float32')
                     loss_real = _get_tensor(self.real_outputs, 'score_out')
                     loss_fake = _get_tensor(self.fake_outputs, 'score_out')
+                    Kone = K.ones_like(loss_real)
                     gan_losses['loss_real'] = K.mean(loss_real)
                     gan_losses['loss_fake'] = K.mean(loss_fake)
 
@@ -259,15 +434,16 @@ class _MotionGAN(object):
 
                 elif self.gan_type == 'standard' or self.gan_type == 'no_gan':
                     # GAN-GP, https://arxiv.org/abs/1801.04406
-                    Kone = K.ones((self.batch_size, 1), dtype='float32')
-                    Kzero = K.zeros((self.batch_size, 1), dtype='float32')
+                    Kone = K.ones_like(_get_tensor(self.real_outputs, 'score_out'))
+                    Kzero = K.zeros_like(Kone)
                     loss_real = K.binary_crossentropy(Kone, _get_tensor(self.real_outputs, 'score_out'), True)
                     loss_fake = K.binary_crossentropy(Kzero, _get_tensor(self.fake_outputs, 'score_out'), True)
                     gan_losses['loss_real'] = K.mean(loss_real)
                     gan_losses['loss_fake'] = K.mean(loss_fake)
 
                     # R1 Gradient Penalty
-                    grad_disc = K.gradients(_get_tensor(self.real_outputs, 'score_out'), self.disc_inputs)[0]
+                    grad_disc = self._get_gradients(_get_tensor(self.real_outputs, 'score_out'),
+                                                    self.disc_inputs, self.disc_loss_scale)[0]
                     norm_grad_disc = K.sum(K.square(grad_disc), axis=(1, 2, 3))
 
                     # Discriminator loss
@@ -383,18 +559,168 @@ class _MotionGAN(object):
             with K.name_scope('regularization_loss'):
                 if len(self.disc_model.losses) > 0:
                     disc_loss_reg = 0.0
-                    for reg_loss in set(self.disc_model.losses):
+                    for reg_loss in self._reg_losses(self.disc_model):
                         disc_loss_reg += reg_loss
                     disc_losses['disc_loss_reg'] = disc_loss_reg
 
                 if len(self.gen_model.losses) > 0:
                     gen_loss_reg = 0.0
-                    for reg_loss in set(self.gen_model.losses):
+                    for reg_loss in self._reg_losses(self.gen_model):
                         gen_loss_reg += reg_loss
                     gen_losses['gen_loss_reg'] = gen_loss_reg
 
         return gan_losses, disc_losses, gen_losses, gen_metrics
 
+    def _reg_losses(self, model):
+        # The regularization losses of the model were built on the weight snapshots, in the
+        # training loop they are built again on the weight reads of the step
+        if not self._rebuild_reg_losses:
+            return set(model.losses)
+        reg_losses = _weight_reg_losses(model)
+        assert len(reg_losses) == len(set(model.losses)), \
+            'the regularization losses of %s can not be rebuilt in the training loop' % model.name
+        return reg_losses
+
+    def _run_net(self, net, x, scope_name):
+        # Runs the network body (discriminator / generator), in float16 in mixed precision mode
+        if not self.mixed_precision:
+            return net(x)
+        scope = Scoping.get_global_scope()
+        with scope.name_scope(scope_name):
+            x = Lambda(lambda arg: K.cast(arg, 'float16'), name=scope+'cast_in')(x)
+            with mixed_precision_scope('float16'):
+                x = net(x)
+            return Lambda(lambda arg: K.cast(arg, 'float32'), name=scope+'cast_out')(x)
+
+    def _get_gradients(self, loss, params, loss_scale=None):
+        # The float16 gradients of mixed precision are loss scaled, penalties on input gradients included
+        if loss_scale is None:
+            return K.gradients(loss, params)
+        return loss_scale.get_gradients(loss, params)
+
+    def _rebuild_loss(self, inputs):
+        """Builds the losses again on a new batch, a list of tensors ordered as gen_inputs, by calling
+        the models on it. Returns the loss dicts, as _build_loss."""
+        aux_names = [name for name in ['diff_input', 'diff_mask', 'diff_output',
+                                       'angles_input', 'angles_mask', 'angles_output'] if hasattr(self, name)]
+        if self._step_model is None:
+            # Exposes the inner generator tensors used by the losses
+            self._step_model = Model(self.gen_inputs, self.gen_outputs + [getattr(self, name) for name in aux_names],
+                                     name=self.name + '_step')
+        bound_names = ['batch_size', 'disc_inputs', 'gen_inputs', 'place_holders', 'gen_outputs',
+                       'real_outputs', 'fake_outputs'] + aux_names
+        bound = dict([(name, getattr(self, name)) for name in bound_names])
+        try:
+            # Inputs are looked up by name
+            self.gen_inputs = [tf.identity(x, name=name) for x, name in zip(inputs, self.input_names)]
+            self.disc_inputs = self.gen_inputs[:1]
+            self.place_holders = self.gen_inputs[2:]
+            self.batch_size = K.int_shape(inputs[0])[0]  # None in batch size agnostic graphs
+            step_outputs = self._step_model(self.gen_inputs)
+            step_outputs = step_outputs if isinstance(step_outputs, list) else [step_outputs]
+            self.gen_outputs = step_outputs[:len(self.gen_outputs)]
+            for name, tensor in zip(aux_names, step_outputs[len(self.gen_outputs):]):
+                setattr(self, name, tensor)
+            self.real_outputs = self.disc_model(self.disc_inputs)
+            self.fake_outputs = self.disc_model(self.gen_outputs)
+            return self._build_loss()
+        finally:
+            for name, value in bound.items():
+                setattr(self, name, value)
+
+    def _train_losses_and_grads(self, inputs):
+        """Training losses on a batch (see _rebuild_loss) and gradients of the disc and gen losses.
+        With several replicas, the batch is split among them, each one computing its own losses,
+        gradient penalties included, and the losses and gradients are averaged."""
+        batch_size = K.int_shape(inputs[0])[0]
+        replica_batch = (batch_size if batch_size is not None else tf.shape(inputs[0])[0]) // self.num_replicas
+        replicas_losses, replicas_disc_grads, replicas_gen_grads = [], [], []
+        for r in range(self.num_replicas):
+            with tf.device(self.replica_devices[r] if self.num_replicas > 1 else None), \
+                 K.name_scope('replica_%d' % r):
+                if self.num_replicas > 1:
+                    losses = self._rebuild_loss([x[r * replica_batch:(r + 1) * replica_batch] for x in inputs])
+                else:
+                    losses = self._rebuild_loss(inputs)
+                replicas_losses.append(losses)
+                replicas_disc_grads.append(self._get_gradients(sum(losses[1].values()),
+                                                               self.disc_model.trainable_weights, self.disc_loss_scale))
+                replicas_gen_grads.append(self._get_gradients(sum(losses[2].values()),
+                                                              self.gen_model.trainable_weights, self.gen_loss_scale))
+
+        if self.num_replicas == 1:
+            return replicas_losses[0], replicas_disc_grads[0], replicas_gen_grads[0]
+
+        def _mean(tensors):
+            # Embedding gradients are IndexedSlices
+            return tf.add_n([tf.convert_to_tensor(tensor) for tensor in tensors]) / self.num_replicas
+
+        with K.name_scope('replicas_mean'):
+            losses = tuple(OrderedDict([(key, _mean([replica_losses[d][key] for replica_losses in replicas_losses]))
+                                        for key in replicas_losses[0][d].keys()])
+                           for d in range(len(replicas_losses[0])))
+            disc_grads = [_mean(grads) for grads in zip(*replicas_disc_grads)]
+            gen_grads = [_mean(grads) for grads in zip(*replicas_gen_grads)]
+        return losses, disc_grads, gen_grads
+
+    def _build_train_loop(self, input_fn, disc_optimizer, gen_optimizer):
+        """Builds a function running num_steps training steps in a single call, in a tf.while_loop
+        drawing its batches from input_fn. Returns the mean of the disc and gen losses over the steps."""
+
+        weights = self.disc_model.weights + self.gen_model.weights
+
+        def _train_step(deps, disc_train=True, gen_train=True):
+            # The batch and the weights are read after deps, the updates of the previous step
+            with tf.control_dependencies(deps):
+                inputs = input_fn()
+                with _weight_reads_scope(weights):
+                    self._rebuild_reg_losses = True
+                    try:
+                        losses, disc_grads, gen_grads = self._train_losses_and_grads(
+                            [inputs[name] for name in self.input_names])
+                    finally:
+                        self._rebuild_reg_losses = False
+            gan_losses, disc_losses, gen_losses, gen_metrics = losses
+            outs, grads, updates_fns = [], [], []
+            if disc_train:
+                outs += gan_losses.values() + disc_losses.values()
+                grads += disc_grads
+                updates_fns.append(lambda: _get_updates(disc_optimizer, disc_grads,
+                                                        self.disc_model.trainable_weights, self.disc_loss_scale))
+            if gen_train:
+                outs += gen_losses.values() + gen_metrics.values()
+                grads += gen_grads
+                updates_fns.append(lambda: _get_updates(gen_optimizer, gen_grads,
+                                                        self.gen_model.trainable_weights, self.gen_loss_scale))
+            with tf.control_dependencies(grads + outs):
+                updates = []
+                for updates_fn in updates_fns:
+                    updates += updates_fn()
+            return outs, updates
+
+        num_steps = K.placeholder(shape=(), dtype='int32', name='num_steps')
+        num_outs = len(self.gan_losses) + len(self.disc_losses) + len(self.gen_losses) + len(self.gen_metrics)
+
+        def _cond(step, *outs_sums):
+            return step < num_steps
+
+        def _body(step, *outs_sums):
+            if self.fused_train_step:
+                outs, updates = _train_step([step])
+            else:
+                outs, updates = _train_step([step], gen_train=False)
+                # The generator step sees the updated discriminator, as in the alternating steps
+                gen_outs, updates = _train_step(updates, disc_train=False)
+                outs += gen_outs
+            with tf.control_dependencies(updates):
+                return [step + 1] + [outs_sum + out for outs_sum, out in zip(outs_sums, outs)]
+
+        # Iterations must not overlap, each step reads the weights updated by the previous one
+        loop_outs = tf.while_loop(_cond, _body, [tf.constant(0)] + [tf.constant(0.0)] * num_outs,
+                                  parallel_iterations=1)
+        mean_outs = [outs_sum / K.cast(num_steps, K.floatx()) for outs_sum in loop_outs[1:]]
+        return K.function([num_steps], mean_outs)
+
     def _pseudo_build_model(self, model, optimizer):
         # This function mimics compilation to enable saving the model
         model.optimizer = optimizer
@@ -417,7 +743,7 @@ class _MotionGAN(object):
             if self.rescale_coords:
                 x, self.stats[scope+'bone_len'] = rescale_body_in(x, self.body_members)
 
-            self.org_shape = [int(dim) for dim in x.shape]
+            self.org_shape = list(K.int_shape(x))
 
         return x
 
@@ -464,7 +790,7 @@ class _MotionGAN(object):
                 self.angles_input, self.angles_mask = x, x_mask
                 # self.aux_out = seq_to_angles_out(x)  # Uncomment to visualize reconstructed sequence
 
-            self.org_shape = [int(dim) for dim in x.shape]
+            self.org_shape = list(K.int_shape(x))
 
             x = Multiply(name=scope+'mask_mult')([x, x_mask])
 
@@ -703,7 +1029,7 @@ class MotionGANV3(_MotionGAN):
         with scope.name_scope('generator'):
             n_hidden = 512
 
-            x_shape = [int(dim) for dim in x.shape]
+            x_shape = list(K.int_shape(x))
             x = Flatten(name=scope+'flatten_in')(x)
             x = _preact_dense(x, n_hidden)
             for i in range(4):
@@ -785,7 +1111,7 @@ def resnet_disc(x):
 def dmnn_disc(x):
     scope = Scoping.get_global_scope()
     with scope.name_scope('dmnn'):
-        x_shape = [int(dim) for dim in x.shape]
+        x_shape = list(K.int_shape(x))
         n_hidden = 64
         n_reps = 2
         n_blocks = 3
@@ -887,7 +1213,7 @@ class MotionGANV5(_MotionGAN):
     def generator(self, x):
         scope = Scoping.get_global_scope()
         with scope.name_scope('generator'):
-            x_shape = [int(dim) for dim in x.shape]
+            x_shape = list(K.int_shape(x))
             n_hidden = 32
             time_steps = x_shape[1]
             n_blocks = 0
@@ -1065,7 +1391,7 @@ class MotionGANV8(_MotionGAN):
             x = Reshape((int(x.shape[1]), int(x.shape[2]) * chans), name=scope+'resh_in')(x)
             x = Conv1D(int(x.shape[2]) // (2 * chans), 1, 1, name=scope+'conv_in', **CONV1D_ARGS)(x)
 
-            x_shape = [int(dim) for dim in x.shape]
+            x_shape = list(K.int_shape(x))
             n_stages = 2
             for i in range(n_stages):
                 with scope.name_scope('stage_%d' % i):
@@ -1148,7 +1474,7 @@ class MotionGANV87(_MotionGAN):
                 x = Reshape((int(x.shape[1]), int(x.shape[2]) * chans), name=scope+'resh_in')(x)
                 x = Conv1D(int(x.shape[2]) // chans, 1, 1, name=scope+'conv_in', **CONV1D_ARGS)(x)
 
-                x_shape = [int(dim) for dim in x.shape]
+                x_shape = list(K.int_shape(x))
 
                 n_stages = 1
                 with scope.name_scope('rel_mem_rnn'):
@@ -1234,7 +1560,7 @@ class MotionGANV87nocnn(_MotionGAN):
                 x = Reshape((int(x.shape[1]), int(x.shape[2]) * chans), name=scope+'resh_in')(x)
                 x = Conv1D(int(x.shape[2]) // chans, 1, 1, name=scope+'conv_in', **CONV1D_ARGS)(x)
 
-                x_shape = [int(dim) for dim in x.shape]
+                x_shape = list(K.int_shape(x))
 
                 n_stages = 1
                 with scope.name_scope('rel_mem_rnn'):
@@ -1279,7 +1605,7 @@ class MotionGANV87norelm(_MotionGAN):
                 x = Reshape((int(x.shape[1]), int(x.shape[2]) * chans), name=scope+'resh_in')(x)
                 x = Conv1D(int(x.shape[2]) // chans, 1, 1, name=scope+'conv_in', **CONV1D_ARGS)(x)
 
-                x_shape = [int(dim) for dim in x.shape]
+                x_shape = list(K.int_shape(x))
 
                 n_stages = 2
                 with scope.name_scope('lstm'):
@@ -1353,7 +1679,7 @@ class MotionGANV87nolstm(_MotionGAN):
                 x = Reshape((int(x.shape[1]), int(x.shape[2]) * chans), name=scope+'resh_in')(x)
                 x = Conv1D(int(x.shape[2]) // chans, 1, 1, name=scope+'conv_in', **CONV1D_ARGS)(x)
 
-                x_shape = [int(dim) for dim in x.shape]
+                x_shape = list(K.int_shape(x))
 
                 n_stages = 1
                 with scope.name_scope('rel_mem_rnn'):
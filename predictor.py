@@ -0,0 +1,184 @@
+from __future__ import absolute_import, division, print_function
+
+from argparse import Namespace
+from collections import OrderedDict
+import numpy as np
+import tensorflow as tf
+import tensorflow.contrib.keras.api.keras.backend as K
+from config import get_config
+from data_input import pose_stats_file_paths
+from models.motiongan import get_model
+from utils.restore_keras_model import restore_keras_model
+from utils.seq_utils import gen_latent_noise
+
+
+def load_config(save_path, batch_size=None):
+    """Config of a trained model, for inference with batch_size (None for any batch size)"""
+    config = get_config(Namespace(save_path=save_path, config_file=None))
+    assert config.epoch > 0, 'Nothing to predict with an untrained model'
+    config.batch_size = batch_size
+    return config
+
+
+def load_pose_stats(config):
+    """Normalization stats of the data set of config, [1, njoints or 1, 1, 3]"""
+    mean_file_path, std_file_path = pose_stats_file_paths(config)
+    return np.load(mean_file_path).astype(np.float32), np.load(std_file_path).astype(np.float32)
+
+
+class MotionPredictor(object):
+    """Inference with a trained generator. Only the generator is built, from the config pickle
+    and the _gen_weights.hdf5 of save_path, and its weights are loaded once.
+
+    With batch_size None (default) the graph accepts any batch size. The pose stats are loaded
+    from the data set path, unless poses_mean and poses_std are given. predict can be called
+    from any thread, it runs in the graph and session the model was built in."""
+
+    def __init__(self, save_path, batch_size=None, poses_mean=None, poses_std=None):
+        config = load_config(save_path, batch_size)
+        self.config = config
+        self.batch_size = batch_size
+        self.njoints = config.njoints
+        self.action_cond = config.action_cond
+        self.num_actions = config.num_actions
+        self.latent_cond_dim = config.latent_cond_dim
+        self.normalize_data = config.normalize_data
+
+        self.model_wrap = get_model(config, gen_only=True)
+        self.seq_len = self.model_wrap.seq_len
+        self.gen_model = restore_keras_model(
+            self.model_wrap.gen_model, config.save_path + '_gen_weights.hdf5', False, False)
+        # The predict function is built now, in the graph of the model, as predict may be
+        # called from other threads (the default graph is thread local)
+        self.gen_model._make_predict_function()
+        self.graph = tf.get_default_graph()
+        self.session = K.get_session()
+
+        if self.normalize_data:
+            if poses_mean is None or poses_std is None:
+                poses_mean, poses_std = load_pose_stats(config)
+            self.poses_mean = np.asarray(poses_mean, dtype=np.float32)
+            self.poses_std = np.asarray(poses_std, dtype=np.float32)
+
+    def normalize_poses(self, poses):
+        return (poses - self.poses_mean) / (self.poses_std + 1e-8)
+
+    def unnormalize_poses(self, poses):
+        return (poses * (self.poses_std + 1e-8)) + self.poses_mean
+
+    def normalize_frames(self, frames):
+        # Same as normalize_poses, for frame major arrays [nframes, njoints, 3]
+        return (frames - self.poses_mean[:, :, 0, :]) / (self.poses_std[:, :, 0, :] + 1e-8)
+
+    def get_inputs(self, poses, mask, labels=None, latent=None, normalized=False):
+        """Gen model inputs from unnormalized (unless normalized) poses [batch, njoints, seq_len, 3],
+        mask [batch, njoints, seq_len(, 1)], labels [batch(, 1)] and latent [batch, latent_cond_dim]"""
+        poses = np.asarray(poses, dtype=np.float32)
+        batch_size = poses.shape[0]
+        if self.normalize_data and not normalized:
+            poses = self.normalize_poses(poses)
+        mask = np.reshape(np.asarray(mask, dtype=np.float32), poses.shape[:3] + (1,))
+
+        gen_inputs = [poses, mask]
+        if self.action_cond:
+            assert labels is not None, 'the model is conditioned on the action labels'
+            gen_inputs.append(np.reshape(labels, (batch_size, 1)).astype(np.int32))
+        if self.latent_cond_dim > 0:
+            latent = gen_latent_noise(batch_size, self.latent_cond_dim) if latent is None else latent
+            gen_inputs.append(np.reshape(latent, (batch_size, self.latent_cond_dim)).astype(np.float32))
+        return gen_inputs
+
+    def predict(self, poses, mask, labels=None, latent=None, normalized=False):
+        """Returns the generated, unnormalized, poses [batch, njoints, seq_len, 3]"""
+        gen_inputs = self.get_inputs(poses, mask, labels, latent, normalized)
+        batch_size = self.batch_size if self.batch_size is not None else gen_inputs[0].shape[0]
+        with self.graph.as_default(), self.session.as_default():
+            gen_output = self.gen_model.predict(gen_inputs, batch_size)
+        if self.normalize_data:
+            gen_output = self.unnormalize_poses(gen_output)
+        return gen_output
+
+
+class _Stream(object):
+    def __init__(self, buffer_len, njoints, label, latent):
+        self.frames = np.zeros((buffer_len, njoints, 3), dtype=np.float32)
+        self.count = 0
+        self.pos = 0
+        self.updated = False
+        self.label = label
+        self.latent = latent
+
+    def push(self, frame):
+        self.frames[self.pos, ...] = frame
+        self.pos = (self.pos + 1) % self.frames.shape[0]
+        self.count = min(self.count + 1, self.frames.shape[0])
+        self.updated = True
+
+    def last_frames(self):
+        # The buffered frames in arrival order, [count, njoints, 3]
+        return self.frames[(self.pos - self.count + np.arange(self.count)) % self.frames.shape[0], ...]
+
+
+class StreamingPredictor(object):
+    """Future prediction (mask mode 1) on live skeleton feeds, with a MotionPredictor.
+
+    Each stream keeps a ring buffer with its last known frames, normalized once on arrival.
+    tick() predicts, in one generator call, the future of all the streams with new frames.
+    The window has the known frames first, as the Future Prediction masks of gen_mask, and the
+    generator completes the rest. Each stream keeps its own latent code, so its successive
+    predictions are consistent."""
+
+    def __init__(self, predictor, keep_prob=0.5):
+        assert predictor.seq_len is not None, 'streaming needs a model with a fixed seq_len'
+        self.predictor = predictor
+        self.known_len = int(np.floor(predictor.seq_len * keep_prob))
+        assert self.known_len > 0, 'keep_prob is too low, no known frames'
+        self.streams = OrderedDict()
+
+    def add_stream(self, stream_id, label=None, latent=None):
+        assert not self.predictor.action_cond or label is not None, 'the model needs an action label'
+        if self.predictor.latent_cond_dim > 0 and latent is None:
+            latent = gen_latent_noise(1, self.predictor.latent_cond_dim)[0, :]
+        self.streams[stream_id] = _Stream(self.known_len, self.predictor.njoints, label, latent)
+
+    def remove_stream(self, stream_id):
+        del self.streams[stream_id]
+
+    def push(self, stream_id, frame):
+        """Adds the new unnormalized frame [njoints, 3] of a stream"""
+        frame = np.asarray(frame, dtype=np.float32)[np.newaxis, ...]
+        if self.predictor.normalize_data:
+            frame = self.predictor.normalize_frames(frame)
+        self.streams[stream_id].push(frame[0, ...])
+
+    def tick(self):
+        """Returns a dict with the predicted frames [njoints, seq_len - known frames, 3] of the
+        streams updated since the last tick"""
+        stream_ids = [stream_id for stream_id, stream in self.streams.items() if stream.updated]
+        chunk_size = self.predictor.batch_size if self.predictor.batch_size is not None else len(stream_ids)
+        predictions = {}
+        for start in range(0, len(stream_ids), max(chunk_size, 1)):
+            predictions.update(self._predict(stream_ids[start:start + chunk_size]))
+        return predictions
+
+    def _predict(self, stream_ids):
+        njoints, seq_len = self.predictor.njoints, self.predictor.seq_len
+        batch_size = self.predictor.batch_size if self.predictor.batch_size is not None else len(stream_ids)
+        poses = np.zeros((batch_size, njoints, seq_len, 3), dtype=np.float32)
+        mask = np.zeros((batch_size, njoints, seq_len, 1), dtype=np.float32)
+        labels = np.zeros((batch_size, 1), dtype=np.int32)
+        latent = np.zeros((batch_size, self.predictor.latent_cond_dim), dtype=np.float32)
+
+        streams = [self.streams[stream_id] for stream_id in stream_ids]
+        for i, stream in enumerate(streams):
+            poses[i, :, :stream.count, :] = np.transpose(stream.last_frames(), (1, 0, 2))
+            mask[i, :, :stream.count, :] = 1.0
+            if stream.label is not None:
+                labels[i, 0] = stream.label
+            if stream.latent is not None:
+                latent[i, :] = stream.latent
+            stream.updated = False
+
+        gen_output = self.predictor.predict(poses, mask, labels, latent, normalized=True)
+        return dict([(stream_id, gen_output[i, :, stream.count:, :])
+                     for i, (stream_id, stream) in enumerate(zip(stream_ids, streams))])
@@ -0,0 +1,233 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import numbers
+import threading
+import time
+from collections import deque
+import numpy as np
+import tensorflow as tf
+from predictor import MotionPredictor, load_config
+from frozen_predictor import FrozenPredictor
+from utils.seq_utils import MASK_MODES, gen_mask
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from Queue import Queue, Empty
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from queue import Queue, Empty
+
+flags = tf.flags
+flags.DEFINE_string("model_path", None, "Trained model save path")
+flags.DEFINE_string("export_path", None, "Generator exported by export.py, served instead of the keras model")
+flags.DEFINE_string("host", "127.0.0.1", "Address to listen on")
+flags.DEFINE_integer("port", 8080, "Port to listen on")
+flags.DEFINE_integer("max_batch_size", 32, "Max requests per generator call")
+flags.DEFINE_float("max_wait_ms", 5.0, "Max time a request waits for others to fill its batch")
+flags.DEFINE_integer("report_secs", 60, "Seconds between stats reports (0 == never)")
+flags.DEFINE_bool("verbose", False, "To talk or not to talk")
+FLAGS = flags.FLAGS
+
+
+class _Request(object):
+    def __init__(self, poses, mask, mask_mode, keep_prob, label):
+        self.poses = poses
+        self.mask = mask
+        self.mask_mode = mask_mode
+        self.keep_prob = keep_prob
+        self.label = label
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """Collects concurrent requests into batches for one generator call, bounded by max_batch_size
+    and by max_wait_ms since the arrival of the first request of the batch.
+
+    Sequences shorter than the model seq_len are padded with unknown (masked) frames, so the
+    generator completes them. Results are the full seq_len sequences."""
+
+    def __init__(self, predictor, body_members, max_batch_size=32, max_wait_ms=5.0, stats_window=1000):
+        assert predictor.batch_size is None or max_batch_size <= predictor.batch_size, \
+            'the batches do not fit in the static batch size of the predictor'
+        assert predictor.seq_len is not None, 'serving needs a model with a fixed seq_len'
+        self.predictor = predictor
+        self.body_members = body_members
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = Queue()
+
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_batches = 0
+        self.latencies = deque(maxlen=stats_window)
+        self.fill_ratios = deque(maxlen=stats_window)
+
+        self.thread = threading.Thread(target=self._run, name='micro_batcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, poses, mask=None, mask_mode=0, keep_prob=0.5, label=None):
+        """Blocks until the prediction is done. poses [njoints, nframes, 3], with nframes <= seq_len,
+        the optional mask [njoints, nframes] overrides mask_mode and keep_prob (see gen_mask)"""
+        poses = np.asarray(poses, dtype=np.float32)
+        assert poses.ndim == 3 and poses.shape[0] == self.predictor.njoints and poses.shape[2] == 3, \
+            'poses must be [%d, nframes, 3]' % self.predictor.njoints
+        assert poses.shape[1] <= self.predictor.seq_len, 'at most %d frames' % self.predictor.seq_len
+        if mask is not None:
+            mask = np.reshape(np.asarray(mask, dtype=np.float32), poses.shape[:2])
+        # Checked here, a bad request would fail the whole batch it joins
+        assert isinstance(mask_mode, numbers.Integral) and 0 <= mask_mode < len(MASK_MODES), 'unknown mask mode'
+        assert isinstance(keep_prob, numbers.Real) and 0.0 <= keep_prob <= 1.0, 'keep_prob must be in [0, 1]'
+        if self.predictor.action_cond:
+            num_actions = self.predictor.num_actions
+            assert isinstance(label, numbers.Integral) and 0 <= label and \
+                (num_actions is None or label < num_actions), \
+                'the model needs an action label in [0, %s)' % num_actions
+
+        request = _Request(poses, mask, mask_mode, keep_prob, label)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = batch[0].arrival + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                # Past the deadline, only the already queued requests are taken
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _predict(self, batch):
+        njoints, seq_len = self.predictor.njoints, self.predictor.seq_len
+        batch_size = len(batch) if self.predictor.batch_size is None else self.predictor.batch_size
+        poses = np.zeros((batch_size, njoints, seq_len, 3), dtype=np.float32)
+        mask = np.zeros((batch_size, njoints, seq_len, 1), dtype=np.float32)
+        labels = np.zeros((batch_size, 1), dtype=np.int32)
+
+        mode_mask = gen_mask([request.mask_mode for request in batch], [request.keep_prob for request in batch],
+                             len(batch), njoints, seq_len, self.body_members)
+        for i, request in enumerate(batch):
+            nframes = request.poses.shape[1]
+            poses[i, :, :nframes, :] = request.poses
+            if request.mask is not None:
+                mask[i, :, :nframes, 0] = request.mask
+            else:
+                mask[i, :, :nframes, :] = mode_mask[i, :, :nframes, :]
+            if request.label is not None:
+                labels[i, 0] = request.label
+
+        gen_output = self.predictor.predict(poses, mask, labels)
+        for i, request in enumerate(batch):
+            request.result = gen_output[i, ...]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._predict(batch)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+
+            end = time.time()
+            with self.lock:
+                self.num_requests += len(batch)
+                self.num_batches += 1
+                self.fill_ratios.append(len(batch) / self.max_batch_size)
+                self.latencies.extend([(end - request.arrival) * 1000 for request in batch])
+            for request in batch:
+                request.done.set()
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            fill_ratios = list(self.fill_ratios)
+            stats = {'requests': self.num_requests, 'batches': self.num_batches}
+        stats['queue_depth'] = self.queue.qsize()
+        stats['batch_fill_ratio'] = float(np.mean(fill_ratios)) if len(fill_ratios) > 0 else 0.0
+        stats['latency_p50_ms'] = float(np.percentile(latencies, 50)) if len(latencies) > 0 else 0.0
+        stats['latency_p99_ms'] = float(np.percentile(latencies, 99)) if len(latencies) > 0 else 0.0
+        return stats
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(batcher, verbose=False):
+    class _Handler(BaseHTTPRequestHandler):
+        """POST /predict with a json {poses, [mask], [mask_mode], [keep_prob], [label]},
+        GET /stats for the batcher stats"""
+
+        def _reply(self, code, body):
+            body = json.dumps(body).encode('utf8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, batcher.stats())
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._reply(404, {'error': 'not found'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf8'))
+                gen_poses = batcher.submit(request['poses'], request.get('mask', None), request.get('mask_mode', 0),
+                                           request.get('keep_prob', 0.5), request.get('label', None))
+            except (ValueError, KeyError, AssertionError) as e:
+                self._reply(400, {'error': str(e)})
+            except Exception as e:
+                self._reply(500, {'error': str(e)})
+            else:
+                self._reply(200, {'poses': gen_poses.tolist()})
+
+        def log_message(self, *args):
+            if verbose:
+                BaseHTTPRequestHandler.log_message(self, *args)
+
+    return _Handler
+
+
+def _report(batcher, report_secs):
+    while True:
+        time.sleep(report_secs)
+        print(json.dumps(batcher.stats(), sort_keys=True))
+
+
+if __name__ == "__main__":
+    config = load_config(FLAGS.model_path)
+    if FLAGS.export_path is not None:
+        predictor = FrozenPredictor(FLAGS.export_path)
+    else:
+        predictor = MotionPredictor(FLAGS.model_path)
+    batcher = MicroBatcher(predictor, config.body_members, FLAGS.max_batch_size, FLAGS.max_wait_ms)
+
+    if FLAGS.report_secs > 0:
+        report_thread = threading.Thread(target=_report, args=(batcher, FLAGS.report_secs), name='report')
+        report_thread.daemon = True
+        report_thread.start()
+
+    server = _ThreadingHTTPServer((FLAGS.host, FLAGS.port), make_handler(batcher, FLAGS.verbose))
+    print('Serving %s on %s:%d' % (FLAGS.model_path, FLAGS.host, FLAGS.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -10,10 +10,11 @@ from models.motiongan import get_model
 from models.dmnn import DMNNv1
 from utils.restore_keras_model import restore_keras_model
 from utils.viz import plot_seq_gif, plot_seq_pano, plot_seq_frozen
-from utils.seq_utils import MASK_MODES, gen_mask, linear_baseline, burke_baseline, post_process, seq_to_angles_transformer, get_angles_mask, gen_latent_noise, _some_variables, fkl, rotate_start
+from utils.seq_utils import MASK_MODES, gen_mask, linear_baseline_batch, burke_baseline_batch, post_process_batch, KinematicPlan, gen_latent_noise, _some_variables, fkl_batch, rotate_start
 import h5py as h5
 from tqdm import trange
 from collections import OrderedDict
+from multiprocessing import Pool
 from colorama import Fore, Back, Style
 import utils.npangles as npangles
 
@@ -26,6 +27,7 @@ flags.DEFINE_string("dmnn_path", None, "Path to trained DMNN model")
 flags.DEFINE_string("images_mode", "gif", "Image modes: gif, png")
 flags.DEFINE_integer("mask_mode", 1, "Mask modes: " + ' '.join(['%d:%s' % tup for tup in enumerate(MASK_MODES)]))
 flags.DEFINE_float("keep_prob", 0.5, "Probability of keeping input data. (1 == Keep All)")
+flags.DEFINE_integer("baseline_workers", 0, "Processes computing the burke baseline in dmnn_score (0 == no pool)")
 FLAGS = flags.FLAGS
 
 
@@ -45,6 +47,11 @@ if __name__ == "__main__":
     elif "plot_survey" in FLAGS.test_mode:
         batch_size = 120
 
+    # Forked before building the models and the session
+    baseline_pool = None
+    if "dmnn_score" in FLAGS.test_mode and FLAGS.baseline_workers > 0:
+        baseline_pool = Pool(FLAGS.baseline_workers)
+
     configs = []
     model_wraps = []
     # Hacks to fill undefined, but necessary flags
@@ -114,7 +121,8 @@ if __name__ == "__main__":
     njoints = configs[0].njoints
     seq_len = model_wraps[0].seq_len
     body_members = configs[0].body_members  # if not configs[0].data_set == 'Human36' else configs[0].full_body_members
-    angle_trans = seq_to_angles_transformer(body_members)
+    kinematic_plan = KinematicPlan(body_members)
+    angle_trans = kinematic_plan.get_angles
 
     def get_inputs(baseline_mode=False):
         labs_batch, poses_batch = val_generator.next()
@@ -213,9 +221,7 @@ if __name__ == "__main__":
                     latent_noise = gen_latent_noise(batch_size, configs[m].latent_cond_dim)
                     gen_inputs.append(latent_noise)
                 gen_output = model_wrap.gen_model.predict(gen_inputs, batch_size)
-                for j in range(batch_size):
-                    gen_output[j, ...] = post_process(poses_batch[j, ...], gen_output[j, ...],
-                                                      mask_batch[j, ...], body_members)
+                gen_output = post_process_batch(poses_batch, gen_output, mask_batch, body_members)
                 if configs[m].normalize_data:
                     gen_output = data_input.unnormalize_poses(gen_output)
 
@@ -300,7 +306,7 @@ if __name__ == "__main__":
                 p2ps_occ_num = np.sum(1.0 - mask_batch) + 1e-8
                 dms_mask_batch = np.expand_dims(mask_batch, axis=1) * np.expand_dims(mask_batch, axis=2)
                 dms_occ_num = np.sum(1.0 - dms_mask_batch) + 1e-8
-                angles_mask_batch = get_angles_mask(mask_batch, body_members)
+                angles_mask_batch = kinematic_plan.get_angles_mask(mask_batch)
                 angles_occ_num = np.sum(1.0 - angles_mask_batch) + 1e-8
 
                 for m, model_wrap in enumerate(model_wraps):
@@ -328,11 +334,8 @@ if __name__ == "__main__":
                     _, real_acc = model_wrap_dmnn.model.evaluate(poses_batch, labs_batch[:, 2], batch_size=batch_size, verbose=2)
                     accs['real_acc'] += real_acc
 
-                linear_batch = np.empty_like(poses_batch)
-                burke_batch = np.empty_like(poses_batch)
-                for j in range(batch_size):
-                    linear_batch[j, ...] = linear_baseline(poses_batch[j, ...], mask_batch[j, ...])
-                    burke_batch[j, ...] = burke_baseline(poses_batch[j, ...], mask_batch[j, ...])
+                linear_batch = linear_baseline_batch(poses_batch, mask_batch)
+                burke_batch = burke_baseline_batch(poses_batch, mask_batch, baseline_pool)
 
                 if FLAGS.dmnn_path is not None:
                     _, linear_acc = model_wrap_dmnn.model.evaluate(linear_batch, labs_batch[:, 2], batch_size=batch_size, verbose=2)
@@ -392,6 +395,10 @@ if __name__ == "__main__":
 
         else:
             run_dmnn_score()
+
+        if baseline_pool is not None:
+            baseline_pool.close()
+            baseline_pool.join()
     elif FLAGS.test_mode == "hmp_l2_comp":
         from utils.human36_expmaps_to_h5 import actions
 
@@ -413,10 +420,8 @@ if __name__ == "__main__":
         parent, offset, rotInd, expmapInd = _some_variables()
 
         def to_coords(seq_angles):
-            seq_coords = np.empty((1, len(h36_coords_used_joints), seq_angles.shape[0], 3))
-            for i in range(seq_angles.shape[0]):
-                frame_coords = fkl(seq_angles[i, :], parent, offset, rotInd, expmapInd)
-                seq_coords[0, :, i, :] = frame_coords[h36_coords_used_joints, :]
+            frames_coords = fkl_batch(seq_angles, parent, offset, rotInd, expmapInd)
+            seq_coords = np.transpose(frames_coords[:, h36_coords_used_joints, :], (1, 0, 2))[np.newaxis, ...]
             seq_coords[..., 1] = seq_coords[..., 1] * -1  # Inverting y axis for visualization purposes
             return seq_coords
 
@@ -833,10 +838,8 @@ if __name__ == "__main__":
             return seq[range(0, int(seq.shape[0]), 5), :]
 
         def to_coords(seq_angles):
-            seq_coords = np.empty((1, len(h36_coords_used_joints), seq_angles.shape[0], 3))
-            for i in range(seq_angles.shape[0]):
-                frame_coords = fkl(seq_angles[i, :], parent, offset, rotInd, expmapInd)
-                seq_coords[0, :, i, :] = frame_coords[h36_coords_used_joints, :]
+            frames_coords = fkl_batch(seq_angles, parent, offset, rotInd, expmapInd)
+            seq_coords = np.transpose(frames_coords[:, h36_coords_used_joints, :], (1, 0, 2))[np.newaxis, ...]
             seq_coords[..., 1] = seq_coords[..., 1] * -1  # Inverting y axis for visualization purposes
             return seq_coords
 
@@ -1054,10 +1057,8 @@ if __name__ == "__main__":
         parent, offset, rotInd, expmapInd = _some_variables()
 
         def to_coords(seq_angles):
-            seq_coords = np.empty((len(h36_coords_used_joints), seq_angles.shape[0], 3))
-            for i in range(seq_angles.shape[0]):
-                frame_coords = fkl(seq_angles[i, :], parent, offset, rotInd, expmapInd)
-                seq_coords[:, i, :] = frame_coords[h36_coords_used_joints, :]
+            frames_coords = fkl_batch(seq_angles, parent, offset, rotInd, expmapInd)
+            seq_coords = np.transpose(frames_coords[:, h36_coords_used_joints, :], (1, 0, 2))
             seq_coords[..., 1] = seq_coords[..., 1] * -1  # Inverting y axis for visualization purposes
             return seq_coords
 
@@ -0,0 +1,82 @@
+from __future__ import absolute_import, division, print_function
+from argparse import Namespace
+import h5py
+import numpy as np
+import pytest
+from config import get_config
+from data_input import DataInput
+
+
+@pytest.fixture(scope='module')
+def data_path(tmpdir_factory):
+    # Small MSRC12 like data set, ragged sequences with leading padding frames
+    path = tmpdir_factory.mktemp('data')
+    rng = np.random.RandomState(0)
+    with h5py.File(str(path.join('MSRC12v1.h5')), 'w') as h5file:
+        for split, nseqs in [('Train', 30), ('Validate', 21)]:
+            for s in range(nseqs):
+                plen = rng.randint(10, 120)
+                pose = rng.randn(20, 4, plen).astype(np.float32)
+                pose[:, 3, :] = rng.rand(20, plen) > 0.1
+                pose[:, :, :rng.randint(0, 5)] = 0
+                group = h5file.create_group('MSRC12/%s/SEQ%d' % (split, s))
+                group['Subject'] = np.int32(rng.randint(1, 30))
+                group['Action'] = np.int32(rng.randint(1, 12))
+                group['Pose'] = pose
+    return str(path) + '/'
+
+
+def _data_input(data_path, **options):
+    config = get_config(Namespace(config_file='motiongan_v7_nogan_msrc', save_path=None))
+    config.data_path = data_path
+    config.batch_size = 4
+    config.pick_num = 0
+    config.crop_len = 0
+    config.augment_data = False
+    config.__dict__.update(options)
+    return DataInput(config)
+
+
+def test_ragged_splits_match(data_path):
+    """The split loaded sequentially, by the load workers and from the cache is the same."""
+    ram = _data_input(data_path)
+    for data_input in [_data_input(data_path, load_workers=2), _data_input(data_path, data_cache=True)]:
+        for is_training in [True, False]:
+            np.testing.assert_array_equal(data_input.labs[is_training], ram.labs[is_training])
+            np.testing.assert_array_equal(data_input.starts[is_training], ram.starts[is_training])
+            np.testing.assert_array_equal(data_input.frames[is_training], ram.frames[is_training])
+
+
+@pytest.mark.parametrize('data_cache', [False, True])
+def test_streamed_batches_match(data_path, data_cache):
+    """Streamed validation batches come in order, as the ones of the loaded split. Only the first
+    epoch is compared, the loaded split pads its epochs to whole batches before wrapping around."""
+    ram = _data_input(data_path, only_val=True)
+    stream = _data_input(data_path, only_val=True, data_streaming=True, data_cache=data_cache,
+                         stream_buffer_mb=0.01)
+    ram_batches, stream_batches = ram.batch_generator(False), stream.batch_generator(False)
+    for _ in range(ram.len_val_keys // ram.batch_size):
+        ram_labs, ram_poses = ram_batches.next()
+        stream_labs, stream_poses = stream_batches.next()
+        np.testing.assert_array_equal(stream_labs, ram_labs)
+        np.testing.assert_array_equal(stream_poses, ram_poses)
+
+
+def test_shuffled_stream_samples(data_path):
+    """Shuffled streamed batches hold the loaded sequences, each one once per epoch."""
+    ram = _data_input(data_path)
+    stream = _data_input(data_path, data_streaming=True, stream_buffer_mb=0.05)
+    seq_poses = {}
+    for batch_start in range(0, ram.len_train_keys, ram.batch_size):
+        seq_idcs = np.arange(batch_start, batch_start + ram.batch_size) % ram.len_train_keys
+        labs_batch, poses_batch = ram.sub_sample_batch((ram.labs[True][seq_idcs], ram.starts[True][seq_idcs]), True)
+        seq_poses.update(zip(labs_batch[:, 0], poses_batch))
+
+    stream_batches = stream.batch_generator(True)
+    seq_idcs = []
+    for _ in range(ram.len_train_keys // ram.batch_size):
+        labs_batch, poses_batch = stream_batches.next()
+        for labs, poses in zip(labs_batch, poses_batch):
+            np.testing.assert_array_equal(poses, seq_poses[labs[0]])
+            seq_idcs.append(labs[0])
+    assert len(set(seq_idcs)) == len(seq_idcs)
@@ -0,0 +1,47 @@
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pytest
+from utils.prefetch import BatchPrefetcher
+
+
+def _produce(index, rng):
+    return index, rng.rand(4)
+
+
+def _take(prefetcher, num_batches):
+    return [prefetcher.next() for _ in range(num_batches)]
+
+
+def _assert_same(batches, ref_batches):
+    assert [index for index, _ in batches] == [index for index, _ in ref_batches]
+    for (_, batch), (_, ref_batch) in zip(batches, ref_batches):
+        np.testing.assert_array_equal(batch, ref_batch)
+
+
+@pytest.mark.parametrize('worker_type', ['thread', 'process'])
+@pytest.mark.parametrize('num_workers', [1, 3])
+def test_stream_is_deterministic(worker_type, num_workers):
+    """The stream only depends on the seed and the start index, not on the workers."""
+    ref_batches = _take(BatchPrefetcher(_produce, 0, seed=[42, 1], start_index=5), 12)
+    prefetcher = BatchPrefetcher(_produce, num_workers, 4, seed=[42, 1], start_index=5, worker_type=worker_type)
+    try:
+        _assert_same(_take(prefetcher, 12), ref_batches)
+
+        # Restarted on the same workers, the batches of the previous stream are dropped
+        prefetcher.reset([42, 2], 0)
+        _assert_same(_take(prefetcher, 6), _take(BatchPrefetcher(_produce, 0, seed=[42, 2]), 6))
+    finally:
+        prefetcher.close()
+
+
+@pytest.mark.parametrize('worker_type', ['thread', 'process'])
+def test_errors_are_raised(worker_type):
+    def _fail(index, rng):
+        if index == 3:
+            raise ValueError('batch %d' % index)
+        return index
+
+    prefetcher = BatchPrefetcher(_fail, 2, 4, worker_type=worker_type)
+    assert _take(prefetcher, 3) == [0, 1, 2]
+    with pytest.raises(ValueError):
+        prefetcher.next()
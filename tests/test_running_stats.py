@@ -0,0 +1,41 @@
+from __future__ import absolute_import, division, print_function
+import numpy as np
+from utils.running_stats import RunningStats
+
+
+def _chunks(x, rng, nchunks):
+    # Random split points, empty chunks included
+    bounds = np.sort(rng.randint(0, x.shape[0] + 1, nchunks - 1))
+    return np.split(x, bounds)
+
+
+def test_update_matches_numpy():
+    rng = np.random.RandomState(0)
+    x = rng.normal(3.0, 2.0, size=(1000, 5, 3))
+    stats = RunningStats([5, 3])
+    for chunk in _chunks(x, rng, 20):
+        stats.update(chunk)
+    assert stats.count == x.shape[0]
+    np.testing.assert_allclose(stats.mean, np.mean(x, axis=0))
+    np.testing.assert_allclose(stats.std, np.std(x, axis=0))
+
+
+def test_merge_matches_numpy():
+    """Partial stats, e.g. of the shards of a pool, merge into the stats of the whole."""
+    rng = np.random.RandomState(1)
+    x = rng.normal(-1.0, 0.5, size=(777, 3)) * [1.0, 10.0, 100.0]
+    stats = RunningStats([3])
+    for shard in _chunks(x, rng, 8):
+        shard_stats = RunningStats([3])
+        for chunk in _chunks(shard, rng, 3):
+            shard_stats.update(chunk)
+        stats.merge(shard_stats)
+    assert stats.count == x.shape[0]
+    np.testing.assert_allclose(stats.mean, np.mean(x, axis=0))
+    np.testing.assert_allclose(stats.std, np.std(x, axis=0))
+
+
+def test_empty_stats():
+    stats = RunningStats([3]).merge(RunningStats([3])).update(np.zeros([0, 3]))
+    assert stats.count == 0
+    np.testing.assert_array_equal(stats.std, np.zeros([3]))
@@ -0,0 +1,71 @@
+from __future__ import absolute_import, division, print_function
+from argparse import Namespace
+from collections import OrderedDict
+import numpy as np
+import tensorflow as tf
+import tensorflow.contrib.keras.api.keras.backend as K
+from config import get_config
+from models.motiongan import get_model
+
+NUM_STEPS = 3
+
+
+def _run(train_fn):
+    """Builds a small model reading the same batches from a tf.data iterator, with the same
+    initial weights, and returns the training losses of train_fn and the losses (and outputs)
+    of the trained model on a fixed batch."""
+    K.clear_session()
+    tf.set_random_seed(42)
+    config = get_config(Namespace(config_file='motiongan_v7_nogan_msrc', save_path=None))
+    # The regularization losses (l2 of the convolution kernels) must follow the steps too
+    config.model_version = 'v5'
+    config.gan_type = 'standard'
+    config.batch_size = 4
+    config.pick_num = 8
+    config.steps_per_run = NUM_STEPS
+    config.input_pipeline = 'tf_data'
+
+    rng = np.random.RandomState(0)
+    poses = rng.normal(size=(2 * NUM_STEPS + 1, config.batch_size, config.njoints, config.pick_num, 3))
+    masks = rng.rand(2 * NUM_STEPS + 1, config.batch_size, config.njoints, config.pick_num, 1) < 0.5
+    poses, masks = poses.astype(np.float32), masks.astype(np.float32)
+    iterator = tf.data.Dataset.from_tensor_slices({'real_seq': poses[:-1],
+                                                   'seq_mask': masks[:-1]}).make_one_shot_iterator()
+    model_wrap = get_model(config, iterator.get_next(), iterator.get_next)
+    K.get_session().run(tf.global_variables_initializer())
+
+    train_losses = train_fn(model_wrap)
+    eval_losses = model_wrap.disc_eval([poses[-1], poses[-1], masks[-1]])
+    eval_losses.update(model_wrap.gen_eval([poses[-1], masks[-1]]))
+    del eval_losses['fae_z']
+    return train_losses, eval_losses
+
+
+def _assert_close(losses, ref_losses):
+    assert sorted(losses.keys()) == sorted(ref_losses.keys())
+    for key in ref_losses.keys():
+        np.testing.assert_allclose(losses[key], ref_losses[key], rtol=1e-5, err_msg=key)
+
+
+def _mean_losses(steps_losses):
+    return tuple(OrderedDict([(key, np.mean([losses[d][key] for losses in steps_losses]))
+                              for key in steps_losses[0][d].keys()]) for d in range(2))
+
+
+def test_train_loop_matches_single_steps():
+    """Each step of the in graph loop computes with the weights updated by the previous one, so
+    N steps in a run match N runs of a single step. The first discriminator step also matches the
+    train function, up to rounding, the losses are built again in the loop. Later steps can not be
+    compared, Nadam turns the rounding noise of the null gradients (e.g. of the biases followed
+    by a normalization) into full steps."""
+    single_losses, single_eval_losses = _run(
+        lambda model_wrap: [model_wrap.train_loop(1) for _ in range(NUM_STEPS)])
+    loop_losses, loop_eval_losses = _run(lambda model_wrap: model_wrap.train_loop(NUM_STEPS))
+    train_f_losses, _ = _run(lambda model_wrap: model_wrap.disc_train([]))
+
+    # The steps change the weights, the regularization losses included
+    assert single_losses[0][1]['train/gen_loss_reg'] != single_losses[-1][1]['train/gen_loss_reg']
+    for losses, ref_losses in zip(loop_losses, _mean_losses(single_losses)):
+        _assert_close(losses, ref_losses)
+    _assert_close(loop_eval_losses, single_eval_losses)
+    _assert_close(train_f_losses, single_losses[0][0])
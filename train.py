@@ -1,6 +1,7 @@
 from __future__ import absolute_import, division, print_function
 import numpy as np
 import tensorflow as tf
+import tensorflow.contrib.keras.api.keras.backend as K
 from config import get_config
 from data_input import DataInput
 from utils.callbacks import TensorBoard
@@ -9,10 +10,11 @@ from utils.restore_keras_model import restore_keras_model
 from tqdm import trange
 from utils.viz import plot_seq_gif, plot_seq_emb
 from utils.seq_utils import MASK_MODES, gen_mask, gen_latent_noise
+from utils import tfseq_utils
+from utils.prefetch import BatchPrefetcher
 
 
-def _reset_rand_seed():
-    seed = 42
+def _reset_rand_seed(seed=42):
     np.random.seed(seed)
     tf.set_random_seed(seed)
 
@@ -34,14 +36,117 @@ if __name__ == "__main__":
 
     data_input = DataInput(config)
     _reset_rand_seed()
+
     train_batches = data_input.train_epoch_size
-    train_generator = data_input.batch_generator(True)
     val_batches = data_input.val_epoch_size
     val_generator = data_input.batch_generator(False)
 
+    disc_batches = 1
+    # disc_batches = 55 if ((config.epoch < 1 and batch < train_batches // 10)
+    #                           or (batch % 10 == 0)) else 5
+    # The fused step trains both networks on a single batch
+    step_batches = 1 if config.fused_train_step else disc_batches + 1
+
+    def get_keep_prob(epoch):
+        return 0.5 if config.train_fp else (np.random.RandomState([config.nan_restarts, epoch]).rand() * 0.5) + 0.25
+
+    def get_start_index():
+        return (config.epoch * train_batches + config.batch) * step_batches
+
+    # Streamed batches can only be read in order, through a generator shared by the prefetch threads
+    assert not config.data_streaming or (config.prefetch_type == 'thread' and config.input_pipeline == 'feed_dict'), \
+        'data_streaming requires the feed_dict input pipeline with thread prefetch workers'
+    train_stream = data_input.batch_generator(True) if config.data_streaming else None
+
+    def prepare_train_batch(index, rng):
+        # Each training step consumes disc_batches batches for the discriminator, then one for the generator
+        epoch, batch = divmod(index // step_batches, train_batches)
+        if train_stream is not None:
+            labs_batch, poses_batch = train_stream.next()
+        else:
+            labs_batch, poses_batch = data_input.get_batch(True, index, rng)
+
+        keep_prob = get_keep_prob(epoch)
+        mask_mode = 1
+        if not config.train_fp and batch % 2 == 1:
+            mask_mode = rng.randint(2, len(MASK_MODES))
+        mask_batch = gen_mask(mask_mode, keep_prob, config.batch_size, config.njoints,
+                              data_input.pshape[1], config.body_members, rng=rng,
+                              out=np.empty(poses_batch.shape[:3] + (1,), dtype=np.float32))
+        mask_batch *= poses_batch[..., 3, np.newaxis]
+        poses_batch = poses_batch[..., :3]
+
+        latent_noise = None
+        if config.latent_cond_dim > 0:
+            latent_noise = gen_latent_noise(config.batch_size, config.latent_cond_dim, rng=rng)
+
+        return labs_batch, poses_batch, mask_batch, latent_noise
+
+    def get_train_inputs(labs_batch, poses_batch, mask_batch, latent_noise):
+        gen_inputs = [poses_batch, mask_batch]
+        labels = np.reshape(labs_batch[:, 2], (config.batch_size, 1))
+        place_holders = []
+        if config.action_cond:
+            place_holders.append(labels)
+            gen_inputs.append(labels)
+        if config.latent_cond_dim > 0:
+            place_holders.append(latent_noise)
+            gen_inputs.append(latent_noise)
+        return gen_inputs, place_holders
+
+    train_prefetcher = None
+    if config.input_pipeline == 'feed_dict':
+        # Process workers are forked here, before any tf session exists, and are reused on restarts
+        # Seeded with the restarts count, so an epoch restarted because of nans sees new batches
+        train_prefetcher = BatchPrefetcher(prepare_train_batch, config.prefetch_workers, config.prefetch_queue_size,
+                                           seed=[42, config.nan_restarts], start_index=get_start_index(),
+                                           worker_type=config.prefetch_type)
+
+    assert config.steps_per_run == 1 or config.input_pipeline == 'tf_data', \
+        'the in graph training loop (steps_per_run > 1) needs the tf_data input pipeline'
+    assert config.steps_per_run == 1 or not config.mixed_precision, \
+        'the in graph training loop (steps_per_run > 1) does not support mixed_precision'
+    train_inputs = None
+    train_input_fn = None
+    if config.input_pipeline == 'tf_data':
+        # Start index and keep probs are fed on (re)initialization, e.g. after a nan restart
+        start_index_ph = tf.placeholder(tf.int64, [], name='start_index')
+        keep_probs_ph = tf.placeholder(tf.float32, [config.num_epochs], name='keep_probs')
+
+        def prepare_train_batch_tf(index, labs_batch, poses_batch):
+            # In graph version of prepare_train_batch
+            epoch = tf.minimum((index // step_batches) // train_batches, config.num_epochs - 1)
+            batch = (index // step_batches) % train_batches
+            keep_prob = tf.gather(keep_probs_ph, epoch)
+            mask_mode = tf.constant(1)
+            if not config.train_fp:
+                mask_mode = tf.where(tf.equal(batch % 2, 1),
+                                     tf.random_uniform([], 2, len(MASK_MODES), dtype=tf.int32), mask_mode)
+            mask_batch = poses_batch[..., 3:] * tfseq_utils.gen_mask(
+                mask_mode, keep_prob, config.batch_size, config.njoints,
+                data_input.pshape[1], config.body_members)
+
+            train_inputs = {'real_seq': poses_batch[..., :3], 'seq_mask': mask_batch}
+            if config.action_cond:
+                train_inputs['true_label'] = labs_batch[:, 2:3]
+            if config.latent_cond_dim > 0:
+                train_inputs['latent_cond'] = tfseq_utils.gen_latent_noise(config.batch_size, config.latent_cond_dim)
+            return train_inputs
+
+        train_iterator = data_input.tf_dataset(True, prepare_train_batch_tf, start_index_ph,
+                                               config.prefetch_queue_size).make_initializable_iterator()
+        train_inputs = train_iterator.get_next()
+        train_input_fn = train_iterator.get_next
+
+    if config.num_replicas > 1:
+        session_config = tf.ConfigProto(allow_soft_placement=True)
+        if config.replica_device == 'cpu':
+            session_config.device_count['CPU'] = config.num_replicas
+        K.set_session(tf.Session(config=session_config))
+
     # Model building
     if config.model_type == 'motiongan':
-        model_wrap = get_model(config)
+        model_wrap = get_model(config, train_inputs, train_input_fn)
 
     if FLAGS.verbose:
         print('Discriminator model:')
@@ -76,6 +181,22 @@ if __name__ == "__main__":
                               write_graph=True)
     tensorboard.set_model(model_wrap.gan_model)
 
+    def start_train_inputs():
+        if config.input_pipeline == 'tf_data':
+            feed_dict = data_input.tf_feed_dict(True)
+            feed_dict[start_index_ph] = get_start_index()
+            feed_dict[keep_probs_ph] = [get_keep_prob(epoch) for epoch in range(config.num_epochs)]
+            K.get_session().run(train_iterator.initializer, feed_dict)
+        elif train_prefetcher.index != get_start_index() or train_prefetcher.seed != [42, config.nan_restarts]:
+            # Restart of an epoch, the stream was already started at the right index on startup
+            train_prefetcher.reset([42, config.nan_restarts], get_start_index())
+
+    def close_train_prefetcher():
+        if train_prefetcher is not None:
+            train_prefetcher.close()
+
+    start_train_inputs()
+
     try:
         while config.epoch < config.num_epochs:
             tensorboard.on_epoch_begin(config.epoch)
@@ -85,84 +206,54 @@ if __name__ == "__main__":
                 # learning_rate = config.learning_rate * (1.0 - (config.epoch / config.num_epochs))
                 model_wrap.update_lr(learning_rate)
 
-            t = trange(config.batch, train_batches)
+            t = trange(config.batch, train_batches, config.steps_per_run)
             t.set_description('| ep: %d | lr: %.2e |' % (config.epoch, learning_rate))
             disc_loss_sum = 0.0
             gen_loss_sum = 0.0
-            keep_prob = 0.5 if config.train_fp else (np.random.rand() * 0.5) + 0.25
             for batch in t:
                 tensorboard.on_batch_begin(batch)
 
-                disc_batches = 1
-                # disc_batches = 55 if ((config.epoch < 1 and batch < train_batches // 10)
-                #                           or (batch % 10 == 0)) else 5
-                disc_loss = 0.0
-                loss_real = 0.0
-                loss_fake = 0.0
-                for disc_batch in range(disc_batches):
-                    labs_batch, poses_batch = train_generator.next()
-
-                    mask_batch = poses_batch[..., 3, np.newaxis]
-                    mask_mode = 1
-                    if not config.train_fp and batch % 2 == 1:
-                        mask_mode = np.random.randint(2, len(MASK_MODES))
-                    mask_batch = mask_batch * gen_mask(mask_mode, keep_prob,
-                                                       config.batch_size, config.njoints,
-                                                       model_wrap.seq_len, config.body_members)
-                    poses_batch = poses_batch[..., :3]
-
-                    disc_inputs = [poses_batch]
-                    gen_inputs = [poses_batch, mask_batch]
-                    labels = np.reshape(labs_batch[:, 2], (config.batch_size, 1))
-                    place_holders = []
-                    if config.action_cond:
-                        place_holders.append(labels)
-                        gen_inputs.append(labels)
-                    if config.latent_cond_dim > 0:
-                        latent_noise = gen_latent_noise(config.batch_size, config.latent_cond_dim)
-                        place_holders.append(latent_noise)
-                        gen_inputs.append(latent_noise)
-
-                    losses = model_wrap.disc_train(disc_inputs + gen_inputs + place_holders)
-
-                    if disc_batch == 0:
-                        disc_losses = losses
+                # Number of training steps of this iteration, the training loop runs several at once
+                num_steps = min(config.steps_per_run, train_batches - batch)
+                if config.steps_per_run > 1:
+                    disc_losses, gen_losses = model_wrap.train_loop(num_steps)
+                elif config.fused_train_step:
+                    if train_prefetcher is None:
+                        disc_losses, gen_losses = model_wrap.fused_train([])
+                    else:
+                        gen_inputs, _ = get_train_inputs(*train_prefetcher.next())
+                        disc_losses, gen_losses = model_wrap.fused_train(gen_inputs)
+                else:
+                    for disc_batch in range(disc_batches):
+                        if train_prefetcher is None:
+                            # tf_data pipeline, the train function reads its inputs in graph
+                            losses = model_wrap.disc_train([])
+                        else:
+                            labs_batch, poses_batch, mask_batch, latent_noise = train_prefetcher.next()
+                            gen_inputs, place_holders = get_train_inputs(labs_batch, poses_batch,
+                                                                         mask_batch, latent_noise)
+                            losses = model_wrap.disc_train([poses_batch] + gen_inputs + place_holders)
+
+                        if disc_batch == 0:
+                            disc_losses = losses
+                        else:
+                            for key in disc_losses.keys():
+                                disc_losses[key] += losses[key]
+
+                    for key in disc_losses.keys():
+                        disc_losses[key] /= disc_batches
+
+                    if train_prefetcher is None:
+                        gen_losses = model_wrap.gen_train([])
                     else:
-                        for key in disc_losses.keys():
-                            disc_losses[key] += losses[key]
-
-                for key in disc_losses.keys():
-                    disc_losses[key] /= disc_batches
-
-                labs_batch, poses_batch = train_generator.next()
-
-                mask_batch = poses_batch[..., 3, np.newaxis]
-                mask_mode = 1
-                if not config.train_fp and batch % 2 == 1:
-                    mask_mode = np.random.randint(2, len(MASK_MODES))
-                mask_batch = mask_batch * gen_mask(mask_mode, keep_prob,
-                                                   config.batch_size, config.njoints,
-                                                   model_wrap.seq_len, config.body_members)
-                poses_batch = poses_batch[..., :3]
-
-                gen_inputs = [poses_batch, mask_batch]
-                labels = np.reshape(labs_batch[:, 2], (config.batch_size, 1))
-                place_holders = []
-                if config.action_cond:
-                    place_holders.append(labels)
-                    gen_inputs.append(labels)
-                if config.latent_cond_dim > 0:
-                    latent_noise = gen_latent_noise(config.batch_size, config.latent_cond_dim)
-                    place_holders.append(latent_noise)
-                    gen_inputs.append(latent_noise)
-
-                gen_losses = model_wrap.gen_train(gen_inputs)  # + place_holders)
+                        gen_inputs, _ = get_train_inputs(*train_prefetcher.next())
+                        gen_losses = model_wrap.gen_train(gen_inputs)  # + place_holders)
 
                 # Output to terminal, note output is averaged over the epoch
-                disc_loss_sum += disc_losses['train/disc_loss_gan']
-                gen_loss_sum += gen_losses['train/gen_loss_gan']
-                t.set_postfix(disc_loss='%.2e' % (disc_loss_sum / (batch + 1)),
-                              gen_loss='%.2e' % (gen_loss_sum / (batch + 1)))
+                disc_loss_sum += disc_losses['train/disc_loss_gan'] * num_steps
+                gen_loss_sum += gen_losses['train/gen_loss_gan'] * num_steps
+                t.set_postfix(disc_loss='%.2e' % (disc_loss_sum / (batch + num_steps)),
+                              gen_loss='%.2e' % (gen_loss_sum / (batch + num_steps)))
 
                 logs = disc_losses.copy()
                 logs.update(gen_losses)
@@ -177,9 +268,9 @@ if __name__ == "__main__":
                     assert config.nan_restarts < 25, "restarted too many times because of nans"
                     break
 
-                tensorboard.on_batch_end(batch, logs)
+                tensorboard.on_batch_end(batch + num_steps - 1, logs)
 
-                config.batch = batch + 1
+                config.batch = batch + num_steps
 
             # Restarting epoch after sudden break
             if config.batch < train_batches:
@@ -188,6 +279,7 @@ if __name__ == "__main__":
                 model_wrap.gen_model = restore_keras_model(
                     model_wrap.gen_model, config.save_path + '_gen_weights.hdf5', False)
                 config.batch = 0
+                start_train_inputs()
                 continue
 
             labs_batch, poses_batch = val_generator.next()
@@ -265,7 +357,9 @@ if __name__ == "__main__":
             config.save()
 
     except KeyboardInterrupt:
+        close_train_prefetcher()
         save_models()
         config.save()
 
+    close_train_prefetcher()
     tensorboard.on_train_end()
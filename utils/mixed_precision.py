@@ -0,0 +1,77 @@
+from __future__ import absolute_import, division, print_function
+from contextlib import contextmanager
+import tensorflow as tf
+import tensorflow.contrib.keras.api.keras.backend as K
+from tensorflow.contrib.keras.api.keras.layers import Layer
+
+
+def _master_dtype(dtype, compute_dtype):
+    # Floating point weights are always created in float32
+    if dtype is None or tf.as_dtype(dtype) == tf.as_dtype(compute_dtype):
+        return tf.float32
+    return dtype
+
+
+@contextmanager
+def mixed_precision_scope(compute_dtype='float16'):
+    """Layers built in this scope keep float32 weights, the master weights updated by the optimizers
+    and saved in the checkpoints, but compute with compute_dtype casts of them.
+    The inputs of the layers must be of compute_dtype."""
+    tf_add_variable = tf.layers.Layer.add_variable
+    keras_add_weight = Layer.add_weight
+
+    def _cast(weight):
+        if weight.dtype.base_dtype == tf.float32:
+            return K.cast(weight, compute_dtype)
+        return weight
+
+    def add_variable(self, name, shape, dtype=None, *args, **kwargs):
+        return _cast(tf_add_variable(self, name, shape, _master_dtype(dtype, compute_dtype), *args, **kwargs))
+
+    def add_weight(self, name, shape, dtype=None, *args, **kwargs):
+        return _cast(keras_add_weight(self, name, shape, _master_dtype(dtype, compute_dtype), *args, **kwargs))
+
+    tf.layers.Layer.add_variable = add_variable
+    Layer.add_weight = add_weight
+    try:
+        yield
+    finally:
+        tf.layers.Layer.add_variable = tf_add_variable
+        Layer.add_weight = keras_add_weight
+
+
+class DynamicLossScale(object):
+    """Dynamic loss scaling, keeps the small float16 gradients from flushing to zero.
+
+    The loss is multiplied by the scale before computing the gradients, which are divided
+    by it afterwards. When the gradients are not finite, the scale is halved and the update
+    should be skipped (see is_finite), after increment_period finite steps it is doubled.
+    """
+
+    def __init__(self, init_scale=2.0 ** 15, increment_period=2000, name='loss_scale'):
+        self.increment_period = increment_period
+        with K.name_scope(name):
+            self.scale = K.variable(init_scale, name='scale')
+            self.good_steps = K.variable(0, dtype='int64', name='good_steps')
+
+    def get_scale(self):
+        # Explicit read, the scale may be used in graph loops
+        return self.scale.read_value()
+
+    def get_gradients(self, loss, params):
+        scale = self.get_scale()
+        grads = K.gradients(loss * scale, params)
+        return [tf.convert_to_tensor(grad) / scale for grad in grads]
+
+    def is_finite(self, grads):
+        return tf.reduce_all(tf.stack([tf.reduce_all(tf.is_finite(grad)) for grad in grads]))
+
+    def get_updates(self, is_finite):
+        scale = self.get_scale()
+        good_steps = self.good_steps.read_value()
+        new_good_steps = tf.where(is_finite, good_steps + 1, tf.zeros_like(good_steps))
+        increase = new_good_steps >= self.increment_period
+        new_scale = tf.where(is_finite, tf.where(increase, scale * 2.0, scale), tf.maximum(scale / 2.0, 1.0))
+        new_good_steps = tf.where(increase, tf.zeros_like(new_good_steps), new_good_steps)
+        with tf.control_dependencies([new_scale, new_good_steps]):
+            return [tf.assign(self.scale, new_scale), tf.assign(self.good_steps, new_good_steps)]
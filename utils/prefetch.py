@@ -0,0 +1,139 @@
+from __future__ import absolute_import, division, print_function
+import time
+import threading
+import multiprocessing
+import numpy as np
+from six.moves import queue
+
+
+class BatchPrefetcher(object):
+    """Prepares batches in background workers, filling bounded queues.
+
+    Batch i is produced by calling produce_fn(i, rng), where rng is a RandomState
+    seeded with (seed, i). Worker w handles batches w, w + num_workers, ... in its own
+    queue, and next() reads the queues round robin, so the stream is deterministic
+    regardless of the number of workers or their scheduling.
+
+    Args:
+        produce_fn: callable (index, rng) -> batch.
+        num_workers: number of workers, 0 produces synchronously on next().
+        queue_size: max number of prepared batches waiting, shared among workers.
+        seed: int or list of ints, base seed of the per batch rngs.
+        start_index: index of the first batch to produce, to resume a stream.
+        worker_type: 'thread' or 'process'. Processes are forked, so produce_fn
+            does not need to be picklable, but its results do. Create process
+            prefetchers before any tf session, forking a process with live
+            session threads can deadlock, and restart them with reset().
+    """
+
+    def __init__(self, produce_fn, num_workers=2, queue_size=8, seed=42, start_index=0, worker_type='thread'):
+        assert worker_type in ('thread', 'process'), 'unknown worker type %s' % worker_type
+        self.produce_fn = produce_fn
+        self.num_workers = num_workers
+
+        if worker_type == 'thread':
+            make_queue, make_worker, self._stop_event = queue.Queue, threading.Thread, threading.Event()
+        else:
+            make_queue, make_worker, self._stop_event = multiprocessing.Queue, multiprocessing.Process, multiprocessing.Event()
+
+        worker_queue_size = max(1, queue_size // max(1, num_workers))
+        self._queues = [make_queue(worker_queue_size) for _ in range(num_workers)]
+        self._cmd_queues = [make_queue() for _ in range(num_workers)]
+        self._generation = 0
+        self._workers = []
+        for w in range(num_workers):
+            worker = make_worker(target=self._work, args=(self._queues[w], self._cmd_queues[w]))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        self.reset(seed, start_index)
+
+    def reset(self, seed, start_index):
+        """Restarts the stream from start_index with a new seed, reusing the workers.
+
+        Process workers are only forked once, so the stream can be restarted after
+        the parent has created threads (e.g. a tf session) without forking again.
+        """
+        self.seed = list(seed) if isinstance(seed, (list, tuple)) else [seed]
+        self.index = start_index
+        self.start_index = start_index
+        # Batches of previous generations still in the queues are dropped by next()
+        self._generation += 1
+        for w, cmd_queue in enumerate(self._cmd_queues):
+            cmd_queue.put((self._generation, self.seed, start_index + w))
+
+    def _produce(self, seed, index):
+        rng = np.random.RandomState(seed + [index])
+        return self.produce_fn(index, rng)
+
+    def _work(self, out_queue, cmd_queue):
+        generation = None
+        while not self._stop_event.is_set():
+            try:
+                # Waits for a command while idle, otherwise only checks for a reset between batches
+                if generation is None:
+                    generation, seed, index = cmd_queue.get(timeout=0.1)
+                else:
+                    generation, seed, index = cmd_queue.get_nowait()
+            except queue.Empty:
+                if generation is None:
+                    continue
+            try:
+                item = (generation, True, self._produce(seed, index))
+            except Exception as e:
+                item = (generation, False, e)
+            while not self._stop_event.is_set():
+                try:
+                    out_queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if item[1]:
+                index += self.num_workers
+            else:
+                generation = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.num_workers == 0:
+            batch = self._produce(self.seed, self.index)
+        else:
+            out_queue = self._queues[(self.index - self.start_index) % self.num_workers]
+            while True:
+                # Polling keeps the consumer interruptible by KeyboardInterrupt
+                try:
+                    generation, is_ok, batch = out_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if generation == self._generation:
+                    break
+            if not is_ok:
+                self.close()
+                raise batch
+        self.index += 1
+        return batch
+
+    __next__ = next
+
+    def qsize(self):
+        return sum([out_queue.qsize() for out_queue in self._queues])
+
+    def close(self, timeout=5.0):
+        self._stop_event.set()
+        deadline = time.time() + timeout
+        while any([worker.is_alive() for worker in self._workers]) and time.time() < deadline:
+            # Keep draining, workers (and process queue feeders) may be blocked on full queues
+            for out_queue in self._queues:
+                try:
+                    while True:
+                        out_queue.get(timeout=0.01)
+                except queue.Empty:
+                    pass
+            for worker in self._workers:
+                worker.join(timeout=0.01)
+        for worker in self._workers:
+            if isinstance(worker, multiprocessing.Process) and worker.is_alive():
+                worker.terminate()
+        self._workers = []
@@ -0,0 +1,41 @@
+from __future__ import absolute_import, division, print_function
+import numpy as np
+
+
+class RunningStats(object):
+    """Streaming mean and variance along the first axis of the updates (Welford / Chan et al.).
+    Partial stats, e.g. computed by different processes, are combined with merge."""
+
+    def __init__(self, shape):
+        self.count = 0
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if x.shape[0] == 0:
+            return self
+        mean = np.mean(x, axis=0)
+        m2 = np.sum(np.square(x - mean), axis=0)
+        return self._merge(x.shape[0], mean, m2)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        return self._merge(other.count, other.mean, other.m2)
+
+    def _merge(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + np.square(delta) * (self.count * count / total)
+        self.count = total
+        return self
+
+    @property
+    def var(self):
+        return self.m2 / max(self.count, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
@@ -7,27 +7,39 @@ from utils.npangles import quaternion_between, quaternion_to_expmap, expmap_to_r
 MASK_MODES = ('No mask', 'Future Prediction', 'Missing Frames', 'Occlusion Simulation', 'Structured Occlusion', 'Noisy Transmission')
 
 
-def gen_mask(mask_type, keep_prob, batch_size, njoints, seq_len, body_members, baseline_mode=False):
+def gen_mask(mask_type, keep_prob, batch_size, njoints, seq_len, body_members, baseline_mode=False,
+             rng=np.random, out=None):
+    """Masks [batch_size, njoints, seq_len, 1], drawn independently for each sample, for all the
+    samples of a mode at once. mask_type and keep_prob are scalars or per sample arrays.
+    The masks are written in out if given."""
+    mask_types = np.broadcast_to(mask_type, [batch_size])
+    keep_probs = np.broadcast_to(np.asarray(keep_prob, dtype=np.float64), [batch_size])
+
     # Default mask, no mask
-    mask = np.ones(shape=(batch_size, njoints, seq_len, 1))
-    if mask_type == 1:  # Future Prediction
-        mask[:, :, np.int(seq_len * keep_prob):, :] = 0.0
-    elif mask_type == 2:  # Missing Frames
-        occ_frames = np.random.randint(seq_len - 1, size=np.int(seq_len * (1.0 - keep_prob)))
-        mask[:, :, occ_frames, :] = 0.0
-    elif mask_type == 3:  # Occlusion Simulation
-        rand_joints = np.random.randint(njoints, size=np.int(njoints * (1.0 - keep_prob)))
-        mask[:, rand_joints, :, :] = 0.0
-    elif mask_type == 4:  # Structured Occlusion Simulation
-        rand_joints = set()
-        while ((njoints - len(rand_joints)) >
-               (njoints * keep_prob)):
-            joints_to_add = (body_members.values()[np.random.randint(len(body_members))])['joints']
-            for joint in joints_to_add:
-                rand_joints.add(joint)
-        mask[:, list(rand_joints), :, :] = 0.0
-    elif mask_type == 5:  # Noisy transmission
-        mask = np.random.binomial(1, keep_prob, size=mask.shape)
+    mask = np.empty((batch_size, njoints, seq_len, 1)) if out is None else out
+    mask[...] = 1.0
+
+    for mode in np.unique(mask_types):
+        samples = np.flatnonzero(mask_types == mode)
+        nsamples = samples.shape[0]
+        mode_keep_probs = keep_probs[samples]
+        if mode == 1:  # Future Prediction
+            known_frames = (seq_len * mode_keep_probs).astype(np.int64)
+            frames_keep = np.arange(seq_len)[np.newaxis, :] < known_frames[:, np.newaxis]
+            mask[samples, ...] = frames_keep[:, np.newaxis, :, np.newaxis]
+        elif mode == 2:  # Missing Frames
+            occ_count = (seq_len * (1.0 - mode_keep_probs)).astype(np.int64)
+            occ_frames = _random_occlusion(occ_count, seq_len, seq_len - 1, rng)
+            mask[samples, ...] = ~occ_frames[:, np.newaxis, :, np.newaxis]
+        elif mode == 3:  # Occlusion Simulation
+            occ_count = (njoints * (1.0 - mode_keep_probs)).astype(np.int64)
+            occ_joints = _random_occlusion(occ_count, njoints, njoints, rng)
+            mask[samples, ...] = ~occ_joints[:, :, np.newaxis, np.newaxis]
+        elif mode == 4:  # Structured Occlusion Simulation
+            occ_joints = _structured_occlusion(mode_keep_probs, njoints, body_members, rng)
+            mask[samples, ...] = ~occ_joints[:, :, np.newaxis, np.newaxis]
+        elif mode == 5:  # Noisy transmission
+            mask[samples, ...] = rng.rand(nsamples, njoints, seq_len, 1) < mode_keep_probs[:, np.newaxis, np.newaxis, np.newaxis]
 
     if baseline_mode:
         # This unmasks first and last frame for all sequences (required for baselines)
@@ -35,28 +47,88 @@ def gen_mask(mask_type, keep_prob, batch_size, njoints, seq_len, body_members, b
     return mask
 
 
-def gen_latent_noise(batch_size, latent_cond_dim):
-    return np.random.uniform(size=(batch_size, latent_cond_dim))
+def _random_occlusion(occ_count, depth, high, rng):
+    # Occludes occ_count[i] indices for sample i, drawn with replacement in [0, high)
+    nsamples = occ_count.shape[0]
+    occ_idcs = rng.randint(high, size=(nsamples, depth))
+    is_drawn = np.arange(depth)[np.newaxis, :] < occ_count[:, np.newaxis]
+    occluded = np.zeros((nsamples, depth), dtype=bool)
+    occluded[np.nonzero(is_drawn)[0], occ_idcs[is_drawn]] = True
+    return occluded
+
+
+def _structured_occlusion(keep_probs, njoints, body_members, rng):
+    # Occludes random body members until no more than njoints * keep_prob joints are visible.
+    # Members are drawn in rounds for all the pending samples, the cumulative unions tell
+    # where each sample would have stopped
+    members_joints = np.zeros((len(body_members), njoints), dtype=bool)
+    for m, member in enumerate(body_members.values()):
+        members_joints[m, member['joints']] = True
+
+    nsamples = keep_probs.shape[0]
+    occluded = np.zeros((nsamples, njoints), dtype=bool)
+    is_pending = njoints > (njoints * keep_probs)
+    while np.any(is_pending):
+        pending = np.flatnonzero(is_pending)
+        draws = members_joints[rng.randint(len(body_members), size=(pending.shape[0], len(body_members)))]
+        cum_occluded = np.logical_or.accumulate(draws, axis=1) | occluded[pending, np.newaxis, :]
+        is_done = (njoints - np.sum(cum_occluded, axis=-1)) <= (njoints * keep_probs[pending, np.newaxis])
+        any_done = np.any(is_done, axis=1)
+        last_draw = np.where(any_done, np.argmax(is_done, axis=1), len(body_members) - 1)
+        occluded[pending, :] = cum_occluded[np.arange(pending.shape[0]), last_draw, :]
+        is_pending[pending] = ~any_done
+    return occluded
+
+
+def gen_latent_noise(batch_size, latent_cond_dim, rng=np.random):
+    return rng.uniform(size=(batch_size, latent_cond_dim))
 
 
 def linear_baseline(real_seq, mask):
+    return linear_baseline_batch(real_seq[np.newaxis, ...], mask[np.newaxis, ...])[0, ...]
+
+
+def linear_baseline_batch(real_seq, mask):
+    """Batched linear_baseline, poses [batch, njoints, seq_len, 3] and masks [batch, njoints, seq_len, 1].
+    The unknown frames are blended from the closest known frames before and after them, bit for bit
+    as the frame by frame version, where the frames without known ones before are blended from the
+    previous (already blended) frame, and the ones without known ones after from the next frame."""
     linear_seq = real_seq * mask
-    for j in range(real_seq.shape[0]):
-        for f in range(1, real_seq.shape[1] - 1):
-            if mask[j, f, 0] == 0:
-                prev_f = f - 1
-                for g in range(f - 1, -1, -1):
-                    if mask[j, g, 0] == 1:
-                        prev_f = g
-                        break
-                next_f = f + 1
-                for g in range(f + 1, real_seq.shape[1]):
-                    if mask[j, g, 0] == 1:
-                        next_f = g
-                        break
-                blend_factor = (f - prev_f) / (next_f - prev_f)
-                linear_seq[j, f, :] = ((linear_seq[j, prev_f, :] * (1 - blend_factor)) +
-                                       (linear_seq[j, next_f, :] * blend_factor))
+    batch_size, njoints, seq_len = real_seq.shape[:3]
+    frames = np.arange(seq_len)
+    known = mask[..., 0] == 1
+    unknown = mask[..., 0] == 0
+    unknown[..., 0] = False
+    unknown[..., -1] = False
+
+    # Closest known frames strictly before and after each frame, -1 and seq_len if none
+    last_known = np.maximum.accumulate(np.where(known, frames, -1), axis=-1)
+    first_known = np.minimum.accumulate(np.where(known, frames, seq_len)[..., ::-1], axis=-1)[..., ::-1]
+    prev_f = np.concatenate([np.full([batch_size, njoints, 1], -1), last_known[..., :-1]], axis=-1)
+    next_f = np.concatenate([first_known[..., 1:], np.full([batch_size, njoints, 1], seq_len)], axis=-1)
+    has_prev = prev_f >= 0
+    prev_f = np.where(has_prev, prev_f, frames - 1)
+    next_f = np.where(next_f < seq_len, next_f, frames + 1)
+
+    # Weights computed in double precision and cast, as the python float scalars
+    blend_factor = (frames - prev_f) / (next_f - prev_f)
+    seq_blend = blend_factor.astype(linear_seq.dtype)[..., np.newaxis]
+    prev_blend = (1 - blend_factor).astype(linear_seq.dtype)[..., np.newaxis]
+    batch_idcs = np.arange(batch_size)[:, np.newaxis, np.newaxis]
+    joint_idcs = np.arange(njoints)[np.newaxis, :, np.newaxis]
+    next_seq = linear_seq[batch_idcs, joint_idcs, np.clip(next_f, 0, seq_len - 1), :]
+
+    # Frames with a known frame before, only blended from unmodified frames
+    blend = unknown & has_prev
+    prev_seq = linear_seq[batch_idcs, joint_idcs, np.clip(prev_f, 0, seq_len - 1), :]
+    linear_seq = np.where(blend[..., np.newaxis], (prev_seq * prev_blend) + (next_seq * seq_blend), linear_seq)
+
+    # Frames without, blended from the previous one, in order
+    blend = unknown & ~has_prev
+    for f in np.nonzero(np.any(blend, axis=(0, 1)))[0]:
+        frame_blend = ((linear_seq[:, :, f - 1, :] * prev_blend[:, :, f, :]) +
+                       (next_seq[:, :, f, :] * seq_blend[:, :, f, :]))
+        linear_seq[:, :, f, :] = np.where(blend[:, :, f, np.newaxis], frame_blend, linear_seq[:, :, f, :])
     return linear_seq
 
 
@@ -71,9 +143,10 @@ def burke_baseline(rawdata, mask, tol=0.0025, sigR=1e-3, keepOriginal=True):
     mask = np.reshape(mask, (raw_shape[0], raw_shape[1] * raw_shape[2]))
 
     rawdata[mask == 0] = np.nan
+    observed = ~np.isnan(rawdata)
 
-    X = rawdata[~np.isnan(rawdata).any(axis=1)]
-    if X.size == 0 or np.product(X.shape[-2:]) == 0:
+    X = rawdata[observed.all(axis=1)]
+    if X.size == 0 or np.prod(X.shape[-2:]) == 0:
         return np.zeros((raw_shape[1], raw_shape[0], raw_shape[2]))
 
     m = np.mean(X, axis=0)
@@ -84,45 +157,51 @@ def burke_baseline(rawdata, mask, tol=0.0025, sigR=1e-3, keepOriginal=True):
     if len(d[0]) == 0:
         return np.zeros((raw_shape[1], raw_shape[0], raw_shape[2]))
     d = d[0][0]
-
-    Q = np.dot(np.dot(V[0:d, :], np.diag(np.std(np.diff(X, axis=0), axis=0))), V[0:d, :].T)
-
-    state = []
-    state_pred = []
-    cov_pred = []
-    cov = []
-    cov.insert(0, 1e12 * np.eye(d))
-    state.insert(0, np.random.normal(0.0, 1.0, d))
-    cov_pred.insert(0, 1e12 * np.eye(d))
-    state_pred.insert(0, np.random.normal(0.0, 1.0, d))
-    for i in range(1, rawdata.shape[0] + 1):
-        z = rawdata[i - 1, ~np.isnan(rawdata[i - 1, :])]
-        H = np.diag(~np.isnan(rawdata[i - 1, :]))
-        H = H[~np.all(H == 0, axis=1)]
-        Ht = np.dot(H, V[0:d, :].T)
-
-        R = sigR * np.eye(H.shape[0])
-
-        state_pred.insert(i, state[i - 1])
-        cov_pred.insert(i, cov[i - 1] + Q)
-
-        K = np.dot(np.dot(cov_pred[i], Ht.T), np.linalg.inv(np.dot(np.dot(Ht, cov_pred[i]), Ht.T) + R))
-
-        state.insert(i, state_pred[i] + np.dot(K, (z - (np.dot(Ht, state_pred[i]) + np.dot(H, m)))))
-        cov.insert(i, np.dot(np.eye(d) - np.dot(K, Ht), cov_pred[i]))
-
-    y = np.zeros(rawdata.shape)
-    y[-1, :] = np.dot(V[0:d, :].T, state[-1]) + m
-    for i in range(len(state) - 2, 0, -1):
-        state[i] = state[i] + np.dot(np.dot(cov[i], np.linalg.inv(cov_pred[i])),
-                                     (state[i + 1] - state_pred[i + 1]))
-        cov[i] = cov[i] + np.dot(np.dot(np.dot(cov[i], np.linalg.inv(cov_pred[i])),
-                                        (cov[i + 1] - cov_pred[i + 1])), cov[i])
-
-        y[i - 1, :] = np.dot(V[0:d, :].T, state[i]) + m
+    Vd = V[0:d, :]
+
+    Q = np.dot(Vd * np.std(np.diff(X, axis=0), axis=0), Vd.T)
+
+    # Index 0 is the initial state, index i the state after the frame i - 1
+    nframes = rawdata.shape[0]
+    state = np.empty((nframes + 1, d))
+    state_pred = np.empty((nframes + 1, d))
+    cov = np.empty((nframes + 1, d, d))
+    cov_pred = np.empty((nframes + 1, d, d))
+    cov[0, ...] = 1e12 * np.eye(d)
+    state[0, :] = np.random.normal(0.0, 1.0, d)
+    cov_pred[0, ...] = 1e12 * np.eye(d)
+    state_pred[0, :] = np.random.normal(0.0, 1.0, d)
+    for i in range(1, nframes + 1):
+        # The observation matrix selects the observed coords, H = I[obs_idcs]
+        obs_idcs = np.nonzero(observed[i - 1, :])[0]
+        z = rawdata[i - 1, obs_idcs]
+        Ht = Vd[:, obs_idcs].T
+
+        state_pred[i, :] = state[i - 1, :]
+        cov_pred[i, ...] = cov[i - 1, ...] + Q
+
+        if len(obs_idcs) == 0:
+            state[i, :] = state_pred[i, :]
+            cov[i, ...] = cov_pred[i, ...]
+            continue
+
+        # K = P H' S^-1, from the solution of S K' = H P (S and P are symmetric)
+        Ht_cov = np.dot(Ht, cov_pred[i, ...])
+        K = np.linalg.solve(np.dot(Ht_cov, Ht.T) + sigR * np.eye(len(obs_idcs)), Ht_cov).T
+
+        state[i, :] = state_pred[i, :] + np.dot(K, z - (np.dot(Ht, state_pred[i, :]) + m[obs_idcs]))
+        cov[i, ...] = np.dot(np.eye(d) - np.dot(K, Ht), cov_pred[i, ...])
+
+    for i in range(nframes - 1, 0, -1):
+        # G = cov[i] cov_pred[i]^-1, from the solution of cov_pred[i]' G' = cov[i]'
+        G = np.linalg.solve(cov_pred[i, ...].T, cov[i, ...].T).T
+        state[i, :] = state[i, :] + np.dot(G, state[i + 1, :] - state_pred[i + 1, :])
+        cov[i, ...] = cov[i, ...] + np.dot(np.dot(G, cov[i + 1, ...] - cov_pred[i + 1, ...]), cov[i, ...])
+
+    y = np.dot(state[1:, :], Vd) + m
 
     if (keepOriginal):
-        y[~np.isnan(rawdata)] = rawdata[~np.isnan(rawdata)]
+        y[observed] = rawdata[observed]
 
     y = np.reshape(y, (raw_shape[0], raw_shape[1], raw_shape[2]))
     y = np.transpose(y, (1, 0, 2))
@@ -130,6 +209,21 @@ def burke_baseline(rawdata, mask, tol=0.0025, sigR=1e-3, keepOriginal=True):
     return y
 
 
+def _burke_baseline_star(args):
+    return burke_baseline(*args)
+
+
+def burke_baseline_batch(rawdata, mask, pool=None, tol=0.0025, sigR=1e-3, keepOriginal=True):
+    """burke_baseline of poses [batch, njoints, seq_len, 3] and masks [batch, njoints, seq_len, 1].
+    The samples are smoothed in parallel if a multiprocessing pool is given."""
+    burke_args = [(rawdata[i, ...], mask[i, ...], tol, sigR, keepOriginal) for i in range(rawdata.shape[0])]
+    if pool is not None:
+        burke_seqs = pool.map(_burke_baseline_star, burke_args)
+    else:
+        burke_seqs = [_burke_baseline_star(args) for args in burke_args]
+    return np.stack(burke_seqs, axis=0)
+
+
 def get_body_graph(body_members):
     members_from = []
     members_to = []
@@ -170,95 +264,93 @@ def get_swap_list(body_members):
     return swap_list
 
 
-def post_process(real_seq, gen_seq, mask, body_members):
+def get_body_levels(body_members):
+    """Joints of the body tree by depth, as in a traversal from the root (0),
+    a list of (joint_idcs, parent_idcs) per level, the root level has parent_idcs None"""
     _, _, graph = get_body_graph(body_members)
 
-    blend_seq = real_seq * mask
+    levels = [(np.array([0]), None)]
+    while True:
+        parent_idcs = [parent_idx for parent_idx in levels[-1][0] for _ in graph.get(parent_idx, [])]
+        joint_idcs = [child_idx for parent_idx in levels[-1][0] for child_idx in graph.get(parent_idx, [])]
+        if len(joint_idcs) == 0:
+            return levels
+        levels.append((np.array(joint_idcs), np.array(parent_idcs)))
 
-    def _post_process_joint(frame, joint_idx, parent_idx):
-        if mask[joint_idx, frame, 0] == 0:
-            # Blend in time
-            blend_seq[joint_idx, frame, :] = (blend_seq[joint_idx, frame - 1, :]
-                                              + gen_seq[joint_idx, frame, :] - gen_seq[joint_idx, frame - 1, :])
-            # Blend in space
-            if parent_idx is not None:
-                space_blend = (gen_seq[joint_idx, frame, :] - gen_seq[parent_idx, frame, :]
-                               + blend_seq[parent_idx, frame, :])
-                blend_seq[joint_idx, frame, :] = (blend_seq[joint_idx, frame, :] + space_blend) / 2
 
-        for child_idx in graph[joint_idx]:
-            _post_process_joint(frame, child_idx, joint_idx)
+def post_process(real_seq, gen_seq, mask, body_members):
+    return post_process_batch(real_seq[np.newaxis, ...], gen_seq[np.newaxis, ...],
+                              mask[np.newaxis, ...], body_members)[0, ...]
 
-    for f in range(1, real_seq.shape[1] - 1):
-        _post_process_joint(f, 0, None)
 
-    return blend_seq
+def post_process_batch(real_seq, gen_seq, mask, body_members):
+    """post_process of a batch [batch, njoints, seq_len, 3], blending all the joints of a tree
+    level at once, for all the samples. Only the frames are processed in order."""
+    levels = get_body_levels(body_members)
 
+    blend_seq = real_seq * mask
+    unknown = mask[..., 0] == 0
+
+    for f in range(1, real_seq.shape[2] - 1):
+        # Blend in time
+        time_blend = blend_seq[:, :, f - 1, :] + gen_seq[:, :, f, :] - gen_seq[:, :, f - 1, :]
+        for joint_idcs, parent_idcs in levels:
+            joint_blend = time_blend[:, joint_idcs, :]
+            # Blend in space, with the parents already blended in this frame
+            if parent_idcs is not None:
+                space_blend = (gen_seq[:, joint_idcs, f, :] - gen_seq[:, parent_idcs, f, :]
+                               + blend_seq[:, parent_idcs, f, :])
+                joint_blend = (joint_blend + space_blend) / 2
+            blend_seq[:, joint_idcs, f, :] = np.where(unknown[:, joint_idcs, f, np.newaxis],
+                                                      joint_blend, blend_seq[:, joint_idcs, f, :])
 
-def seq_to_angles_transformer(body_members):
-    _, _, body_graph = get_body_graph(body_members)
+    return blend_seq
 
-    def _get_angles(coords):
-        base_shape = [int(dim) for dim in coords.shape]
-        base_shape.pop(1)
-        base_shape[-1] = 1
 
-        coords_list = np.split(coords, int(coords.shape[1]), axis=1)
-        coords_list = [np.squeeze(elem, axis=1) for elem in coords_list]
+class KinematicPlan(object):
+    """Bones of the body tree, in the order of the angles of seq_to_angles_transformer, computed
+    once per body_members. The bone joint -> child has the angle between it and the bone joint -> parent.
+    The bones of the root have no parent bone and no angle (they are fixed)."""
 
-        def _get_angle_for_joint(joint_idx, parent_idx, angles):
-            if parent_idx is None:  # joint_idx should be 0
-                parent_bone = np.concatenate([np.ones(base_shape),
-                                              np.zeros(base_shape),
-                                              np.zeros(base_shape)], axis=-1)
-            else:
-                parent_bone = coords_list[parent_idx] - coords_list[joint_idx]
+    def __init__(self, body_members):
+        _, _, body_graph = get_body_graph(body_members)
 
+        def _traverse(joint_idx, parent_idx, bones):
+            # All the bones of a joint first, then the ones of each of its children
             for child_idx in body_graph[joint_idx]:
-                child_bone = coords_list[child_idx] - coords_list[joint_idx]
-                angle = quaternion_between(parent_bone, child_bone)
-                angle = quaternion_to_expmap(angle)
-                angle = expmap_to_rotmat(angle)
-                angle = rotmat_to_euler(angle)
-                angles.append(angle)
-
+                bones.append((parent_idx, joint_idx, child_idx))
             for child_idx in body_graph[joint_idx]:
-                angles = _get_angle_for_joint(child_idx, joint_idx, angles)
-
-            return angles
+                bones = _traverse(child_idx, joint_idx, bones)
+            return bones
+
+        bones = _traverse(0, None, [])[len(body_graph[0]):]
+        self.parent_idcs = np.array([bone[0] for bone in bones], dtype=np.int64)
+        self.joint_idcs = np.array([bone[1] for bone in bones], dtype=np.int64)
+        self.child_idcs = np.array([bone[2] for bone in bones], dtype=np.int64)
+        self.nbones = len(bones)
+
+    def get_angles(self, coords):
+        """Euler angles [batch, nbones, seq_len, 3] of coords [batch, njoints, seq_len, 3],
+        each conversion runs once for all the bones"""
+        joint_coords = coords[:, self.joint_idcs, ...]
+        parent_bone = coords[:, self.parent_idcs, ...] - joint_coords
+        child_bone = coords[:, self.child_idcs, ...] - joint_coords
+        angle = quaternion_between(parent_bone, child_bone)
+        angle = quaternion_to_expmap(angle)
+        angle = expmap_to_rotmat(angle)
+        return rotmat_to_euler(angle)
+
+    def get_angles_mask(self, coord_masks):
+        """Masks [batch, nbones, seq_len, 1] of the angles, the mask of the child joint"""
+        return coord_masks[:, self.child_idcs, ...]
 
-        angles = _get_angle_for_joint(0, None, [])
-        fixed_angles = len(body_graph[0])
-        angles = angles[fixed_angles:]
-        return np.stack(angles, axis=1)
 
-    return _get_angles
+def seq_to_angles_transformer(body_members):
+    return KinematicPlan(body_members).get_angles
 
 
 def get_angles_mask(coord_masks, body_members):
-
-    _, _, body_graph = get_body_graph(body_members)
-
-    base_shape = [int(dim) for dim in coord_masks.shape]
-    base_shape.pop(1)
-    base_shape[-1] = 1
-
-    coord_masks_list = np.split(coord_masks, int(coord_masks.shape[1]), axis=1)
-    coord_masks_list = [np.squeeze(elem, axis=1) for elem in coord_masks_list]
-
-    def _get_angle_mask_for_joint(joint_idx, angles_mask):
-        for child_idx in body_graph[joint_idx]:
-            angles_mask.append(coord_masks_list[child_idx])
-
-        for child_idx in body_graph[joint_idx]:
-            angles_mask = _get_angle_mask_for_joint(child_idx, angles_mask)
-
-        return angles_mask
-
-    angles_mask = _get_angle_mask_for_joint(0, [])
-    fixed_angles = len(body_graph[0])
-    angles_mask = angles_mask[fixed_angles:]
-    return np.stack(angles_mask, axis=1)
+    return KinematicPlan(body_members).get_angles_mask(coord_masks)
 
 
 def fkl(angles, parent, offset, rotInd, expmapInd):
@@ -279,41 +371,44 @@ def fkl(angles, parent, offset, rotInd, expmapInd):
 
     assert len(angles) == 99
 
-    # Structure that indicates parents for each joint
+    return fkl_batch(angles[np.newaxis, :], parent, offset, rotInd, expmapInd)[0, ...]
+
+
+def fkl_batch(angles, parent, offset, rotInd, expmapInd):
+    """
+    fkl of a batch of frames, angles [N, 99], returns the 3d points [N, 32, 3].
+    All the rotations are converted at once, then the joints are composed by tree levels,
+    all the joints of a level and all the frames at once.
+    """
+    assert angles.shape[-1] == 99
+
     njoints = 32
-    xyzStruct = [dict() for x in range(njoints)]
-
-    for i in np.arange(njoints):
-
-        if not rotInd[i]:  # If the list is empty
-            xangle, yangle, zangle = 0, 0, 0
-        else:
-            xangle = angles[rotInd[i][0] - 1]
-            yangle = angles[rotInd[i][1] - 1]
-            zangle = angles[rotInd[i][2] - 1]
-
-        r = angles[expmapInd[i]]
-
-        thisRotation = expmap_to_rotmat(r)
-        thisPosition = np.array([xangle, yangle, zangle])
-
-        if parent[i] == -1:  # Root node
-            xyzStruct[i]['rotation'] = thisRotation
-            xyzStruct[i]['xyz'] = np.reshape(offset[i, :],
-                                             (1, 3)) + thisPosition
-        else:
-            xyzStruct[i]['xyz'] = (offset[i, :] + thisPosition).dot(
-                xyzStruct[parent[i]]['rotation']) + xyzStruct[parent[i]]['xyz']
-            xyzStruct[i]['rotation'] = thisRotation.dot(
-                xyzStruct[parent[i]]['rotation'])
-
-    xyz = [xyzStruct[i]['xyz'] for i in range(njoints)]
-    xyz = np.array(xyz).squeeze()
-    xyz = xyz[:, [0, 2, 1]]
-    # xyz = xyz[:,[2,0,1]]
-    # xyz = np.reshape(xyz, [-1])
-
-    return xyz
+    rotations = expmap_to_rotmat(angles[:, np.stack(expmapInd, axis=0)])
+    positions = np.zeros((angles.shape[0], njoints, 3), dtype=angles.dtype)
+    for i in range(njoints):
+        if rotInd[i]:
+            positions[:, i, :] = angles[:, np.array(rotInd[i]) - 1]
+    positions = positions + offset
+
+    # Depth of each joint in the tree
+    depth = np.zeros(njoints, dtype=np.int64)
+    for i in range(njoints):
+        if parent[i] != -1:
+            depth[i] = depth[parent[i]] + 1
+
+    xyz = np.empty_like(positions)
+    for level in range(np.max(depth) + 1):
+        joint_idcs = np.nonzero(depth == level)[0]
+        if level == 0:  # Root node
+            xyz[:, joint_idcs, :] = positions[:, joint_idcs, :]
+            continue
+        parent_idcs = parent[joint_idcs]
+        parent_rotations = rotations[:, parent_idcs, ...]
+        xyz[:, joint_idcs, :] = (np.matmul(positions[:, joint_idcs, np.newaxis, :], parent_rotations)[..., 0, :]
+                                 + xyz[:, parent_idcs, :])
+        rotations[:, joint_idcs, ...] = np.matmul(rotations[:, joint_idcs, ...], parent_rotations)
+
+    return xyz[..., [0, 2, 1]]
 
 
 def revert_coordinate_space(channels, R0, T0):
@@ -99,7 +99,7 @@ def quaternion_between(u, v):
     if u.shape[-1] != 3 or v.shape[-1] != 3:
         raise ValueError("The last dimension of u and v must be 3.")
 
-    if u.shape != v.shape:
+    if not u.shape.is_compatible_with(v.shape):
         raise ValueError("u and v must have the same shape")
 
     def _vector_batch_dot(a, b):
@@ -111,10 +111,8 @@ def quaternion_between(u, v):
     def _normalize(a):
         return a / tf.sqrt(_length_2(a) + 1e-8)
 
-    base_shape = [int(d) for d in u.shape]
-    base_shape[-1] = 1
-    zero_dim = tf.zeros(base_shape)
-    one_dim = tf.ones(base_shape)
+    zero_dim = tf.zeros_like(u[..., :1])
+    one_dim = tf.ones_like(zero_dim)
     w = tf.sqrt(_length_2(u) * _length_2(v)) + _vector_batch_dot(u, v)
 
     q = tf.where(
@@ -205,26 +203,21 @@ def expmap_to_rotmat(r):
     Returns:
       R: (..., 3, 3) rotation matrix Tensor
     """
-    base_shape = [int(d) for d in r.shape][:-1]
-    zero_dim = tf.zeros(base_shape)
+    zero_dim = tf.zeros_like(r[..., 0])
 
     theta = tf.sqrt(tf.reduce_sum(tf.square(r), axis=-1, keep_dims=True) + 1e-8)
     r0 = r / theta
 
-    r0x = tf.reshape(
-        tf.stack([zero_dim, -1.0 * r0[..., 2], r0[..., 1],
-                  zero_dim, zero_dim, -1.0 * r0[..., 0],
-                  zero_dim, zero_dim, zero_dim], axis=-1),
-        base_shape + [3, 3]
-    )
+    r0x = tf.stack([tf.stack([zero_dim, -1.0 * r0[..., 2], r0[..., 1]], axis=-1),
+                    tf.stack([zero_dim, zero_dim, -1.0 * r0[..., 0]], axis=-1),
+                    tf.stack([zero_dim, zero_dim, zero_dim], axis=-1)], axis=-2)
     trans_dims = range(len(r0x.shape))
     trans_dims[-1], trans_dims[-2] = trans_dims[-2], trans_dims[-1]
     r0x = r0x - tf.transpose(r0x, trans_dims)
 
-    tile_eye = tf.constant(np.tile(np.reshape(np.eye(3), [1 for _ in base_shape] + [3, 3]), base_shape + [1, 1]), dtype=tf.float32)
     theta = tf.expand_dims(theta, axis=-1)
 
-    R = tile_eye + tf.sin(theta) * r0x + (1.0 - tf.cos(theta)) * tf.matmul(r0x, r0x)
+    R = tf.eye(3, dtype=r.dtype) + tf.sin(theta) * r0x + (1.0 - tf.cos(theta)) * tf.matmul(r0x, r0x)
     return R
 
 
@@ -307,9 +300,8 @@ def rotmat_to_euler(R):
     Returns:
       eul: a (..., 3) Euler angle representation of R
     """
-    base_shape = [int(d) for d in R.shape][:-2]
-    zero_dim = tf.zeros(base_shape)
-    one_dim = tf.ones(base_shape)
+    zero_dim = tf.zeros_like(R[..., 0, 0])
+    one_dim = tf.ones_like(zero_dim)
 
     econd0 = tf.equal(R[..., 0, 2], one_dim)
     econd1 = tf.equal(R[..., 0, 2], -1.0 * one_dim)
@@ -0,0 +1,84 @@
+from __future__ import absolute_import, division, print_function
+import tensorflow as tf
+import numpy as np
+from utils.seq_utils import MASK_MODES
+
+
+def gen_mask(mask_type, keep_prob, batch_size, njoints, seq_len, body_members, baseline_mode=False):
+    """In graph version of utils.seq_utils.gen_mask, masks are drawn independently for each sample.
+    mask_type and keep_prob are scalars or per sample tensors [batch_size].
+    Returns a float32 mask of shape [batch_size, njoints, seq_len, 1]."""
+    with tf.name_scope('gen_mask'):
+        mask_type = tf.convert_to_tensor(mask_type, dtype=tf.int32)
+        mask_type = mask_type + tf.zeros([batch_size], dtype=tf.int32)
+        keep_prob = tf.convert_to_tensor(keep_prob, dtype=tf.float32)
+        keep_prob = keep_prob + tf.zeros([batch_size], dtype=tf.float32)
+        frames_range = tf.range(seq_len)
+
+        def _frames_mask(frames_keep):
+            return tf.tile(tf.cast(frames_keep, tf.float32)[:, tf.newaxis, :], [1, njoints, 1])
+
+        def _joints_mask(joints_keep):
+            return tf.tile(tf.cast(joints_keep, tf.float32)[:, :, tf.newaxis], [1, 1, seq_len])
+
+        def _random_occlusion(occ_count, depth, high):
+            # Occludes occ_count[i] indices for sample i, drawn with replacement in [0, high)
+            occ_idcs = tf.random_uniform([batch_size, depth], 0, high, dtype=tf.int32)
+            is_drawn = tf.cast(tf.range(depth)[tf.newaxis, :] < occ_count[:, tf.newaxis], tf.float32)
+            return tf.reduce_max(tf.one_hot(occ_idcs, depth) * is_drawn[..., tf.newaxis], axis=1) > 0
+
+        # No mask
+        masks = [tf.ones([batch_size, njoints, seq_len])]
+
+        # Future Prediction
+        known_frames = tf.cast(tf.floor(seq_len * keep_prob), tf.int32)
+        masks.append(_frames_mask(frames_range[tf.newaxis, :] < known_frames[:, tf.newaxis]))
+
+        # Missing Frames
+        occ_count = tf.cast(tf.floor(seq_len * (1.0 - keep_prob)), tf.int32)
+        masks.append(_frames_mask(tf.logical_not(_random_occlusion(occ_count, seq_len, seq_len - 1))))
+
+        # Occlusion Simulation
+        occ_count = tf.cast(tf.floor(njoints * (1.0 - keep_prob)), tf.int32)
+        masks.append(_joints_mask(tf.logical_not(_random_occlusion(occ_count, njoints, njoints))))
+
+        # Structured Occlusion Simulation, members are added to the pending samples until done
+        members_joints = np.zeros([len(body_members), njoints], dtype=bool)
+        for m, member in enumerate(body_members.values()):
+            members_joints[m, member['joints']] = True
+        members_joints = tf.constant(members_joints)
+
+        def _is_pending(occ_joints):
+            return (njoints - tf.reduce_sum(tf.cast(occ_joints, tf.float32), axis=1)) > (njoints * keep_prob)
+
+        def _cond(occ_joints):
+            return tf.reduce_any(_is_pending(occ_joints))
+
+        def _body(occ_joints):
+            members = tf.random_uniform([batch_size], 0, len(body_members), dtype=tf.int32)
+            new_joints = tf.logical_and(tf.gather(members_joints, members), _is_pending(occ_joints)[:, tf.newaxis])
+            return tf.logical_or(occ_joints, new_joints)
+
+        occ_joints = tf.while_loop(_cond, _body, [tf.zeros([batch_size, njoints], dtype=tf.bool)], back_prop=False)
+        masks.append(_joints_mask(tf.logical_not(occ_joints)))
+
+        # Noisy transmission
+        masks.append(tf.cast(tf.random_uniform([batch_size, njoints, seq_len]) <
+                             keep_prob[:, tf.newaxis, tf.newaxis], tf.float32))
+
+        assert len(masks) == len(MASK_MODES)
+        masks = tf.stack(masks, axis=1)
+        mask = tf.gather_nd(masks, tf.stack([tf.range(batch_size), mask_type], axis=1))
+
+        if baseline_mode:
+            # This unmasks first and last frame for all sequences (required for baselines)
+            is_edge = tf.logical_or(tf.equal(frames_range, 0), tf.equal(frames_range, seq_len - 1))
+            mask = tf.maximum(mask, tf.cast(is_edge, tf.float32)[tf.newaxis, tf.newaxis, :])
+
+        mask = mask[..., tf.newaxis]
+        mask.set_shape([batch_size, njoints, seq_len, 1])
+        return mask
+
+
+def gen_latent_noise(batch_size, latent_cond_dim):
+    return tf.random_uniform([batch_size, latent_cond_dim])